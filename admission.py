@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+'''
+Module provides admission control for the git processes git_http_backend
+runs, so that a crowd of clients (say, 2000 clones at once) does not make
+as many git upload-pack / pack-objects processes and push the box into swap.
+
+Every launch of git asks AdmissionController for a slot, named after the
+repo and the service:
+    advertise-refs  /info/refs requests (cheap)
+    upload-pack     fetches, clones (pack generation, expensive)
+    receive-pack    pushes
+Slots are limited in total, per repo and per service. Requests not getting
+a slot right away wait in a bounded queue, cheaper services first (see
+AdmissionController.priorities), for at most timeout seconds. Requests
+finding the queue full, or timing out, are answered with
+"503 Service Unavailable" and a Retry-After header.
+
+acquire() waits on the calling thread. Event loops wait with enqueue(),
+withdraw() and releaser() instead, which do not block.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bisect
+import itertools
+import threading
+
+class AdmissionController(object):
+    '''
+    Hands out slots for running git processes.
+
+    Counters:
+        admitted - slots handed out (right away or after waiting).
+        queued - requests that had to wait.
+        rejected - requests turned away as the queue was full.
+        timed_out - requests that waited for timeout seconds in vain.
+    '''
+    # lower = served first.
+    priorities = {
+        'advertise-refs': 0,
+        'receive-pack': 1,
+        'upload-pack': 2
+    }
+
+    def __init__(self, max_total = 32, max_per_repo = 8, max_per_service = None,
+            max_queue = 128, timeout = 30.0, retry_after = 5):
+        '''
+        @param max_total (Default: 32) Max number of git processes at a time.
+        @param max_per_repo (Default: 8) Same, per repo. None = no limit.
+        @param max_per_service (Default: None) Dict of service name : max
+            number of git processes of that service at a time. Say,
+            {'upload-pack': 24} keeps 8 of 32 slots for the other services.
+        @param max_queue (Default: 128) Max number of requests waiting.
+        @param timeout (Default: 30.0) Max seconds a request waits.
+        @param retry_after (Default: 5) Seconds to put in Retry-After
+            header of 503 responses.
+        '''
+        self.max_total = max_total
+        self.max_per_repo = max_per_repo
+        self.max_per_service = max_per_service or {}
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.total = 0
+        self.per_repo = {}
+        self.per_service = {}
+        # sorted list of [priority, sequence number, repo path, service, notify]
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.lock = threading.Lock()
+
+    def _allowed(self, repo_path, service):
+        # must be called with self.lock acquired.
+        if self.total >= self.max_total:
+            return False
+        if self.max_per_repo is not None and self.per_repo.get(repo_path, 0) >= self.max_per_repo:
+            return False
+        limit = self.max_per_service.get(service)
+        return limit is None or self.per_service.get(service, 0) < limit
+
+    def _take(self, repo_path, service):
+        # must be called with self.lock acquired.
+        self.total += 1
+        self.per_repo[repo_path] = self.per_repo.get(repo_path, 0) + 1
+        self.per_service[service] = self.per_service.get(service, 0) + 1
+        self.admitted += 1
+
+    def acquire(self, repo_path, service, timeout = None):
+        '''
+        Asks for a slot for running git service against the repo.
+
+        Waits (up to timeout seconds, Default: self.timeout) for one if
+        needed. Returns a callable to call once git is done (releasing the
+        slot), or None if there is no slot to be had.
+
+        timeout = 0 just checks for a free slot (and is not counted as
+        rejected when there is none.)
+        '''
+        probe = timeout == 0
+        if timeout is None:
+            timeout = self.timeout
+        admitted = threading.Event()
+        waiter = self._enqueue(repo_path, service, admitted.set, bool(timeout), not probe)
+        if waiter is None:
+            return None
+        admitted.wait(timeout)
+        if self.withdraw(waiter, timed_out = True):
+            return None
+        return self.releaser(waiter)
+
+    def enqueue(self, repo_path, service, notify):
+        '''
+        Asks for a slot without waiting for it, for event loops.
+
+        Returns None if there is no slot and no room in the queue, or
+        else a waiter. notify() is called (right away, or later from the
+        thread releasing a slot, with the controller's lock held) once the
+        waiter has its slot. Then releaser(waiter) gives the callable
+        releasing it. A waiter given up on (timeout, cancellation) is to be
+        withdraw()n. If that returns False the slot came in the meantime
+        and is to be released.
+        '''
+        return self._enqueue(repo_path, service, notify, True, True)
+
+    def _enqueue(self, repo_path, service, notify, queue, count_rejected):
+        waiter = [
+            self.priorities.get(service, len(self.priorities)),
+            next(self.sequence),
+            repo_path,
+            service,
+            notify
+            ]
+        with self.lock:
+            if self._allowed(repo_path, service):
+                self._take(repo_path, service)
+                notify()
+                return waiter
+            if not queue or len(self.waiters) >= self.max_queue:
+                if count_rejected:
+                    self.rejected += 1
+                return None
+            bisect.insort(self.waiters, waiter)
+            self.queued += 1
+        return waiter
+
+    def withdraw(self, waiter, timed_out = False):
+        '''
+        Takes the waiter out of the queue. Returns True if it was still
+        waiting, False if it has been handed a slot already.
+        '''
+        with self.lock:
+            if waiter not in self.waiters:
+                return False
+            self.waiters.remove(waiter)
+            if timed_out:
+                self.timed_out += 1
+            return True
+
+    def releaser(self, waiter):
+        '''
+        Returns the callable releasing the slot handed to the waiter.
+        '''
+        return self._releaser(waiter[2], waiter[3])
+
+    def _releaser(self, repo_path, service):
+        released = []
+        def release():
+            if released:
+                return
+            released.append(True)
+            self._release(repo_path, service)
+        return release
+
+    def _release(self, repo_path, service):
+        with self.lock:
+            self.total -= 1
+            self.per_repo[repo_path] -= 1
+            if not self.per_repo[repo_path]:
+                del self.per_repo[repo_path]
+            self.per_service[service] -= 1
+            # handing freed slots out, most important waiting requests first.
+            for waiter in list(self.waiters):
+                if self.total >= self.max_total:
+                    break
+                if self._allowed(waiter[2], waiter[3]):
+                    self._take(waiter[2], waiter[3])
+                    self.waiters.remove(waiter)
+                    waiter[4]()
+
+    def status(self):
+        '''
+        Returns a dict of counters and numbers of slots in use and of
+        requests waiting.
+        '''
+        with self.lock:
+            return {
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'running': self.total,
+                'running_per_service': dict((k, v) for k, v in self.per_service.items() if v),
+                'waiting': len(self.waiters)
+            }
@@ -0,0 +1,588 @@
+#!/usr/bin/env python
+'''
+Module provides a generator of the refs advertisement (the response to
+/info/refs requests) that does not run git.
+
+"git upload-pack --advertise-refs" (and receive-pack's) output is a list of
+the repo's refs in pkt-line format, the first line carrying the server's
+capabilities. For ordinary repos, making it takes reading HEAD, packed-refs
+and the loose refs, plus peeling the annotated tags (packed-refs knows the
+peeled values; objects loose refs point at are looked up in the object
+store). RefAdvertiser does just that, byte for byte the way git does it, at
+a fraction of the cost of starting a git process. Only gits whose output it
+was checked against (see RefAdvertiser.git_versions) are stood in for, as
+other versions may say things differently.
+
+Repos (and configurations) RefAdvertiser does not know how to handle make it
+return None, so that the caller falls back on git. These include repos with
+extensions (reftable, sha256), alternates, shallow repos, hidden refs,
+symbolic refs other than HEAD, push certificates, session ids, config
+includes, GIT_NAMESPACE and deltified tag objects.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import mmap
+import zlib
+import struct
+import binascii
+import processlauncher
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+ZERO_SHA = b'0' * 40
+UPLOAD_PACK_CAPABILITIES = (
+    b'multi_ack thin-pack side-band side-band-64k ofs-delta shallow deepen-since '
+    b'deepen-not deepen-relative no-progress include-tag multi_ack_detailed')
+RECEIVE_PACK_CAPABILITIES = b'report-status report-status-v2 delete-refs side-band-64k quiet'
+
+# pack entry types
+OBJ_COMMIT, OBJ_TREE, OBJ_BLOB, OBJ_TAG, OBJ_OFS_DELTA, OBJ_REF_DELTA = 1, 2, 3, 4, 6, 7
+TYPE_NAMES = {OBJ_COMMIT: b'commit', OBJ_TREE: b'tree', OBJ_BLOB: b'blob', OBJ_TAG: b'tag'}
+
+SHA_PATTERN = re.compile(b'^[0-9a-f]{40}$')
+# check_refname_format() of git, minus the corner cases that make us give up.
+BAD_REFNAME = re.compile(b'(^|/)\\.|\\.\\.|[\\x00-\\x20\\x7f~^:?*\\[\\\\]|@\\{|\\.lock(/|$)|//|/$|\\.$')
+
+class Unsupported(Exception):
+    '''
+    Raised for repos RefAdvertiser can't speak for. Git has to.
+    '''
+    pass
+
+def _b(s):
+    if isinstance(s, text_type):
+        return s.encode('utf8')
+    return s
+
+def _output(launcher, cmd):
+    # runs cmd, returns a tuple (exit code, its output.)
+    null = open(os.devnull, 'r+b')
+    try:
+        process = launcher.spawn(cmd, stdin = null, stderr = null)
+        try:
+            output = process.stdout.read()
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+    finally:
+        null.close()
+    return returncode, output
+
+def pkt_line(data):
+    return ('%04x' % (len(data) + 4)).encode('ascii') + data
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def config_bool(value):
+    '''
+    Returns the boolean meaning of git config value (None = key without "=").
+    '''
+    if value is None:
+        return True
+    value = value.strip().lower()
+    if value in (b'true', b'yes', b'on'):
+        return True
+    if value in (b'false', b'no', b'off', b''):
+        return False
+    try:
+        return int(value) != 0
+    except ValueError:
+        raise Unsupported('Bad boolean config value')
+
+def parse_config(data):
+    '''
+    Parses contents of a git config file into a list of (key, value) tuples.
+    key is "section.name" or "section.subsection.name" (section and name
+    lowercased), value is None for keys given without "=".
+    '''
+    entries = []
+    section = None
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line[:1] in (b'#', b';'):
+            continue
+        if line.startswith(b'['):
+            match = re.match(b'^\\[\\s*([-.a-zA-Z0-9]+)\\s*(?:"((?:[^"\\\\]|\\\\.)*)")?\\s*\\]\\s*([#;].*)?$', line)
+            if not match:
+                raise Unsupported('Config syntax is beyond us')
+            name, subsection = match.group(1), match.group(2)
+            if subsection is not None:
+                section = name.lower() + b'.' + re.sub(b'\\\\(.)', b'\\1', subsection)
+            elif b'.' in name:
+                # deprecated [section.subsection] syntax
+                name, subsection = name.split(b'.', 1)
+                section = name.lower() + b'.' + subsection.lower()
+            else:
+                section = name.lower()
+            continue
+        match = re.match(b'^([a-zA-Z][-a-zA-Z0-9]*)\\s*(=\\s*(.*))?$', line)
+        if not match or section is None:
+            raise Unsupported('Config syntax is beyond us')
+        key = section + b'.' + match.group(1).lower()
+        if match.group(2) is None:
+            entries.append((key, None))
+            continue
+        value = []
+        quoted = False
+        chars = iter(match.group(3).decode('latin-1'))
+        for c in chars:
+            if c == '"':
+                quoted = not quoted
+            elif c == '\\':
+                c = next(chars, None)
+                if c is None:
+                    # line continuation
+                    raise Unsupported('Config syntax is beyond us')
+                value.append({'n': '\n', 't': '\t', 'b': '\b'}.get(c, c))
+            elif c in '#;' and not quoted:
+                break
+            else:
+                value.append(c)
+        entries.append((key, ''.join(value).strip().encode('latin-1')))
+    return entries
+
+class ObjectStore(object):
+    '''
+    Just enough of a reader of git's object store (loose objects and packs
+    with version 2 indexes) to tell the type of objects and which objects
+    annotated tags point at.
+    '''
+    def __init__(self, objects_path):
+        self.path = objects_path
+        self.packs = None
+        self.files = []
+
+    def _load_packs(self):
+        self.packs = []
+        pack_dir = os.path.join(self.path, b'pack')
+        try:
+            names = sorted(os.listdir(pack_dir))
+        except (IOError, OSError):
+            names = []
+        for name in names:
+            if not (name.startswith(b'pack-') and name.endswith(b'.idx')):
+                continue
+            pack_path = os.path.join(pack_dir, name[:-4] + b'.pack')
+            if not os.path.isfile(pack_path):
+                continue
+            try:
+                f = open(os.path.join(pack_dir, name), 'rb')
+            except (IOError, OSError):
+                continue
+            self.files.append(f)
+            try:
+                idx = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                raise Unsupported('Unreadable pack index')
+            if idx[:8] != b'\xfftOc\x00\x00\x00\x02':
+                raise Unsupported('Pack index is not version 2')
+            fanout = struct.unpack('>256I', idx[8:8 + 1024])
+            self.packs.append([idx, fanout, pack_path, None])
+
+    def _find_in_pack(self, pack, sha):
+        # returns offset of the object in the pack or None
+        idx, fanout = pack[0], pack[1]
+        first = ord(sha[0:1])
+        lo = fanout[first - 1] if first else 0
+        hi = fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = 1032 + mid * 20
+            probe = idx[start:start + 20]
+            if probe < sha:
+                lo = mid + 1
+            elif probe > sha:
+                hi = mid
+            else:
+                count = fanout[255]
+                start = 1032 + count * 24 + mid * 4
+                offset = struct.unpack('>I', idx[start:start + 4])[0]
+                if offset & 0x80000000:
+                    start = 1032 + count * 28 + (offset & 0x7fffffff) * 8
+                    offset = struct.unpack('>Q', idx[start:start + 8])[0]
+                return offset
+        return None
+
+    def _find(self, sha_hex):
+        # returns ('loose', path) or (pack, offset) or None
+        path = os.path.join(self.path, sha_hex[:2], sha_hex[2:])
+        if os.path.isfile(path):
+            return 'loose', path
+        if self.packs is None:
+            self._load_packs()
+        sha = binascii.unhexlify(sha_hex)
+        for pack in self.packs:
+            offset = self._find_in_pack(pack, sha)
+            if offset is not None:
+                return pack, offset
+        return None
+
+    def _pack_entry(self, pack, offset):
+        # returns (type, size, offset of data) of the entry, deltas resolved
+        # to the type of their base.
+        if pack[3] is None:
+            f = open(pack[2], 'rb')
+            self.files.append(f)
+            pack[3] = f
+        f = pack[3]
+        for depth in range(100):
+            f.seek(offset)
+            header = f.read(64)
+            if not header:
+                raise Unsupported('Truncated pack')
+            c = ord(header[0:1])
+            entry_type, size, shift, i = (c >> 4) & 7, c & 15, 4, 1
+            while c & 0x80:
+                c = ord(header[i:i + 1])
+                size |= (c & 0x7f) << shift
+                shift += 7
+                i += 1
+            if entry_type in TYPE_NAMES:
+                return entry_type, size, offset + i, depth
+            if entry_type == OBJ_OFS_DELTA:
+                c = ord(header[i:i + 1])
+                base = c & 0x7f
+                while c & 0x80:
+                    i += 1
+                    c = ord(header[i:i + 1])
+                    base = ((base + 1) << 7) | (c & 0x7f)
+                offset -= base
+            elif entry_type == OBJ_REF_DELTA:
+                offset = self._find_in_pack(pack, header[i:i + 20])
+                if offset is None:
+                    raise Unsupported('Delta base is in other pack')
+            else:
+                raise Unsupported('Unknown pack entry type')
+        raise Unsupported('Delta chain too long')
+
+    def _loose_header(self, path, limit = None):
+        data = _read(path)
+        if data is None:
+            raise Unsupported('Unreadable loose object')
+        try:
+            content = zlib.decompressobj().decompress(data, limit or 0)
+        except zlib.error:
+            raise Unsupported('Corrupt loose object')
+        header, _, body = content.partition(b'\x00')
+        return header.split(b' ')[0], body
+
+    def object_type(self, sha_hex):
+        '''
+        Returns type of the object (b'commit', b'tree', b'blob', b'tag') or
+        None if there is no such object.
+        '''
+        where = self._find(sha_hex)
+        if where is None:
+            return None
+        if where[0] == 'loose':
+            return self._loose_header(where[1], 64)[0]
+        return TYPE_NAMES[self._pack_entry(*where)[0]]
+
+    def tag_target(self, sha_hex):
+        '''
+        Returns the sha of the object the annotated tag points at.
+        '''
+        where = self._find(sha_hex)
+        if where is None:
+            raise Unsupported('Missing tag object')
+        if where[0] == 'loose':
+            body = self._loose_header(where[1], 4096)[1]
+        else:
+            entry_type, size, data_offset, depth = self._pack_entry(*where)
+            if depth:
+                raise Unsupported('Deltified tag')
+            f = where[0][3]
+            f.seek(data_offset)
+            try:
+                body = zlib.decompressobj().decompress(f.read(4096), 4096)
+            except zlib.error:
+                raise Unsupported('Corrupt pack entry')
+        line = body.split(b'\n', 1)[0]
+        if not line.startswith(b'object ') or not SHA_PATTERN.match(line[7:]):
+            raise Unsupported('Malformed tag')
+        return line[7:]
+
+    def peel(self, sha_hex):
+        '''
+        Returns the sha of the object the annotated tag (chain) points at,
+        or None if the object is not a tag.
+        '''
+        if self.object_type(sha_hex) != b'tag':
+            return None
+        for i in range(20):
+            sha_hex = self.tag_target(sha_hex)
+            if self.object_type(sha_hex) != b'tag':
+                return sha_hex
+        raise Unsupported('Tag chain too long')
+
+    def close(self):
+        for pack in self.packs or []:
+            pack[0].close()
+        for f in self.files:
+            f.close()
+        self.files = []
+
+class RefAdvertiser(object):
+    '''
+    Produces refs advertisements of upload-pack and receive-pack. See the
+    module's docstring.
+
+    Counters:
+        advertised - advertisements made.
+        fallbacks - repos we left to git.
+    '''
+    # (major, minor) versions of git the output was checked against (with
+    # test_advertisement.py). Other gits are left to do it themselves.
+    git_versions = frozenset([(2, 39)])
+
+    def __init__(self, git_path = 'git', launcher = None):
+        '''
+        @param git_path (Default: 'git') git to ask (once) for its version
+            and for global and system configuration. (Changes to these made
+            later go unnoticed.)
+        @param launcher (Default: None = process-wide launcher)
+            processlauncher.ProcessLauncher instance starting git, the one
+            running git for the requests (its environment is git's.)
+        '''
+        self.advertised = 0
+        self.fallbacks = 0
+        self.enabled = False
+        self.global_config = []
+        launcher = launcher or processlauncher.get_launcher()
+        try:
+            version = _output(launcher, [git_path, 'version'])[1].strip()
+        except EnvironmentError:
+            return
+        match = re.match(b'^git version (\\d+)\\.(\\d+)', version)
+        if not match or tuple(int(i) for i in match.groups()) not in self.git_versions:
+            return
+        # git trims it and replaces unprintable characters and spaces so.
+        self.agent = re.sub(
+            b'[^\x21-\x7e]', b'.',
+            (_b(launcher.env.get('GIT_USER_AGENT')) or b'git/' + version[len(b'git version '):]).strip())
+        for scope in ('--system', '--global'):
+            returncode, output = _output(launcher, [git_path, 'config', scope, '--list', '-z'])
+            if returncode:
+                # no such file
+                continue
+            for entry in output.split(b'\x00'):
+                if entry:
+                    key, newline, value = entry.partition(b'\n')
+                    self.global_config.append((key, value if newline else None))
+        self.enabled = True
+
+    def settings(self, config):
+        '''
+        Returns a dict of advertisement-related settings the config (list of
+        (key, value) tuples, in order of precedence, lowest first) makes.
+        '''
+        settings = {
+            'allow_tip': False,
+            'allow_reachable': False,
+            'allow_filter': False,
+            'atomic': True,
+            'push_options': False,
+            'ofs_delta': True
+        }
+        for key, value in config:
+            if key.startswith((b'extensions.', b'include.', b'includeif.')) or key in (
+                    b'uploadpack.hiderefs', b'receive.hiderefs', b'transfer.hiderefs',
+                    b'transfer.advertisesid', b'receive.certnonceseed'):
+                raise Unsupported('Config %s is beyond us' % key)
+            if key == b'core.repositoryformatversion' and value not in (b'0', b'1'):
+                raise Unsupported('Unknown repository format')
+            if key == b'uploadpack.allowtipsha1inwant':
+                settings['allow_tip'] = config_bool(value)
+            elif key == b'uploadpack.allowreachablesha1inwant':
+                settings['allow_reachable'] = config_bool(value)
+            elif key == b'uploadpack.allowanysha1inwant':
+                settings['allow_tip'] = settings['allow_reachable'] = config_bool(value)
+            elif key == b'uploadpack.allowfilter':
+                settings['allow_filter'] = config_bool(value)
+            elif key == b'receive.advertiseatomic':
+                settings['atomic'] = config_bool(value)
+            elif key == b'receive.advertisepushoptions':
+                settings['push_options'] = config_bool(value)
+            elif key == b'repack.usedeltabaseoffset':
+                settings['ofs_delta'] = config_bool(value)
+        return settings
+
+    def read_refs(self, repo_path, store):
+        '''
+        Returns a sorted list of (name, sha, peeled) of repo's refs, peeled
+        being the sha of the object a tag points at or None if the ref is
+        not a tag.
+        '''
+        refs = {}
+        data = _read(os.path.join(repo_path, b'packed-refs'))
+        if data:
+            lines = data.splitlines()
+            traits = []
+            if lines[0].startswith(b'# pack-refs with:'):
+                traits = lines.pop(0)[len(b'# pack-refs with:'):].split()
+            name = None
+            for line in lines:
+                if line.startswith(b'^'):
+                    if name is None or not SHA_PATTERN.match(line[1:]):
+                        raise Unsupported('Malformed packed-refs')
+                    refs[name][1] = line[1:]
+                    continue
+                sha, _, name = line.partition(b' ')
+                if not SHA_PATTERN.match(sha) or not name.startswith(b'refs/') or BAD_REFNAME.search(name):
+                    raise Unsupported('Malformed packed-refs')
+                if b'fully-peeled' in traits or (b'peeled' in traits and name.startswith(b'refs/tags/')):
+                    refs[name] = [sha, None]
+                else:
+                    refs[name] = [sha, False]
+
+        refs_root = os.path.join(repo_path, b'refs')
+        for root, dirs, files in os.walk(refs_root):
+            for file_name in files:
+                if file_name.endswith(b'.lock'):
+                    # update in progress. The ref itself still has the old value.
+                    continue
+                path = os.path.join(root, file_name)
+                name = b'refs' + path[len(refs_root):].replace(os.sep.encode('ascii'), b'/')
+                if BAD_REFNAME.search(name):
+                    raise Unsupported('Unusual ref name')
+                data = _read(path)
+                if data is None:
+                    # deleted while we were looking
+                    continue
+                sha = data.strip()
+                if not SHA_PATTERN.match(sha):
+                    # symbolic ref or junk
+                    raise Unsupported('Unusual ref')
+                refs[name] = [sha, False]
+
+        result = []
+        for name in sorted(refs):
+            sha, peeled = refs[name]
+            if peeled is False:
+                # (refs pointing at missing objects are advertised, unpeeled.)
+                peeled = store.peel(sha)
+            result.append((name, sha, peeled))
+        return result
+
+    def read_head(self, repo_path, refs, store):
+        '''
+        Returns a tuple (sha, peeled, symref target) for HEAD or None if HEAD
+        is unborn.
+        '''
+        data = _read(os.path.join(repo_path, b'HEAD'))
+        if data is None:
+            raise Unsupported('No HEAD')
+        data = data.strip()
+        if data.startswith(b'ref: '):
+            target = data[5:].strip()
+            if not target.startswith(b'refs/'):
+                raise Unsupported('Unusual HEAD')
+            for name, sha, peeled in refs:
+                if name == target:
+                    return sha, peeled, target
+            return None
+        if not SHA_PATTERN.match(data):
+            raise Unsupported('Unusual HEAD')
+        return data, store.peel(data), None
+
+    def advertise(self, repo_path, service):
+        '''
+        Returns what "git <service> --stateless-rpc --advertise-refs <repo_path>"
+        would print, or None if the repo is to be left to git.
+
+        @param service 'upload-pack' or 'receive-pack'.
+        '''
+        if not self.enabled or service not in ('upload-pack', 'receive-pack'):
+            return None
+        try:
+            result = self._advertise(_b(repo_path), service)
+        except (Unsupported, EnvironmentError, ValueError, struct.error, IndexError, TypeError):
+            result = None
+        if result is None:
+            self.fallbacks += 1
+        else:
+            self.advertised += 1
+        return result
+
+    def _advertise(self, repo_path, service):
+        if os.environ.get('GIT_NAMESPACE') or os.environ.get('GIT_CONFIG_PARAMETERS') \
+                or os.environ.get('GIT_CONFIG_COUNT'):
+            return None
+        for name in (b'commondir', b'shallow', b'reftable', b'objects/info/alternates'):
+            if os.path.exists(os.path.join(repo_path, name)):
+                return None
+        config = _read(os.path.join(repo_path, b'config'))
+        if config is None:
+            return None
+        settings = self.settings(self.global_config + parse_config(config))
+
+        store = ObjectStore(os.path.join(repo_path, b'objects'))
+        try:
+            refs = self.read_refs(repo_path, store)
+            head = self.read_head(repo_path, refs, store) if service == 'upload-pack' else None
+        finally:
+            store.close()
+
+        lines = []
+        if service == 'upload-pack':
+            capabilities = [UPLOAD_PACK_CAPABILITIES]
+            if settings['allow_tip']:
+                capabilities.append(b'allow-tip-sha1-in-want')
+            if settings['allow_reachable']:
+                capabilities.append(b'allow-reachable-sha1-in-want')
+            capabilities.append(b'no-done')
+            if head and head[2]:
+                capabilities.append(b'symref=HEAD:' + head[2])
+            if settings['allow_filter']:
+                capabilities.append(b'filter')
+            if head:
+                refs = [(b'HEAD', head[0], head[1])] + refs
+        else:
+            capabilities = [RECEIVE_PACK_CAPABILITIES]
+            if settings['atomic']:
+                capabilities.append(b'atomic')
+            if settings['ofs_delta']:
+                capabilities.append(b'ofs-delta')
+            if settings['push_options']:
+                capabilities.append(b'push-options')
+            if not refs:
+                refs = [(b'capabilities^{}', ZERO_SHA, None)]
+            # receive-pack does not show peeled tags.
+            refs = [(name, sha, None) for name, sha, peeled in refs]
+        capabilities.append(b'object-format=sha1 agent=' + self.agent)
+
+        for name, sha, peeled in refs:
+            if not lines:
+                lines.append(pkt_line(sha + b' ' + name + b'\x00' + b' '.join(capabilities) + b'\n'))
+            else:
+                lines.append(pkt_line(sha + b' ' + name + b'\n'))
+            if peeled:
+                lines.append(pkt_line(peeled + b' ' + name + b'^{}\n'))
+        lines.append(b'0000')
+        return b''.join(lines)
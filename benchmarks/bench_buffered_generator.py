@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+'''
+Benchmark for subprocessio.BufferedGenerator / SubprocessIOChunker.
+
+Measures:
+    latency     Delay between a chunk being written into a pipe and the
+                consumer getting it out of BufferedGenerator (producer
+                writes a chunk every millisecond).
+    throughput  MB/s of `head -c N /dev/zero` read through SubprocessIOChunker.
+    pooled      Same as throughput, in BufferPool mode. Reports how many
+                buffers the pool allocated over several runs.
+    slow        Whether a fast producer is drained through a small buffer by a
+                consumer that stops reading for a while.
+
+Usage:
+    python benchmarks/bench_buffered_generator.py [latency|throughput|pooled|slow ...]
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import subprocessio
+
+MESSAGE_SIZE = 64
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def pipe_producer(count, interval):
+    '''
+    Returns read end of a pipe into which a thread writes count timestamped
+    messages of MESSAGE_SIZE bytes, interval seconds apart.
+    '''
+    r, w = os.pipe()
+    def run():
+        for i in range(count):
+            os.write(w, ('%.9f' % time.time()).ljust(MESSAGE_SIZE).encode('ascii'))
+            if interval:
+                time.sleep(interval)
+        os.close(w)
+    t = threading.Thread(target = run)
+    t.daemon = True
+    t.start()
+    return os.fdopen(r, 'rb', 0)
+
+def bench_latency(count = 2000):
+    source = pipe_producer(count, 0.001)
+    delays = []
+    for chunk in subprocessio.BufferedGenerator(source, 65536, MESSAGE_SIZE):
+        delays.append(time.time() - float(chunk))
+    print('latency: %d chunks, p50 %.3f ms, p99 %.3f ms, max %.3f ms' % (
+        len(delays),
+        percentile(delays, 50) * 1000,
+        percentile(delays, 99) * 1000,
+        max(delays) * 1000
+        ))
+
+def bench_throughput(size = 256 * 1024 * 1024, pool = None, label = 'throughput'):
+    start = time.time()
+    received = 0
+    for chunk in subprocessio.SubprocessIOChunker('head -c %d /dev/zero' % size, pool = pool):
+        received += len(chunk)
+    elapsed = time.time() - start
+    assert received == size
+    print('%s: %d MB in %.2f s, %.1f MB/s' % (
+        label, size >> 20, elapsed, size / elapsed / 1048576))
+
+def bench_pooled(runs = 3):
+    pool = subprocessio.BufferPool()
+    for i in range(runs):
+        bench_throughput(pool = pool, label = 'pooled')
+    print('pooled: %d runs, %d buffers allocated, %d reused' % (runs, pool.allocated, pool.reused))
+
+def bench_slow_consumer(count = 500, stall = 9):
+    '''
+    Consumer (think slow HTTP client) stops reading for stall seconds after
+    the first chunk, then drains the rest.
+    '''
+    source = pipe_producer(count, 0)
+    result = {'received': 0}
+    def consume():
+        for chunk in subprocessio.BufferedGenerator(source, 4 * MESSAGE_SIZE, MESSAGE_SIZE):
+            if not result['received']:
+                time.sleep(stall)
+            result['received'] += 1
+    start = time.time()
+    t = threading.Thread(target = consume)
+    t.daemon = True
+    t.start()
+    t.join(stall + 10)
+    print('slow: %d of %d chunks in %.2f s after %d s stall%s' % (
+        result['received'], count, time.time() - start, stall,
+        ', gave up waiting' if t.is_alive() else ''))
+
+if __name__ == "__main__":
+    benches = {
+        'latency': bench_latency,
+        'throughput': bench_throughput,
+        'pooled': bench_pooled,
+        'slow': bench_slow_consumer
+    }
+    for name in sys.argv[1:] or ['latency', 'throughput', 'pooled', 'slow']:
+        benches[name]()
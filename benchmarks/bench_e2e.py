@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+'''
+End-to-end benchmark: git clients (the real git binary) talking to
+git_http_backend over HTTP on localhost.
+
+A synthetic repo of the chosen size (commits, files changed per commit,
+blob size, refs) is made with git fast-import and served by the app
+assemble_WSGI_git_app returns, running:
+    inprocess   in this process, in simpleserver.py's threaded server
+                (app options can be given, see --option)
+    subprocess  in a process of its own ("git_http_backend.py --server
+                simple", the way it runs from the command line)
+N clients (threads, each running one git command at a time) then do each
+of the operations a number of times:
+    info-refs   git ls-remote
+    clone       git clone --bare
+    fetch       git fetch into a clone lagging --fetch-commits behind
+    push        git push of a new commit (one blob) to a new branch
+Pushes change the repo, so they go last.
+
+Reported per operation: throughput (operations per second, all clients
+together), p50/p95/p99 latency of the git commands, errors, and peak RSS
+and thread count of the server process while the operation was running
+(sampled from /proc, so Linux only. In-process, the clients' threads are
+counted too.)
+
+--json FILE saves the results (with the parameters and the versions of
+the tree, Python and git) and --compare FILE prints the differences to
+results saved earlier, so that a change (or a version) can be compared
+with another on the same box.
+
+Usage:
+    python benchmarks/bench_e2e.py [--clients N] [--iterations N]
+        [--commits N] [--files N] [--blob-size BYTES] [--refs N]
+        [--fetch-commits N] [--operations info-refs,clone,fetch,push]
+        [--server inprocess|subprocess] [--option name=expression ...]
+        [--json FILE] [--compare FILE]
+
+    --option names an assemble_WSGI_git_app argument (inprocess only),
+    the expression is evaluated with this project's modules imported, say
+    --option "advertisement_cache=responsecache.AdvertisementCache()"
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import git_http_backend
+import simpleserver
+import responsecache
+import filecache
+import repoindex
+import admission
+import maintenance
+import advertisement
+import subprocessio
+import processlauncher
+import metrics
+
+OPERATIONS = ['info-refs', 'clone', 'fetch', 'push']
+
+GIT_ENV = dict(os.environ,
+    GIT_TERMINAL_PROMPT = '0',
+    GIT_AUTHOR_NAME = 'Bench', GIT_AUTHOR_EMAIL = 'bench@example.com',
+    GIT_COMMITTER_NAME = 'Bench', GIT_COMMITTER_EMAIL = 'bench@example.com')
+
+def git(args, cwd = None, stdin = None):
+    process = subprocess.Popen(
+        ['git'] + args, cwd = cwd, env = GIT_ENV,
+        stdin = subprocess.PIPE if stdin is not None else None,
+        stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+    out, err = process.communicate(stdin)
+    if process.returncode:
+        raise EnvironmentError('git %s failed: %s' % (' '.join(args), err.decode('utf8', 'replace')))
+    return out
+
+def fast_import_stream(commits, files, blob_size, refs, first_commit = 0, parent = None):
+    '''
+    Returns fast-import commands making commits (each changing files
+    files, blobs of blob_size random bytes) on master and refs refs
+    (half branches, half tags) pointing at commits spread over the history.
+    '''
+    out = []
+    mark = 0
+    marks = []
+    for i in range(first_commit, first_commit + commits):
+        mark += 1
+        timestamp = 1300000000 + i * 60
+        message = ('commit %d\n' % i).encode('ascii')
+        out.append(('commit refs/heads/master\nmark :%d\ncommitter Bench <bench@example.com> %d +0000\ndata %d\n'
+            % (mark, timestamp, len(message))).encode('ascii') + message)
+        if parent and i == first_commit:
+            out.append(('from %s\n' % parent).encode('ascii'))
+        for j in range(files):
+            blob = os.urandom(blob_size)
+            out.append(('M 100644 inline dir%d/file%d\ndata %d\n' % (j % 16, (i * files + j) % 1000, len(blob))).encode('ascii') + blob + b'\n')
+        out.append(b'\n')
+        marks.append(mark)
+    for j in range(refs):
+        name = 'refs/heads/branch-%d' % j if j % 2 else 'refs/tags/v%d' % j
+        out.append(('reset %s\nfrom :%d\n\n' % (name, marks[j * len(marks) // max(refs, 1)])).encode('ascii'))
+    return b''.join(out)
+
+def make_repo(path, args):
+    git(['init', '--quiet', '--bare', path])
+    git(['fast-import', '--quiet'], cwd = path,
+        stdin = fast_import_stream(args['commits'], args['files'], args['blob_size'], args['refs']))
+    git(['repack', '-a', '-d', '-q'], cwd = path)
+
+def add_commits(path, commits, args):
+    head = git(['rev-parse', 'refs/heads/master'], cwd = path).strip().decode('ascii')
+    git(['fast-import', '--quiet', '--force'], cwd = path,
+        stdin = fast_import_stream(commits, args['files'], args['blob_size'], 0, args['commits'], head))
+
+class Sampler(threading.Thread):
+    '''
+    Samples RSS and thread count of a process from /proc, keeping the peaks.
+    '''
+    def __init__(self, pid, interval = 0.01):
+        super(Sampler, self).__init__()
+        self.daemon = True
+        self.path = '/proc/%d/status' % pid
+        self.interval = interval
+        self.running = threading.Event()
+        self.stopped = False
+        self.reset()
+
+    def reset(self):
+        self.peak_rss = None
+        self.peak_threads = None
+
+    def sample(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss = int(line.split()[1]) * 1024
+                        self.peak_rss = max(self.peak_rss or 0, rss)
+                    elif line.startswith('Threads:'):
+                        threads = int(line.split()[1])
+                        self.peak_threads = max(self.peak_threads or 0, threads)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def run(self):
+        while not self.stopped:
+            self.running.wait()
+            self.sample()
+            time.sleep(self.interval)
+
+class QuietRequestHandler(simpleserver.RequestHandler):
+    def log_message(self, *args):
+        pass
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_server(kind, content_path, options):
+    '''
+    Returns a tuple (base URL, pid of the server process, stop callable).
+    '''
+    if kind == 'inprocess':
+        app = git_http_backend.assemble_WSGI_git_app(content_path = content_path, **options)
+        server = simpleserver.ThreadingWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+        server.set_app(app)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        def stop():
+            server.shutdown()
+            server.server_close()
+        return 'http://127.0.0.1:%d' % server.server_port, os.getpid(), stop
+    port = free_port()
+    devnull = open(os.devnull, 'wb')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'git_http_backend.py'),
+            '--server', 'simple', '--content_path', content_path, '--port', str(port)],
+        stdout = devnull, stderr = devnull)
+    deadline = time.time() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            break
+        except socket.error:
+            if time.time() > deadline or process.poll() is not None:
+                process.kill()
+                raise EnvironmentError('server did not start')
+            time.sleep(0.05)
+    def stop():
+        process.terminate()
+        process.wait()
+        devnull.close()
+    return 'http://127.0.0.1:%d' % port, process.pid, stop
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def run_operation(name, url, work_path, args, sampler):
+    '''
+    Runs the operation clients x iterations times. Returns its results (a dict).
+    '''
+    repo_url = url + '/repo.git'
+    template = os.path.join(work_path, 'lagging.git')
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(number):
+        for i in range(args['iterations']):
+            target = os.path.join(work_path, '%s-%d-%d' % (name, number, i))
+            # (preparations are not timed.)
+            if name == 'info-refs':
+                command, cwd = ['ls-remote', repo_url], None
+            elif name == 'clone':
+                command, cwd = ['clone', '--quiet', '--bare', repo_url, target], None
+            elif name == 'fetch':
+                shutil.copytree(template, target)
+                command, cwd = ['fetch', '--quiet', repo_url, '+refs/heads/*:refs/heads/*'], target
+            else:
+                shutil.copytree(template, target)
+                blob = os.urandom(args['blob_size'])
+                tree = git(['mktree'], cwd = target, stdin = ('100644 blob %s\tpushed\n'
+                    % git(['hash-object', '-w', '--stdin'], cwd = target, stdin = blob).strip().decode('ascii')).encode('ascii'))
+                commit = git(['commit-tree', tree.strip().decode('ascii'), '-p', 'refs/heads/master', '-m', 'pushed'],
+                    cwd = target).strip().decode('ascii')
+                command, cwd = ['push', '--quiet', repo_url, '%s:refs/heads/pushed-%d-%d' % (commit, number, i)], target
+            start = time.time()
+            try:
+                git(command, cwd = cwd)
+            except EnvironmentError as e:
+                with lock:
+                    errors.append(str(e))
+            else:
+                with lock:
+                    latencies.append(time.time() - start)
+            shutil.rmtree(target, True)
+
+    sampler.reset()
+    sampler.running.set()
+    threads = [threading.Thread(target = client, args = (i,)) for i in range(args['clients'])]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+    sampler.sample()
+    sampler.running.clear()
+    return {
+        'operations': len(latencies),
+        'errors': len(errors),
+        'first_error': errors[0] if errors else None,
+        'seconds': wall,
+        'throughput': len(latencies) / wall if wall else None,
+        'p50_ms': percentile(latencies, 50) and percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) and percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) and percentile(latencies, 99) * 1000,
+        'peak_rss_mb': sampler.peak_rss and sampler.peak_rss / 1048576.0,
+        'peak_threads': sampler.peak_threads
+    }
+
+def versions():
+    def output(command):
+        try:
+            return subprocess.check_output(command, cwd = ROOT, stderr = subprocess.STDOUT).strip().decode('utf8')
+        except (EnvironmentError, subprocess.CalledProcessError):
+            return None
+    return {
+        'tree': output(['git', 'describe', '--always', '--dirty']),
+        'git': output(['git', '--version']),
+        'python': platform.python_version(),
+        'platform': platform.platform()
+    }
+
+def format_value(value, template):
+    return template % value if value is not None else '-'
+
+def report(results, previous = None):
+    print('%-10s %8s %9s %9s %9s %9s %8s %8s' % (
+        'operation', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'RSS MB', 'threads'))
+    for name in OPERATIONS:
+        result = results.get(name)
+        if not result:
+            continue
+        print('%-10s %8s %9s %9s %9s %9d %8s %8s' % (
+            name,
+            format_value(result['throughput'], '%.2f'),
+            format_value(result['p50_ms'], '%.1f'),
+            format_value(result['p95_ms'], '%.1f'),
+            format_value(result['p99_ms'], '%.1f'),
+            result['errors'],
+            format_value(result['peak_rss_mb'], '%.1f'),
+            format_value(result['peak_threads'], '%d')))
+        if result['first_error']:
+            print('    first error: %s' % result['first_error'].strip().split('\n')[-1])
+        old = (previous or {}).get(name)
+        if old:
+            changes = []
+            for key in ('throughput', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb', 'peak_threads'):
+                if result.get(key) and old.get(key):
+                    changes.append('%s %+.1f%%' % (key, (result[key] - old[key]) * 100.0 / old[key]))
+            print('    vs. saved: ' + ', '.join(changes))
+
+def parse_args(argv):
+    args = {
+        'clients': 4,
+        'iterations': 5,
+        'commits': 200,
+        'files': 4,
+        'blob_size': 16384,
+        'refs': 100,
+        'fetch_commits': 10,
+        'operations': ','.join(OPERATIONS),
+        'server': 'inprocess',
+        'json': None,
+        'compare': None
+    }
+    options = {}
+    argv = list(argv)
+    while argv:
+        name = argv.pop(0)
+        if not name.startswith('--') or not argv:
+            raise SystemExit(__doc__)
+        value = argv.pop(0)
+        key = name[2:].replace('-', '_')
+        if key == 'option':
+            option, expression = value.split('=', 1)
+            options[option] = eval(expression, dict(globals()))
+        elif key not in args:
+            raise SystemExit(__doc__)
+        elif isinstance(args[key], int):
+            args[key] = int(value)
+        else:
+            args[key] = value
+    args['operations'] = [name for name in args['operations'].split(',') if name]
+    for name in args['operations']:
+        if name not in OPERATIONS:
+            raise SystemExit('unknown operation: %s' % name)
+    if options and args['server'] != 'inprocess':
+        raise SystemExit('--option works with --server inprocess only')
+    return args, options
+
+def main(argv):
+    args, options = parse_args(argv)
+    base_path = tempfile.mkdtemp()
+    try:
+        content_path = os.path.join(base_path, 'served')
+        work_path = os.path.join(base_path, 'work')
+        os.makedirs(content_path)
+        os.makedirs(work_path)
+        repo_path = os.path.join(content_path, 'repo.git')
+        print('making repo: %(commits)d commits x %(files)d files x %(blob_size)d bytes, %(refs)d refs' % args)
+        start = time.time()
+        make_repo(repo_path, args)
+        # fetches start from a clone this many commits behind.
+        git(['clone', '--quiet', '--bare', '--no-local', repo_path, os.path.join(work_path, 'lagging.git')])
+        if args['fetch_commits']:
+            add_commits(repo_path, args['fetch_commits'], args)
+        print('  done in %.1f s' % (time.time() - start))
+
+        url, pid, stop = start_server(args['server'], content_path, options)
+        sampler = Sampler(pid)
+        sampler.start()
+        results = {}
+        try:
+            print('%s server, %d clients x %d iterations' % (args['server'], args['clients'], args['iterations']))
+            for name in OPERATIONS:
+                if name in args['operations']:
+                    results[name] = run_operation(name, url, work_path, args, sampler)
+        finally:
+            sampler.stopped = True
+            sampler.running.set()
+            stop()
+
+        previous = None
+        if args['compare']:
+            with open(args['compare']) as f:
+                previous = json.load(f)['results']
+        report(results, previous)
+        if args['json']:
+            saved = dict((key, value) for key, value in args.items() if key not in ('json', 'compare'))
+            saved['options'] = sorted(options)
+            with open(args['json'], 'w') as f:
+                json.dump({
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                    'versions': versions(),
+                    'parameters': saved,
+                    'results': results
+                }, f, indent = 2, sort_keys = True)
+            print('saved to %s' % args['json'])
+    finally:
+        shutil.rmtree(base_path, True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+'''
+Benchmark for git_http_backend.WSGIHandlerSelector routing.
+
+Measures time per .select() call for the routes assembled by
+assemble_WSGI_git_app (with and without uri_marker), for:
+    session     Requests of a typical clone: info/refs, git-upload-pack, HEAD,
+                dumb HTTP files. Repeated paths = memoized lookups.
+    unique      Same requests for ever-new repo names (no memoization hits).
+    long        Unique 4 KB paths matching only the catch-all route.
+                (Only 20 of them for "naive".)
+
+Each is run with the default selector ("memo"), with memoization off
+("no memo") and with plain in-order regex matching of every mapping, as
+routing used to be done ("naive").
+
+Usage:
+    python benchmarks/bench_router.py [count]
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import print_function
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import git_http_backend
+
+def naive_select(selector, path, method, query_string = ''):
+    # WSGIHandlerSelector.select() before the literal prefilter and memoization.
+    path = git_http_backend.urlparse.urljoin(u'/', re.sub('//+', '/', path.strip('/')))
+    for _regex, _registered_methods, _use_query_string, _literals in selector.mappings:
+        if _use_query_string:
+            matches = _regex.search(path + '?' + query_string)
+        else:
+            matches = _regex.search(path)
+        if matches and _registered_methods.get(method):
+            return _registered_methods[method]
+
+def requests(prefix, repo):
+    return [
+        ('%s/%s/info/refs' % (prefix, repo), 'GET', 'service=git-upload-pack'),
+        ('%s/%s/git-upload-pack' % (prefix, repo), 'POST', ''),
+        ('%s/%s/HEAD' % (prefix, repo), 'GET', ''),
+        ('%s/%s/info/refs' % (prefix, repo), 'GET', ''),
+        ('%s/%s/objects/info/packs' % (prefix, repo), 'GET', '')
+    ]
+
+def workloads(prefix, count):
+    session = requests(prefix, 'group/repo.git') * (count // 5)
+    unique = []
+    for i in range(count // 5):
+        unique.extend(requests(prefix, 'group/repo%d.git' % i))
+    long_paths = [
+        ('%s/%s/%d' % (prefix, 'a/' * 2048, i), 'GET', '')
+        for i in range(count // 50)
+        ]
+    return [('session', session), ('unique', unique), ('long', long_paths)]
+
+def run(label, select, paths):
+    start = time.time()
+    for path, method, query_string in paths:
+        select(path, method, query_string)
+    elapsed = time.time() - start
+    return elapsed / len(paths) * 1000000
+
+def bench(uri_marker, count):
+    print('uri_marker = %r' % uri_marker)
+    prefix = '/decorative/%s' % uri_marker if uri_marker else ''
+    for name, paths in workloads(prefix, count):
+        memo = git_http_backend.assemble_WSGI_git_app('.', uri_marker)
+        no_memo = git_http_backend.assemble_WSGI_git_app('.', uri_marker)
+        no_memo.route_cache_size = 0
+        results = [
+            run('memo', memo.select, paths),
+            run('no memo', no_memo.select, paths),
+            # backtracking makes naive matching of long paths too slow to run them all.
+            run('naive', lambda *args: naive_select(no_memo, *args), paths[:20] if name == 'long' else paths)
+            ]
+        print('  %-8s memo %8.2f us, no memo %8.2f us, naive %8.2f us per request' % (
+            (name,) + tuple(results)))
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    bench('', count)
+    bench('my', count)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+'''
+Benchmark for starting git processes: time from asking for a process to
+the first byte of its output (spawn-to-first-byte latency), with 1, 4 and 16
+threads starting processes at once.
+
+The process is "git upload-pack --stateless-rpc --advertise-refs" for a
+small repo, same as for /info/refs requests. Launchers compared:
+    shell       subprocess.Popen with a command line string and shell = True,
+                as git used to be started (no close_fds).
+    popen       processlauncher.ProcessLauncher (argv list, close_fds).
+    spawn       processlauncher.SpawnLauncher (posix_spawn).
+
+fork() copies the page tables of the parent, so its cost grows with the size
+of the server process. --ballast MB makes this process that much bigger.
+
+Usage:
+    python benchmarks/bench_spawn.py [count] [--ballast MB]
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import processlauncher
+
+class ShellLauncher(object):
+    # the way git was started before processlauncher.
+    def spawn(self, cmd, stdin = None):
+        return subprocess.Popen(
+            ' '.join('"%s"' % arg for arg in cmd),
+            bufsize = -1,
+            shell = True,
+            stdin = stdin,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE
+            )
+
+def first_byte(launcher, cmd):
+    start = time.time()
+    process = launcher.spawn(cmd)
+    os.read(process.stdout.fileno(), 1)
+    elapsed = time.time() - start
+    process.stdout.read()
+    process.stderr.read()
+    process.wait()
+    process.stdout.close()
+    process.stderr.close()
+    return elapsed
+
+def run(launcher, cmd, threads, count):
+    times = []
+    lock = threading.Lock()
+    def work():
+        for i in range(count // threads):
+            elapsed = first_byte(launcher, cmd)
+            with lock:
+                times.append(elapsed)
+    workers = [threading.Thread(target = work) for i in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall = time.time() - start
+    times.sort()
+    return (
+        times[len(times) // 2] * 1000,
+        times[int(len(times) * 0.99)] * 1000,
+        len(times) / wall
+        )
+
+def main(count, ballast):
+    base_path = tempfile.mkdtemp()
+    # touched, so that the pages are really there.
+    ballast = bytearray(b'x' * (ballast * 1048576))
+    try:
+        repo_path = os.path.join(base_path, 'repo.git')
+        subprocess.call(['git', 'init', '--quiet', '--bare', repo_path])
+        cmd = ['git', 'upload-pack', '--stateless-rpc', '--advertise-refs', repo_path]
+        launchers = [('shell', ShellLauncher()), ('popen', processlauncher.ProcessLauncher())]
+        if processlauncher.SpawnLauncher.available:
+            launchers.append(('spawn', processlauncher.SpawnLauncher()))
+        print('%d spawns per run, %d MB ballast' % (count, len(ballast) // 1048576))
+        for threads in (1, 4, 16):
+            for name, launcher in launchers:
+                print('  %2d threads %-6s p50 %6.2f ms, p99 %6.2f ms, %7.1f spawns/s' % (
+                    (threads, name) + run(launcher, cmd, threads, count)))
+    finally:
+        shutil.rmtree(base_path, True)
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    ballast = 0
+    if '--ballast' in args:
+        i = args.index('--ballast')
+        ballast = int(args[i + 1])
+        del args[i:i + 2]
+    main(int(args[0]) if args else 400, ballast)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+'''
+Stress and throughput benchmark for subprocessio: SubprocessIOChunker (and
+ReactorSubprocessIOChunker), BufferedGenerator and StreamFeeder.
+
+Scenarios:
+    throughput  --size MB of `head -c` output read through a chunker, in
+                each mode: threaded (default), pooled (BufferPool),
+                passthrough (SubprocessIOFile) and reactor.
+    feed        --size MB fed into `wc -c` through StreamFeeder.
+    concurrent  --concurrency chunkers at once, --size MB between them.
+    slow        A consumer pausing after each 64 KB taken, so that reading
+                pauses on the full buffer (InputStreamChunker) all the time.
+                Counts the stalls.
+    stderr      A producer writing --stderr-kb KB to stderr between two bits
+                of output (drained and dropped by the bottomless error
+                reader, which reads a byte at a time, hence KB), and
+                producers failing with lots of stderr (the error must come
+                through, in at most 16000 bytes.)
+    disconnect  --concurrency rounds of --concurrency chunkers of endless
+                output (half of them fed endless input) closed after a few
+                chunks, as when clients go away mid-response.
+
+Recorded for each: MB/s, CPU seconds (ours and of the reaped subprocesses),
+peak thread count, and what is left behind once the chunkers are closed and
+garbage collected: threads, file descriptors and zombie processes.
+(Dropped processes are reaped on the next spawn, as with subprocess.Popen,
+so zombies are counted after starting one more process. The first use of
+ReactorSubprocessIOChunker starts the process-wide IOReactor, which stays:
+a thread and three file descriptors.)
+
+Usage:
+    python benchmarks/stress_subprocessio.py [scenario ...] [--size MB]
+        [--concurrency N] [--stderr-kb KB] [--json FILE]
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+from __future__ import print_function
+import gc
+import os
+import sys
+import json
+import time
+import resource
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import subprocessio
+import processlauncher
+import metrics
+
+MB = 1048576
+
+SCENARIOS = ['throughput', 'feed', 'concurrent', 'slow', 'stderr', 'disconnect']
+
+def drain(chunker):
+    size = 0
+    try:
+        while True:
+            size += len(chunker.next())
+    except StopIteration:
+        pass
+    return size
+
+def thread_count():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return threading.active_count()
+
+def fd_count():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+def zombie_count():
+    zombies = 0
+    pid = str(os.getpid())
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        if fields[0] == 'Z' and fields[1] == pid:
+            zombies += 1
+    return zombies
+
+class ThreadSampler(threading.Thread):
+    def __init__(self, interval = 0.01):
+        super(ThreadSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak = thread_count()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, thread_count())
+            self.stopped.wait(self.interval)
+
+class ZeroReader(object):
+    '''
+    File-like of size zero bytes (endless if size is None.)
+    '''
+    block = b'\0' * 65536
+
+    def __init__(self, size = None):
+        self.remaining = size
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            size = len(self.block)
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+            self.remaining -= size
+        return self.block[:size]
+
+def scenario_throughput(args):
+    size = args['size'] * MB
+    cmd = ['head', '-c', str(size), '/dev/zero']
+    results = {}
+    for mode in ('threaded', 'pooled', 'passthrough', 'reactor'):
+        start = time.time()
+        if mode == 'threaded':
+            chunker = subprocessio.SubprocessIOChunker(cmd, buffer_size = 1048576, chunk_size = 65536)
+            received = drain(chunker)
+        elif mode == 'pooled':
+            chunker = subprocessio.SubprocessIOChunker(cmd, buffer_size = 1048576, pool = subprocessio.BufferPool())
+            received = drain(chunker)
+        elif mode == 'passthrough':
+            chunker = subprocessio.SubprocessIOChunker(cmd, chunk_size = 65536, passthrough = True)
+            received = drain(chunker.output)
+            chunker.output.close()
+        else:
+            chunker = subprocessio.ReactorSubprocessIOChunker(cmd, buffer_size = 1048576, chunk_size = 65536)
+            received = drain(chunker)
+        elapsed = time.time() - start
+        chunker.close()
+        assert received == size, (mode, received)
+        results[mode + '_mb_s'] = size / MB / elapsed
+    return size * 4, results
+
+def scenario_feed(args):
+    size = args['size'] * MB
+    chunker = subprocessio.SubprocessIOChunker(['wc', '-c'], inputstream = ZeroReader(size))
+    counted = int(chunker.next().strip())
+    chunker.close()
+    assert counted == size, counted
+    return size, {}
+
+def scenario_concurrent(args):
+    count = args['concurrency']
+    size = max(1, args['size'] * MB // count)
+    errors = []
+    def run():
+        try:
+            chunker = subprocessio.SubprocessIOChunker(['head', '-c', str(size), '/dev/zero'], chunk_size = 65536)
+            received = drain(chunker)
+            chunker.close()
+            assert received == size, received
+        except Exception as e:
+            errors.append(repr(e))
+    threads = [threading.Thread(target = run) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return size * count, {'chunkers': count, 'errors': len(errors)}
+
+def scenario_slow(args):
+    size = min(args['size'], 64) * MB
+    m = metrics.Metrics()
+    request = m.request({})
+    chunker = subprocessio.SubprocessIOChunker(
+        ['head', '-c', str(size), '/dev/zero'], buffer_size = 65536, chunk_size = 4096, metrics = request)
+    received = 0
+    pending = 0
+    try:
+        while True:
+            received += len(chunker.next())
+            pending += 4096
+            if pending >= 65536:
+                pending = 0
+                time.sleep(0.0002)
+    except StopIteration:
+        pass
+    chunker.close()
+    assert received == size, received
+    return size, {'stalls': m.get('buffer_stalls_total', (('route', 'unrouted'),)) or 0}
+
+def scenario_stderr(args):
+    size = args['stderr_kb'] * 1024
+    start = time.time()
+    chunker = subprocessio.SubprocessIOChunker(
+        ['sh', '-c', 'head -c 1048576 /dev/zero; head -c %d /dev/zero >&2; head -c 1048576 /dev/zero' % size],
+        chunk_size = 65536)
+    received = drain(chunker)
+    chunker.close()
+    assert received == 2 * MB, received
+    stderr_mb_s = size / float(MB) / (time.time() - start)
+    failures = 0
+    error_size = 0
+    for i in range(10):
+        try:
+            subprocessio.SubprocessIOChunker(
+                ['sh', '-c', 'yes error | head -c 10485760 >&2; exit 1']).close()
+        except EnvironmentError as e:
+            failures += 1
+            error_size = max(error_size, len(str(e)))
+    assert failures == 10, failures
+    return size + 2 * MB, {'stderr_mb_s': stderr_mb_s, 'failures_reported': failures, 'max_error_bytes': error_size}
+
+def scenario_disconnect(args):
+    count = args['concurrency']
+    chunkers = 0
+    for i in range(count):
+        batch = []
+        for j in range(count):
+            if j % 2:
+                chunker = subprocessio.SubprocessIOChunker(['cat'], inputstream = ZeroReader())
+            else:
+                chunker = subprocessio.SubprocessIOChunker(['cat', '/dev/zero'])
+            batch.append(chunker)
+        for chunker in batch:
+            for k in range(3):
+                chunker.next()
+            chunker.close()
+        chunkers += len(batch)
+    return 0, {'chunkers': chunkers}
+
+def measure(name, args):
+    gc.collect()
+    threads_before = thread_count()
+    fds_before = fd_count()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sampler = ThreadSampler()
+    sampler.start()
+    start = time.time()
+    size, result = globals()['scenario_' + name](args)
+    elapsed = time.time() - start
+    sampler.stopped.set()
+    sampler.join()
+
+    # letting closed chunkers' threads finish and dropped processes be reaped.
+    gc.collect()
+    deadline = time.time() + 5
+    while thread_count() > threads_before and time.time() < deadline:
+        time.sleep(0.05)
+    processlauncher.get_launcher().call(['true'])
+    time.sleep(0.1)
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    fds_after = fd_count()
+    result.update({
+        'seconds': elapsed,
+        'mb_s': size / MB / elapsed if size else None,
+        'cpu_seconds': (self_after.ru_utime - self_before.ru_utime) + (self_after.ru_stime - self_before.ru_stime),
+        'children_cpu_seconds': (children_after.ru_utime - children_before.ru_utime)
+            + (children_after.ru_stime - children_before.ru_stime),
+        'peak_threads': sampler.peak,
+        'leaked_threads': thread_count() - threads_before,
+        'leaked_fds': fds_after - fds_before if fds_before is not None else None,
+        'zombies': zombie_count()
+    })
+    return result
+
+def main(argv):
+    args = {'size': 1024, 'concurrency': 16, 'stderr_kb': 256, 'json': None}
+    scenarios = []
+    argv = list(argv)
+    while argv:
+        name = argv.pop(0)
+        key = name[2:].replace('-', '_')
+        if name.startswith('--') and argv and key in args:
+            value = argv.pop(0)
+            args[key] = value if key == 'json' else int(value)
+        elif name in SCENARIOS:
+            scenarios.append(name)
+        else:
+            raise SystemExit(__doc__)
+    results = {}
+    print('%d MB, concurrency %d' % (args['size'], args['concurrency']))
+    for name in scenarios or SCENARIOS:
+        result = results[name] = measure(name, args)
+        print('%-11s %s' % (name, ', '.join(
+            '%s %s' % (key, ('%.2f' % value) if isinstance(value, float) else value)
+            for key, value in sorted(result.items()))))
+    if args['json']:
+        with open(args['json'], 'w') as f:
+            json.dump({'parameters': args, 'results': results}, f, indent = 2, sort_keys = True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
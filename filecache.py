@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+'''
+Module provides a cache of metadata and open file descriptors of the files
+served by git_http_backend.StaticWSGIServer ("dumb" HTTP protocol files.)
+
+Git objects are content-addressed: loose objects (objects/xx/<sha>) and packs
+(objects/pack/pack-<sha>.*) never change once they have their names. So
+their metadata is kept without checking the file system again, and their file
+descriptors are kept open and shared by the requests reading them, with
+pread(), which does not move the descriptor's position.
+
+Other files (HEAD, info/refs, objects/info/packs) change in place or are
+replaced. Their metadata is revalidated with a stat() (at most every ttl
+seconds) and they are opened for every request.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import threading
+from lru import LRU
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+if hasattr(os, 'pread'):
+    # Python 3.3+
+    pread = os.pread
+elif ctypes:
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        _pread = _libc.pread64
+        _pread.restype = ctypes.c_ssize_t
+        _pread.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int64]
+    except (OSError, AttributeError):
+        pread = None
+    else:
+        def pread(fd, size, offset):
+            buf = ctypes.create_string_buffer(size)
+            result = _pread(fd, buf, size, offset)
+            if result < 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            return buf.raw[:result]
+else:
+    pread = None
+
+def _stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+class FileCache(object):
+    '''
+    Remembers whatever metadata StaticWSGIServer wants to keep for a file
+    (keyed on whatever it likes), and keeps descriptors of immutable files open.
+
+    Counters:
+        hits - lookups answered from memory.
+        revalidations - lookups answered after a stat() showed no change.
+        misses - lookups of unknown or changed files.
+    '''
+    def __init__(self, max_entries = 16384, max_open = 256, ttl = 0):
+        '''
+        @param max_entries (Default: 16384) Max number of files to remember.
+        @param max_open (Default: 256) Max number of idle file descriptors
+            kept open. (Descriptors in use by responses are closed once the
+            response is done.)
+        @param ttl (Default: 0) Seconds metadata of mutable files is trusted
+            without a stat(). 0 = stat() them every time.
+        '''
+        self.max_entries = max_entries
+        self.max_open = max_open if pread else 0
+        self.ttl = ttl
+        # key : [info, path, stat key, time checked, immutable]
+        self.entries = LRU()
+        # path : [fd, users, evicted]
+        self.open_files = LRU()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        Returns info .put() for the key or None if there is none or the
+        (mutable) file changed since.
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[4] or (self.ttl and now - entry[3] < self.ttl):
+                self.entries.touch(key)
+                self.hits += 1
+                return entry[0]
+
+        try:
+            stat_key = _stat_key(os.stat(entry[1]))
+        except (EnvironmentError, ValueError):
+            stat_key = None
+        with self.lock:
+            if stat_key == entry[2] and self.entries.get(key) is entry:
+                entry[3] = now
+                self.revalidations += 1
+                return entry[0]
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, path, st, info, immutable = False):
+        '''
+        Stores info (anything) about the file at path, as of the given
+        os.stat() result.
+        '''
+        with self.lock:
+            self.entries.add(key, [info, path, _stat_key(st), time.time(), immutable])
+            self.entries.trim(self.max_entries)
+
+    def invalidate(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self._evict(entry[1])
+
+    def invalidate_path(self, path):
+        '''
+        Forgets the file at path (say, a pack deleted by repacking), under
+        whatever keys, and closes its descriptor once it is not in use.
+        '''
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry[1] == path:
+                    del self.entries[key]
+            self._evict(path)
+
+    def open(self, path):
+        '''
+        Opens a file, or shares an already open descriptor of it.
+
+        Returns a tuple (fd, release) - file descriptor and a callable to call
+        once done with it (instead of closing the descriptor.) Read it with
+        pread() only.
+        '''
+        with self.lock:
+            handle = self.open_files.touch(path)
+            if handle:
+                handle[1] += 1
+                return handle[0], lambda: self._release(handle)
+        fd = os.open(path, os.O_RDONLY | getattr(os, 'O_CLOEXEC', 0))
+        if not self.max_open:
+            return fd, lambda: os.close(fd)
+        with self.lock:
+            handle = self.open_files.get(path)
+            if handle:
+                # other request opened it at the same time.
+                handle[1] += 1
+            else:
+                handle = self.open_files[path] = [fd, 1, False]
+                fd = None
+                while len(self.open_files) > self.max_open:
+                    self._evict(next(iter(self.open_files)))
+        if fd is not None:
+            os.close(fd)
+        return handle[0], lambda: self._release(handle)
+
+    def _release(self, handle):
+        with self.lock:
+            handle[1] -= 1
+            if not (handle[2] and handle[1] == 0):
+                return
+        os.close(handle[0])
+
+    def _evict(self, path):
+        # must be called with self.lock acquired.
+        handle = self.open_files.pop(path, None)
+        if handle:
+            handle[2] = True
+            if handle[1] == 0:
+                os.close(handle[0])
+
+    def close(self):
+        '''
+        Closes idle file descriptors. (Those in use are closed when released.)
+        '''
+        with self.lock:
+            for path in list(self.open_files):
+                self._evict(path)
@@ -28,22 +28,43 @@ along with git_http_backend.py Project.  If not, see <http://www.gnu.org/license
 import io
 import os
 import sys
-import gzip
-import StringIO
+import zlib
+import hashlib
+import uuid
 
-import subprocess
 import subprocessio
+import processlauncher
+import responsecache
+import filecache
+import maintenance
+import admission
+import advertisement
+import metrics
+import profiling
+from lru import LRU
 
 import tempfile
 from wsgiref.headers import Headers
 
 # needed for WSGI Selector
 import re
-import urlparse
+try:
+    # 3.x style module (sre_parse is deprecated since 3.11)
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+import threading
+try:
+    # 2.x style module
+    import urlparse
+except ImportError:
+    # 3.x style module
+    import urllib.parse as urlparse
 from collections import defaultdict
 
 # needed for static content server
 import time
+import stat
 import email.utils
 import mimetypes
 mimetypes.add_type('application/x-git-packed-objects-toc','.idx')
@@ -52,9 +73,277 @@ mimetypes.add_type('application/x-git-packed-objects','.pack')
 __version__=(1,7,0,4) # the number has no significance for this code's functionality.
 # The number means "I was looking at sources of that version of Git while coding"
 
+def _to_unicode(s):
+    '''
+    Decodes (utf8) byte strings, passes through the already-decoded ones.
+    Lets the same code digest environ values of WSGI (bytes on Python 2)
+    and ASGI (text on Python 3) servers.
+    '''
+    if isinstance(s, bytes):
+        return s.decode('utf8')
+    return s
+
+_formatted_now = (None, None)
+
+def _formatdate_now():
+    '''
+    email.utils.formatdate(time.time()), formatted once a second.
+    '''
+    global _formatted_now
+    now = int(time.time())
+    if _formatted_now[0] != now:
+        _formatted_now = (now, email.utils.formatdate(now))
+    return _formatted_now[1]
+
+def parse_byte_ranges(header, size):
+    '''
+    Parses the value of Range request header (RFC 7233) for a resource of
+    size bytes.
+
+    Returns a list of (first, last) byte positions (inclusive) of the
+    satisfiable ranges, in the order requested (empty list if none of them
+    is satisfiable), or None if the header is not a valid request for byte
+    ranges and is to be ignored.
+    '''
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    valid = False
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, dash, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last) or not (first.isdigit() or not first) \
+                or not (last.isdigit() or not last):
+            return None
+        if not first:
+            # suffix range = last N bytes
+            length = int(last)
+            if length and size:
+                ranges.append((max(0, size - length), size - 1))
+        else:
+            first = int(first)
+            if last and int(last) < first:
+                return None
+            last = int(last) if last else size - 1
+            if first < size:
+                ranges.append((first, min(last, size - 1)))
+        valid = True
+    if not valid:
+        return None
+    return ranges
+
+def parse_etags(header):
+    '''
+    Parses the value of If-Match / If-None-Match header.
+
+    Returns a list of (tag, weak) tuples, tag with its quotes. "*" comes
+    back as [('*', False)].
+    '''
+    header = header.strip()
+    if header == '*':
+        return [('*', False)]
+    return [(tag, bool(weak)) for weak, tag in re.findall(r'(W/)?("[^"]*"|[^\s,]+)', header)]
+
+def match_etag(header, etags, weak = True):
+    '''
+    Returns the first of etags (the entity's tags, all strong) listed in
+    If-Match / If-None-Match header value, or None if none of them is.
+    With weak = False, weak tags in the header match nothing (strong
+    comparison, RFC 7232 2.3.2).
+    '''
+    for tag, is_weak in parse_etags(header):
+        if is_weak and not weak:
+            continue
+        if tag == '*':
+            return etags[0]
+        if tag in etags:
+            return tag
+    return None
+
+def etag_variant(etag, suffix):
+    '''
+    Returns the entity tag of a variant (say, compressed) of the entity with
+    the given tag. '"abc"' -> '"abc-gzip"'
+    '''
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], suffix)
+    return '%s-%s' % (etag, suffix)
+
+def parse_http_date(value):
+    '''
+    Returns the POSIX timestamp of an HTTP date, or None if it's not one.
+    '''
+    try:
+        parsed = email.utils.parsedate_tz(value)
+        return parsed and email.utils.mktime_tz(parsed)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def parse_git_protocol(header):
+    '''
+    Returns the value of Git-Protocol request header, fit for passing to git
+    as GIT_PROTOCOL (colon-separated key=value items, "version=2"), or None
+    if there is no header or it does not look like one.
+    '''
+    header = (header or '').strip()
+    if not header or len(header) > 1024 or not re.match(r'^[A-Za-z0-9._=:-]+$', header):
+        return None
+    return str(header)
+
+def git_protocol_version(protocol):
+    '''
+    Returns the wire protocol version (0, 1 or 2) git speaks when given the
+    GIT_PROTOCOL value. Same as with git, the highest known version asked
+    for wins.
+    '''
+    version = 0
+    for item in (protocol or '').split(':'):
+        if item in ('version=1', 'version=2'):
+            version = max(version, int(item[8:]))
+    return version
+
+def git_env(protocol, launcher = None):
+    '''
+    Returns environment for git serving a request made with the given
+    GIT_PROTOCOL value, or None (= launcher's) if there is none.
+    '''
+    if not protocol:
+        return None
+    return (launcher or processlauncher.get_launcher()).environ({'GIT_PROTOCOL': protocol})
+
+def _required_literals(parsed, ignore_case = False):
+    '''
+    Returns a list of strings that any text matched by the parsed (sre_parse)
+    regex must contain. Incomplete (skips literals inside repeats, branches
+    etc.), which is fine, as we use these only for ruling out non-matching
+    text fast.
+    '''
+    literals = []
+    run = []
+    for op, av in parsed:
+        if op == sre_parse.LITERAL and not ignore_case:
+            run.append(av)
+            continue
+        if run:
+            literals.append(u''.join(_unichr(c) for c in run))
+            run = []
+        if op == sre_parse.SUBPATTERN:
+            # (group, subpattern) on 2.x, (group, add_flags, del_flags, subpattern) on 3.x
+            literals.extend(_required_literals(
+                av[-1],
+                ignore_case or (len(av) > 2 and bool(av[1] & re.IGNORECASE))
+                ))
+    if run:
+        literals.append(u''.join(_unichr(c) for c in run))
+    return literals
+
+try:
+    _unichr = unichr
+except NameError:
+    _unichr = chr
+
+def negotiate_content_encoding(accept_encoding, supported = ('gzip', 'deflate')):
+    '''
+    Picks the content coding of a response out of those in supported, going
+    by the value of Accept-Encoding request header (RFC 7231 section 5.3.4).
+    Ties go to the coding listed first in supported.
+
+    Returns the name of the coding or None (= send the response as is).
+    '''
+    qualities = {}
+    for item in (accept_encoding or '').split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities['gzip' if coding == 'x-gzip' else coding] = q
+    best, best_q = None, 0
+    for coding in supported:
+        q = qualities.get(coding, qualities.get('*', 0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+def response_compressor(encoding, level = 6, window_bits = zlib.MAX_WBITS):
+    '''
+    Returns a zlib compression object producing the data of the given
+    Content-Encoding ('gzip' or 'deflate', which, in HTTP, means zlib format.)
+    '''
+    if encoding == 'gzip':
+        window_bits += 16
+    return zlib.compressobj(level, zlib.DEFLATED, window_bits)
+
+class CompressingIterator(object):
+    '''
+    Wraps a WSGI response iterable and yields its contents compressed
+    as they come, so that output streamed from git is not held back until
+    git is done. Memory used per response is bounded by the compression
+    window (2**window_bits bytes) and zlib's state, whatever the size of
+    the response.
+    '''
+    def __init__(self, source, encoding = 'gzip', level = 6, window_bits = zlib.MAX_WBITS):
+        self.source = iter(source)
+        self.source_close = getattr(source, 'close', None)
+        self.compressor = response_compressor(encoding, level, window_bits)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self.compressor:
+            try:
+                chunk = next(self.source)
+            except StopIteration:
+                data, self.compressor = self.compressor.flush(), None
+                return data
+            if isinstance(chunk, memoryview):
+                # subprocessio.BufferPool mode
+                chunk = chunk.tobytes()
+            data = self.compressor.compress(chunk)
+            if data:
+                return data
+        raise StopIteration
+    __next__ = next
+
+    def close(self):
+        self.compressor = None
+        if self.source_close:
+            self.source_close()
+
 class BaseWSGIClass(object):
     bufsize = 65536
+    # "route" label of the metrics of requests we handle.
+    metrics_route = 'other'
     gzip_response = False
+    gzip_level = 6
+    gzip_window_bits = zlib.MAX_WBITS
+    # content that is compressed already. Not worth compressing again.
+    gzip_skip_types = set([
+        'application/x-git-packed-objects',
+        'application/x-git-packed-objects-toc',
+        'application/x-git-loose-object',
+        'application/x-git-upload-pack-result',
+        'application/x-gzip',
+        'application/x-bzip2',
+        'application/x-xz',
+        'multipart/byteranges',
+        'application/zip',
+        'image/gif',
+        'image/jpeg',
+        'image/png'
+    ])
     canned_collection = {
         '304': '304 Not Modified',
         'not_modified': '304 Not Modified',
@@ -71,11 +360,19 @@ class BaseWSGIClass(object):
         'not_found': "404 Not Found",
         '405': "405 Method Not Allowed",
         'method_not_allowed': "405 Method Not Allowed",
+        '412':'412 Precondition Failed',
+        'precondition_failed':'412 Precondition Failed',
+        '413':'413 Request Entity Too Large',
+        'request_too_large':'413 Request Entity Too Large',
+        '416':'416 Requested Range Not Satisfiable',
+        'range_not_satisfiable':'416 Requested Range Not Satisfiable',
         '417':'417 Execution failed',
         'execution_failed':'417 Execution failed',
         '200': "200 OK",
         '501': "501 Not Implemented",
-        'not_implemented': "501 Not Implemented"
+        'not_implemented': "501 Not Implemented",
+        '503': "503 Service Unavailable",
+        'service_unavailable': "503 Service Unavailable"
     }
 
     def canned_handlers(self, environ, start_response, code = '200', headers = []):
@@ -91,7 +388,38 @@ class BaseWSGIClass(object):
         start_response(self.canned_collection[code], headerbase)
         return ['']
 
-    def package_response(self, outIO, environ, start_response, headers = []):
+    def response_encoding(self, environ, headersIface):
+        '''
+        Decides if the response described by headersIface (a wsgiref Headers
+        instance) is to be compressed, and updates the headers accordingly.
+
+        Returns Content-Encoding to apply ('gzip', 'deflate') or None.
+        '''
+        if not self.gzip_response or headersIface.get('Content-Encoding'):
+            return None
+        content_type = (headersIface.get('Content-Type') or '').split(';')[0].strip().lower()
+        if content_type in self.gzip_skip_types:
+            return None
+
+        # compressed or not, the response depends on Accept-Encoding. Telling the caches.
+        vary = headersIface.get('Vary')
+        headersIface['Vary'] = vary + ', Accept-Encoding' if vary else 'Accept-Encoding'
+
+        if headersIface.get('Content-Range'):
+            # byte ranges are those of the content as is.
+            return None
+
+        encoding = negotiate_content_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding:
+            headersIface['Content-Encoding'] = encoding
+            del headersIface['Content-Length']
+            etag = headersIface.get('ETag')
+            if etag:
+                # compressed representation is a different entity.
+                headersIface['ETag'] = etag_variant(etag, encoding)
+        return encoding
+
+    def package_response(self, outIO, environ, start_response, headers = [], status = '200 OK'):
 
         newheaders = headers
         headers = [('Content-type', 'application/octet-stream')] # my understanding of spec. If unknown = binary
@@ -100,15 +428,31 @@ class BaseWSGIClass(object):
         for header in newheaders:
             headersIface[header[0]] = '; '.join(header[1:])
 
-        if hasattr(outIO,'fileno') and 'wsgi.file_wrapper' in environ:
-            outIO.seek(0)
-            retobj = environ['wsgi.file_wrapper']( outIO, self.bufsize )
+        encoding = self.response_encoding(environ, headersIface)
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(outIO, RangeFile) and not getattr(file_wrapper, 'sends_ranges', False):
+            # other servers send the descriptor from its position (and move
+            # it), which is neither where the range starts nor theirs to move,
+            # when the descriptor is shared (see filecache.FileCache.)
+            file_wrapper = None
+
+        # pipes (subprocessio.SubprocessIOFile) can't, and don't need to, seek.
+        if hasattr(outIO,'fileno') and file_wrapper and not encoding:
+            if hasattr(outIO,'seek'):
+                outIO.seek(0)
+            retobj = file_wrapper( outIO, self.bufsize )
         elif hasattr(outIO,'read'):
-            outIO.seek(0)
-            retobj = iter( lambda: outIO.read(self.bufsize), '' )
+            if hasattr(outIO,'seek'):
+                outIO.seek(0)
+            retobj = iter( lambda: outIO.read(self.bufsize), b'' )
+            if hasattr(outIO,'close'):
+                retobj = ClosingIterator(retobj, outIO.close)
         else:
             retobj = outIO
-        start_response("200 OK", headers)
+        if encoding:
+            retobj = CompressingIterator(retobj, encoding, self.gzip_level, self.gzip_window_bits)
+        start_response(status, headers)
         return retobj
 
 class WSGIHandlerSelector(BaseWSGIClass):
@@ -140,26 +484,49 @@ class WSGIHandlerSelector(BaseWSGIClass):
 
     See documentation for .add() method for examples.
 
+    Routing is done by trying patterns in the order they were added, but
+    patterns are tried only on paths containing all the literal parts of
+    the pattern (like "/info/refs?" or "/git-"), and results are memoized
+    for the last route_cache_size paths.
+
     Based on Selector from http://lukearno.com/projects/selector/
 
     Copyright (c) 2010 Daniel Dotsenko <dotsa@hotmail.com>
     Copyright (C) 2006 Luke Arno - http://lukearno.com/
     """
 
-    def __init__(self, WSGI_env_key = 'WSGIHandlerSelector'):
+    # paths (with query strings) longer than this are not memoized.
+    route_cache_max_key = 2048
+
+    def __init__(self, WSGI_env_key = 'WSGIHandlerSelector', route_cache_size = 1024, metrics = None, profiler = None):
         """
         WSGIHandlerSelector instance initializer.
 
-        WSGIHandlerSelector(WSGI_env_key = 'WSGIHandlerSelector')
+        WSGIHandlerSelector(WSGI_env_key = 'WSGIHandlerSelector', route_cache_size = 1024, metrics = None, profiler = None)
 
         Inputs:
          WSGI_env_key (optional)
           name of the key selector injects into WSGI's environ.
           The key will be the base for other dicts, like .matches - the key-value pairs of
           name-matchedtext matched groups. Defaults to 'WSGIHandlerSelector'
+         route_cache_size (optional)
+          Number of (path, method, query string) lookups to remember. 0 = off.
+         metrics (optional)
+          metrics.Metrics instance. Requests are metered (time spent routing
+          and in total, bytes in and out etc.) and counted under the
+          metrics_route of the handler.
+         profiler (optional)
+          profiling.RequestProfiler instance. Requests it picks are profiled
+          from routing to the end of the response body's iteration.
         """
+        self.metrics = metrics
+        self.profiler = profiler
         self.mappings = []
         self.WSGI_env_key = WSGI_env_key
+        self.route_cache_size = route_cache_size
+        self.route_cache = LRU()
+        self.route_cache_lock = threading.Lock()
+        self.uses_query_string = False
 
     def add(self, path, default_handler = None, **http_methods):
         """
@@ -211,71 +578,166 @@ class WSGIHandlerSelector(BaseWSGIClass):
             methods = defaultdict(lambda: default_handler, http_methods.copy())
         else:
             methods = http_methods.copy()
-        self.mappings.append((re.compile(path.decode('utf8')), methods, (path.find(r'\?')>-1) ))
-
-    def __call__(self, environ, start_response):
+        path = _to_unicode(path)
+        regex = re.compile(path)
+        use_query_string = path.find(r'\?')>-1
+        self.mappings.append((
+            regex,
+            methods,
+            use_query_string,
+            _required_literals(sre_parse.parse(path), bool(regex.flags & re.IGNORECASE))
+            ))
+        self.uses_query_string = self.uses_query_string or use_query_string
+        with self.route_cache_lock:
+            self.route_cache.clear()
+
+    def select(self, path, method, query_string = ''):
         """
-        Delegate request to the appropriate WSGI app.
+        Finds the handler for a request.
 
-        The following keys will be added to the WSGI's environ:
+        select(path, method, query_string)
 
-        wsgiorg.routing_args
-            It's a tuple of a list and a dict. The structure is per this spec:
-            http://www.wsgi.org/wsgi/Specifications/routing_args
+        Inputs:
+         path - PATH_INFO of the request (as given by the server).
+         method - HTTP verb.
+         query_string - QUERY_STRING of the request.
+
+        Returns a tuple (handler, matches, alternate_HTTP_verbs, path), where
+        handler is None if no mapping matched both the path and the method,
+        matches is the regex match object of the matched mapping,
+        alternate_HTTP_verbs is the set of verbs the path would match for and
+        path is the sanitized path the mappings were matched against.
+        """
+        # query string makes a difference only if some mapping looks at it.
+        key = (path, method, query_string if self.uses_query_string else None)
+        with self.route_cache_lock:
+            result = self.route_cache.touch(key)
+            if result:
+                return result
 
-        WSGIHandlerSelector.matched_request_methods
-            It's a list of strings denoting other HTTP verbs / methods the
-            matched URI (not chosen handler!) accepts for processing.
-            This matters when
+        result = self._select(path, method, query_string)
 
-        """
+        if self.route_cache_size and len(path) + len(query_string) <= self.route_cache_max_key:
+            with self.route_cache_lock:
+                self.route_cache.add(key, result)
+                self.route_cache.trim(self.route_cache_size)
+        return result
 
-        path = environ.get('PATH_INFO', '').decode('utf8')
+    def _select(self, path, method, query_string):
+        path = _to_unicode(path)
 
         matches = None
         handler = None
         alternate_HTTP_verbs = set()
-        query_string = (environ.get('QUERY_STRING') or '')
 
         # sanitizing the path:
         # turns garbage like this: r'//qwre/asdf/..*/*/*///.././../qwer/./..//../../.././//yuioghkj/../wrt.sdaf'
         # into something like this: /../../wrt.sdaf
         path = urlparse.urljoin(u'/', re.sub('//+','/',path.strip('/')))
         if not path.startswith('/../'): # meaning, if it's not a trash path
-            for _regex, _registered_methods, _use_query_string in self.mappings:
-                if _use_query_string:
-                    matches = _regex.search(path + '?' + query_string)
+            path_and_query = path + '?' + query_string
+            for _regex, _registered_methods, _use_query_string, _literals in self.mappings:
+                subject = path_and_query if _use_query_string else path
+                matches = None
+                for _literal in _literals:
+                    if _literal not in subject:
+                        break
                 else:
-                    matches = _regex.search(path)
+                    matches = _regex.search(subject)
                 if matches:
                     # note, there is a chance that '_registered_methods' is an instance of
                     # collections.defaultdict, which means if default handler was
                     # defined it will be returned for all unmatched HTTP methods.
-                    handler = _registered_methods[environ.get('REQUEST_METHOD','')]
+                    handler = _registered_methods.get(method)
+                    if handler is None and isinstance(_registered_methods, defaultdict):
+                        handler = _registered_methods.default_factory()
                     if handler:
                         break
                     else:
                         alternate_HTTP_verbs.update(_registered_methods.keys())
+        return handler, matches, alternate_HTTP_verbs, path
+
+    def __call__(self, environ, start_response):
+        """
+        Delegate request to the appropriate WSGI app.
+
+        The following keys will be added to the WSGI's environ:
+
+        wsgiorg.routing_args
+            It's a tuple of a list and a dict. The structure is per this spec:
+            http://www.wsgi.org/wsgi/Specifications/routing_args
+
+        WSGIHandlerSelector.matched_request_methods
+            It's a list of strings denoting other HTTP verbs / methods the
+            matched URI (not chosen handler!) accepts for processing.
+            This matters when
+
+        git_http_backend.metrics
+            metrics.RequestMetrics of the request, if we have metrics.
+
+        git_http_backend.profile
+            profiling.RequestProfile of the request, if it is profiled.
+
+        """
+        profile = self.profiler.request(environ) if self.profiler else None
+        if not profile:
+            return self.dispatch(environ, start_response)
+        try:
+            profile.enable()
+            result = self.dispatch(environ, start_response)
+        except:
+            profile.finish()
+            raise
+        finally:
+            profile.disable()
+        return profile.wrap_response(result)
+
+    def dispatch(self, environ, start_response):
+        """
+        Routes the request to the handler (see __call__.)
+        """
+        request = self.metrics.request(environ) if self.metrics else None
+        if request:
+            start_response = request.start_response(start_response)
+            request.wrap_input(environ)
+
+        handler, matches, alternate_HTTP_verbs, path = self.select(
+            environ.get('PATH_INFO', ''),
+            environ.get('REQUEST_METHOD',''),
+            environ.get('QUERY_STRING') or ''
+            )
+        if request:
+            request.phase('routing', time.time() - request.start)
         if handler:
             environ['PATH_INFO'] = path.encode('utf8')
 
             mg = list(environ.get('wsgiorg.routing_args') or ([],{}))
-            mg[0] = list(mg[0]).append(matches.groups()),
+            mg[0] = list(mg[0]) + list(matches.groups())
+            mg[1] = dict(mg[1])
             mg[1].update(matches.groupdict())
             environ['wsgiorg.routing_args'] = tuple(mg)
 
-            return handler(environ, start_response)
+            route = getattr(handler, 'metrics_route', BaseWSGIClass.metrics_route)
+            if request:
+                request.route = route
+            profile = profiling.request_profile(environ)
+            if profile:
+                profile.route = route
+            result = handler(environ, start_response)
         elif alternate_HTTP_verbs:
             # uugh... narrow miss. Regex matched some path, but the method was off.
             # let's advertize what methods we can do with this URI.
-            return self.canned_handlers(
+            result = self.canned_handlers(
                 environ,
                 start_response,
                 'method_not_allowed',
                 headers = [('Allow', ', '.join(alternate_HTTP_verbs))]
                 )
         else:
-            return self.canned_handlers(environ, start_response, 'not_found')
+            result = self.canned_handlers(environ, start_response, 'not_found')
+        if request:
+            result = request.wrap_response(result)
+        return result
 
 class StaticWSGIServer(BaseWSGIClass):
     """
@@ -286,7 +748,29 @@ class StaticWSGIServer(BaseWSGIClass):
 
     Relies on WSGIHandlerSelector for prepopulating some needed environ
     variables, cleaning up the URI, setting up default error handlers.
+
+    Serves byte ranges (Range, If-Range request headers) of files, so that
+    interrupted downloads of large packs can be resumed.
+
+    Sends Cache-Control per cache_control (a list of (regex, value) pairs;
+    first regex found in the path wins; value None = no header). By default,
+    git objects and packs, which never change, are cached for a year, and
+    the files listing refs and packs for a few seconds. (Drop "public" from
+    these if the repos are served to authenticated users only.)
+    ETags are strong: the SHA in the name of git objects and packs, inode,
+    size and modification time of other files. Conditional requests
+    (If-Match, If-None-Match, If-Modified-Since, If-Unmodified-Since) are
+    evaluated per RFC 7232.
     """
+    # Content types git's own http-backend gives to "dumb" HTTP protocol files.
+    # (Also keeps already-compressed objects out of gzip_response's way.)
+    git_content_types = [
+        (re.compile(r'(^|/)objects/[0-9a-f]{2}/[0-9a-f]{38,62}$'), 'application/x-git-loose-object'),
+        (re.compile(r'(^|/)objects/pack/pack-[0-9a-f]{40,64}\.pack$'), 'application/x-git-packed-objects'),
+        (re.compile(r'(^|/)objects/pack/pack-[0-9a-f]{40,64}\.idx$'), 'application/x-git-packed-objects-toc'),
+        (re.compile(r'(^|/)(HEAD|info/refs|objects/info/(packs|alternates|http-alternates))$'), 'text/plain')
+    ]
+    metrics_route = 'static'
 
     def __init__(self, **kw):
         '''
@@ -300,52 +784,456 @@ class StaticWSGIServer(BaseWSGIClass):
             gzip_response (optional) (must be named arg)
                 Specify if we are to detect if gzip compression is supported
                 by client and gzip the output. False by default.
+                Content of types listed in gzip_skip_types (packs, loose
+                objects, images) is never compressed.
+
+            gzip_level (optional)
+                zlib compression level, 1 (fastest) to 9 (smallest). Defaults to 6.
+
+            max_ranges (optional)
+                Requests for more byte ranges than this get the whole file.
+                Defaults to 16.
+
+            file_cache (optional)
+                filecache.FileCache instance remembering metadata of files
+                and keeping files of git objects open. Defaults to None.
+
+            cache_control (optional)
+                List of (compiled regex, Cache-Control header value) pairs.
+                See the class' docstring.
         '''
         self.__dict__.update(kw)
 
+    max_ranges = 16
+    file_cache = None
+    # Content-addressed files. These never change once they have their names.
+    immutable_paths = re.compile(
+        r'(?:^|/)objects/(?:([0-9a-f]{2})/([0-9a-f]{38,62})|pack/pack-([0-9a-f]{40,64})\.(pack|idx))$')
+    cache_control = [
+        (immutable_paths, 'public, max-age=31536000, immutable'),
+        (re.compile(r'(^|/)(HEAD|info/refs|objects/info/(packs|alternates|http-alternates))$'),
+            'public, max-age=5, must-revalidate')
+    ]
+
+    def file_info(self, full_path, path_info, st):
+        '''
+        Returns a dict of what we need to know about the file to serve it.
+        '''
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        for pattern, git_type in self.git_content_types:
+            if pattern.search(path_info):
+                content_type = git_type
+                break
+        cache_control = None
+        for pattern, value in self.cache_control:
+            if pattern.search(path_info):
+                cache_control = value
+                break
+        content_address = self.immutable_paths.search(path_info)
+        if content_address:
+            loose_head, loose_tail, pack_sha, pack_ext = content_address.groups()
+            # (str(), as the path is unicode on Python 2.)
+            etag = str('"%s"' % (loose_head + loose_tail if loose_head else pack_sha + '-' + pack_ext))
+        else:
+            etag = '"%x-%x-%x"' % (st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+        return {
+            'path': full_path,
+            'size': st.st_size,
+            'mtime': int(st.st_mtime),
+            'etag': etag,
+            'last_modified': email.utils.formatdate(st.st_mtime),
+            'content_type': content_type,
+            'cache_control': cache_control,
+            'immutable': bool(content_address)
+        }
+
+    def preconditions(self, environ, etag, mtime):
+        '''
+        Evaluates conditional request headers (RFC 7232 section 6) against
+        the entity tag and modification time of the file.
+
+        Returns None (go on with the request), or a tuple (canned response
+        name, entity tag the client has), for 304 and 412 responses.
+        '''
+        # the client may know the file by the tag of its compressed variant.
+        etags = [etag] + [etag_variant(etag, encoding) for encoding in ('gzip', 'deflate')]
+        if_match = environ.get('HTTP_IF_MATCH')
+        if if_match:
+            if not match_etag(if_match, etags[:1], weak = False):
+                return 'precondition_failed', etag
+        elif environ.get('HTTP_IF_UNMODIFIED_SINCE'):
+            since = parse_http_date(environ['HTTP_IF_UNMODIFIED_SINCE'])
+            if since is not None and mtime > since:
+                return 'precondition_failed', etag
+
+        safe = environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD')
+        if_none = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none:
+            matched = match_etag(if_none, etags)
+            if matched:
+                return ('not_modified' if safe else 'precondition_failed'), matched
+        elif safe and environ.get('HTTP_IF_MODIFIED_SINCE'):
+            since = parse_http_date(environ['HTTP_IF_MODIFIED_SINCE'])
+            if since is not None and mtime <= since:
+                return 'not_modified', etag
+        return None
+
+    def open_file(self, info):
+        '''
+        Returns a tuple (fd, release) - file descriptor of the file and
+        the callable to call instead of closing it.
+        '''
+        if info['immutable'] and self.file_cache:
+            return self.file_cache.open(info['path'])
+        fd = os.open(info['path'], os.O_RDONLY | getattr(os, 'O_BINARY', 0) | getattr(os, 'O_CLOEXEC', 0))
+        return fd, lambda: os.close(fd)
+
+    def multipart_ranges(self, file_like, ranges, size, content_type, boundary):
+        '''
+        Generates "multipart/byteranges" body for ranges of file_like.
+        '''
+        try:
+            for first, last in ranges:
+                yield self.part_header(first, last, size, content_type, boundary)
+                file_like.seek(first)
+                remaining = last - first + 1
+                while remaining:
+                    data = file_like.read(min(self.bufsize, remaining))
+                    if not data:
+                        # file was truncated under us. Content-Length is off anyway.
+                        return
+                    remaining -= len(data)
+                    yield data
+            yield ('\r\n--%s--\r\n' % boundary).encode('ascii')
+        finally:
+            file_like.close()
+
+    def part_header(self, first, last, size, content_type, boundary):
+        return (
+            '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+            % (boundary, content_type, first, last, size)
+            ).encode('ascii')
+
     def __call__(self, environ, start_response):
+        started = time.time()
         selector_matches = (environ.get('wsgiorg.routing_args') or ([],{}))[1]
         if 'working_path' in selector_matches:
             # working_path is a custom key that I just happened to decide to use
             # for marking the portion of the URI that is palatable for static serving.
             # 'working_path' is the name of a regex group fed to WSGIHandlerSelector
-            path_info = selector_matches['working_path'].decode('utf8')
+            path_info = _to_unicode(selector_matches['working_path'])
         else:
-            path_info = environ.get('PATH_INFO', '').decode('utf8')
-
-        # this, i hope, safely turns the relative path into OS-specific, absolute.
-        full_path = os.path.abspath(os.path.join(self.content_path, path_info.strip('/')))
-        _pp = os.path.abspath(self.content_path)
-
-        if not full_path.startswith(_pp):
-            return self.canned_handlers(environ, start_response, 'forbidden')
-        if not os.path.isfile(full_path):
-            return self.canned_handlers(environ, start_response, 'not_found')
+            path_info = _to_unicode(environ.get('PATH_INFO', ''))
+
+        cache = self.file_cache
+        key = (self.content_path, path_info)
+        info = cache.get(key) if cache else None
+        if info is None:
+            # this, i hope, safely turns the relative path into OS-specific, absolute.
+            full_path = os.path.abspath(os.path.join(self.content_path, path_info.strip('/')))
+            _pp = os.path.abspath(self.content_path)
+
+            if not full_path.startswith(_pp):
+                return self.canned_handlers(environ, start_response, 'forbidden')
+            try:
+                st = os.stat(full_path)
+            except (EnvironmentError, ValueError):
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
+                return self.canned_handlers(environ, start_response, 'not_found')
+            info = self.file_info(full_path, path_info, st)
+            if cache:
+                cache.put(key, full_path, st, info, info['immutable'])
 
-        mtime = os.stat(full_path).st_mtime
-        etag, last_modified =  str(mtime), email.utils.formatdate(mtime)
+        size, etag, last_modified, content_type = (
+            info['size'], info['etag'], info['last_modified'], info['content_type'])
         headers = [
-            ('Content-type', 'text/plain'),
-            ('Date', email.utils.formatdate(time.time())),
+            ('Content-Type', content_type),
+            ('Date', _formatdate_now()),
             ('Last-Modified', last_modified),
-            ('ETag', etag)
+            ('ETag', etag),
+            ('Accept-Ranges', 'bytes')
         ]
         headersIface = Headers(headers)
-        headersIface['Content-Type'] = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+        if info['cache_control']:
+            headersIface['Cache-Control'] = info['cache_control']
+
+        failed = self.preconditions(environ, etag, info['mtime'])
+        if failed:
+            code, headersIface['ETag'] = failed
+            return self.canned_handlers(environ, start_response, code, headers)
+
+        ranges = None
+        if_range = (environ.get('HTTP_IF_RANGE') or '').strip()
+        if 'HTTP_RANGE' in environ and (not if_range or if_range in (etag, last_modified)):
+            # with If-Range, ranges are only good for the same version of the file.
+            # (Strong comparison: weak tags start with W/ and never equal ours.)
+            ranges = parse_byte_ranges(environ['HTTP_RANGE'], size)
+            if ranges is not None and len(ranges) > self.max_ranges:
+                ranges = None
+            if ranges == []:
+                headersIface['Content-Range'] = 'bytes */%d' % size
+                return self.canned_handlers(environ, start_response, 'range_not_satisfiable', headers)
+
+        request = metrics.request_metrics(environ)
+        if request:
+            request.phase('checks', time.time() - started)
+        try:
+            fd, release = self.open_file(info)
+        except (EnvironmentError, ValueError):
+            # gone since we looked.
+            if cache:
+                cache.invalidate(key)
+            return self.canned_handlers(environ, start_response, 'not_found')
+        if not ranges:
+            headersIface['Content-Length'] = str(size)
+            return self.package_response(
+                RangeFile(fd, 0, size, release), environ, start_response, headers)
+
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            headersIface['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            headersIface['Content-Length'] = str(last - first + 1)
+            return self.package_response(
+                RangeFile(fd, first, last - first + 1, release),
+                environ, start_response, headers, '206 Partial Content')
+        else:
+            boundary = uuid.uuid4().hex
+            headersIface['Content-Length'] = str(
+                sum(len(self.part_header(first, last, size, content_type, boundary)) + last - first + 1
+                    for first, last in ranges)
+                + len(boundary) + 8)
+            headersIface['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+            return self.package_response(
+                self.multipart_ranges(RangeFile(fd, 0, size, release), ranges, size, content_type, boundary),
+                environ, start_response, headers, '206 Partial Content')
+
+class ClosingIterator(object):
+    '''
+    Wraps a WSGI response iterable and calls the callbacks once, when the
+    iterable is exhausted or when the server closes it (whichever comes first).
 
-        if_modified = environ.get('HTTP_IF_MODIFIED_SINCE')
-        if if_modified and (email.utils.parsedate(if_modified) >= email.utils.parsedate(last_modified)):
-            return self.canned_handlers(environ, start_response, 'not_modified', headers)
-        if_none = environ.get('HTTP_IF_NONE_MATCH')
-        if if_none and (if_none == '*' or etag in if_none):
-            return self.canned_handlers(environ, start_response, 'not_modified', headers)
+    Use it for work that must happen only after the response body, (and,
+    thus, the work of the subprocess producing it) is done.
+    '''
+    def __init__(self, source, *callbacks):
+        self.source = iter(source)
+        self.callbacks = list(callbacks)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return next(self.source)
+        except StopIteration:
+            self._done()
+            raise
+    __next__ = next
+
+    def _done(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        try:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+        finally:
+            self._done()
+
+class RangeFile(object):
+    '''
+    File-like presenting length bytes of the file open as descriptor fd,
+    starting at offset start.
+
+    Reads with pread() (where available), which leaves the position of the
+    descriptor alone, so that many RangeFiles can share one descriptor (see
+    filecache.FileCache). For the same reason, servers wanting to sendfile()
+    the range instead of reading it are to send .remaining bytes of fileno()
+    starting at .offset, and say so by the sends_ranges attribute of their
+    wsgi.file_wrapper (see simpleserver.RangeFileWrapper). Other servers get
+    RangeFiles to read().
+
+    close (optional) is called instead of closing fd when we are done.
+    '''
+    def __init__(self, fd, start, length, close = None):
+        self.fd = fd
+        self.start = start
+        self.length = length
+        self.on_close = close or (lambda: os.close(fd))
+        self.seek(0)
+
+    def fileno(self):
+        return self.fd
+
+    def seek(self, offset):
+        self.offset = self.start + offset
+        self.remaining = self.length - offset
+
+    def read(self, size = -1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b''
+        if filecache.pread:
+            data = filecache.pread(self.fd, size, self.offset)
+        else:
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+            data = os.read(self.fd, size)
+        self.offset += len(data)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        on_close, self.on_close = self.on_close, None
+        if on_close:
+            on_close()
+
+    def __del__(self):
+        self.close()
+
+class PrefixedReader(object):
+    '''
+    File-like returning the contents of prefix string first and then the
+    contents of the source file-like. Used for putting back the part of
+    request body we had to read ahead of time.
+    '''
+    def __init__(self, prefix, source):
+        self.prefix = prefix
+        self.source = source
+
+    def read(self, size = -1):
+        if self.prefix:
+            if size is None or size < 0:
+                data, self.prefix = self.prefix + self.source.read(), b''
+            else:
+                data, self.prefix = self.prefix[:size], self.prefix[size:]
+            return data
+        return self.source.read(size)
+
+class RequestBodyTooLarge(IOError):
+    pass
 
-        file_like = open(full_path, 'rb')
-        return self.package_response(file_like, environ, start_response, headers)
+class GzipDecodingReader(object):
+    '''
+    File-like returning the decompressed contents of a gzip-encoded source
+    file-like. Decompresses as it is read, so the whole request body is
+    never held in memory, compressed or not.
+
+    If max_size is set, reading past max_size bytes of decompressed data
+    raises RequestBodyTooLarge (protection against "gzip bombs").
+    '''
+    def __init__(self, source, max_size = None, chunk_size = 65536):
+        self.source = source
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.size = 0
+        self.eof = False
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            chunks = []
+            chunk = self.read(self.chunk_size)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(self.chunk_size)
+            return b''.join(chunks)
+        data = b''
+        try:
+            while size and not data and not self.eof:
+                compressed = self.decoder.unconsumed_tail
+                if not compressed:
+                    compressed = self.source.read(self.chunk_size)
+                if compressed:
+                    # max_length keeps one read from inflating into gigabytes.
+                    data = self.decoder.decompress(compressed, size)
+                else:
+                    data = self.decoder.flush()
+                    self.eof = True
+        except zlib.error as e:
+            raise IOError('Request body is not valid gzip data: %s' % e)
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise RequestBodyTooLarge('Decompressed request body is larger than %s bytes' % self.max_size)
+        return data
 
 class GitHTTPBackendBase(BaseWSGIClass):
     git_folder_signature = set(['config', 'head', 'info', 'objects', 'refs'])
     repo_auto_create = True
+    advertisement_cache = None
+    repo_index = None
+    pack_cache = None
+    upload_pack_coalescer = None
+    request_body_peek_limit = 1048576
+    max_gzip_request_size = 104857600
+    subprocess_chunker = subprocessio.SubprocessIOChunker
+    stdout_passthrough = False
+    maintenance = None
+    admission = None
+    ref_advertiser = None
+    git_protocol_passthrough = True
+    launcher = None
+
+    def git_protocol(self, environ):
+        '''
+        Returns GIT_PROTOCOL value to run git with (as asked for by the
+        client in Git-Protocol header), or None.
+        '''
+        if not self.git_protocol_passthrough:
+            return None
+        return parse_git_protocol(environ.get('HTTP_GIT_PROTOCOL'))
+
+    def chunker_options(self, protocol = None, environ = None):
+        '''
+        Returns named arguments to give subprocess_chunker: launcher,
+        environment (for the GIT_PROTOCOL value) and metrics of the request,
+        where not the defaults.
+        '''
+        kw = {}
+        if self.launcher:
+            kw['launcher'] = self.launcher
+        if protocol:
+            kw['env'] = git_env(protocol, self.launcher)
+        request = metrics.request_metrics(environ) if environ else None
+        if request:
+            kw['metrics'] = request
+        return kw
+
+    def admit(self, repo_path, service):
+        '''
+        Asks admission controller (if we have one) for a slot for running
+        git service against the repo.
+
+        Returns a callable releasing the slot (None if there is no admission
+        controller), or False if there is no slot to be had.
+        '''
+        if not self.admission:
+            return None
+        return self.admission.acquire(repo_path, service) or False
+
+    def overloaded(self, environ, start_response):
+        '''
+        Answers requests turned away by the admission controller.
+        '''
+        return self.canned_handlers(
+            environ,
+            start_response,
+            'service_unavailable',
+            [('Retry-After', str(self.admission.retry_after))]
+            )
+
+    def release_after(self, out, release):
+        '''
+        Returns out (git's output), made to call release once it's done.
+        '''
+        if isinstance(out, subprocessio.SubprocessIOFile):
+            # wrapping it would hide its fileno() from wsgi.file_wrapper.
+            out.on_close.append(release)
+            return out
+        return ClosingIterator(out, release)
 
     def has_access(self, **kw):
         '''
@@ -356,6 +1244,18 @@ class GitHTTPBackendBase(BaseWSGIClass):
         '''
         return True
 
+    def list_folder(self, path):
+        '''
+        Returns lowercased names of the entries of the folder at path (empty
+        if there is no such folder). Served by repo_index, if we have one.
+        '''
+        if self.repo_index:
+            return self.repo_index.listdir(path)
+        try:
+            return [i.lower() for i in os.listdir(path)]
+        except (EnvironmentError, ValueError):
+            return []
+
     def basic_checks(self, dataObj, environ, start_response):
         '''
         This function is shared by GitInfoRefs and SmartHTTPRPCHandler WSGI classes.
@@ -374,6 +1274,14 @@ class GitHTTPBackendBase(BaseWSGIClass):
         if git_command not in ['git-upload-pack', 'git-receive-pack']: # TODO: this is bad for future compatibility. There may be more commands supported then.
             return self.canned_handlers(environ, start_response, 'bad_request')
 
+        request = metrics.request_metrics(environ)
+        route = '%s/%s' % (self.metrics_route, git_command[4:])
+        if request:
+            request.route = route
+        profile = profiling.request_profile(environ)
+        if profile:
+            profile.route = route
+
         # TODO: Add "public" to "dynamic local" path conversion hook ups here.
 
         #############################################################
@@ -382,7 +1290,7 @@ class GitHTTPBackendBase(BaseWSGIClass):
         repo_path = os.path.abspath(
             os.path.join(
                 self.content_path,
-                (selector_matches.get('working_path') or '').decode('utf8').strip('/').strip('\\')
+                _to_unicode(selector_matches.get('working_path') or '').strip('/').strip('\\')
                 )
             )
         _pp = os.path.abspath(self.content_path)
@@ -398,11 +1306,7 @@ class GitHTTPBackendBase(BaseWSGIClass):
             ):
             return self.canned_handlers(environ, start_response, 'forbidden')
 
-        try:
-            files = os.listdir(repo_path)
-        except:
-            files = []
-        if not self.git_folder_signature.issubset([i.lower() for i in files]):
+        if not self.git_folder_signature.issubset(self.list_folder(repo_path)):
             if not ( self.repo_auto_create and git_command == 'git-receive-pack' ):
                 return self.canned_handlers(environ, start_response, 'not_found')
             else:
@@ -420,9 +1324,13 @@ class GitHTTPBackendBase(BaseWSGIClass):
                         except:
                             return self.canned_handlers(environ, start_response, 'not_found')
                         break
-                    elif not os.path.isdir(_pf) or self.git_folder_signature.issubset([i.lower() for i in os.listdir(_pf)]):
+                    elif not os.path.isdir(_pf) or self.git_folder_signature.issubset(self.list_folder(_pf)):
                         return self.canned_handlers(environ, start_response, 'forbidden')
-                if subprocess.call('git init --quiet --bare "%s"' % repo_path, shell=True):
+                failed = (self.launcher or processlauncher.get_launcher()).call(
+                    ['git', 'init', '--quiet', '--bare', repo_path])
+                if self.repo_index:
+                    self.repo_index.invalidate(repo_path)
+                if failed:
                     return self.canned_handlers(environ, start_response, 'execution_failed')
         #
         #############################################################
@@ -441,12 +1349,29 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
 
     The "right" content is special header and custom top 2 rows of data in the response.
     '''
+    metrics_route = 'info-refs'
+
     def __init__(self, **kw):
         '''
         inputs:
             content_path (Mandatory) - Local file system path = root of served files.
             bufsize (Default = 65536) Chunk size for WSGI file feeding
             gzip_response (Default = False) Compress response body
+            gzip_level (Default = 6) zlib compression level for gzip_response
+            advertisement_cache (Default = None) responsecache.AdvertisementCache instance
+            repo_index (Default = None) repoindex.RepoIndex instance
+            admission (Default = None) admission.AdmissionController instance
+            ref_advertiser (Default = None) advertisement.RefAdvertiser instance
+                making the advertisement without running git, where it can.
+                (Protocol v0 only. Version 1 and 2 ones come from git.)
+            git_protocol_passthrough (Default = True) Pass Git-Protocol
+                request header to git as GIT_PROTOCOL, letting clients speak
+                wire protocol v2. False = everybody speaks v0.
+            subprocess_chunker (Default = subprocessio.SubprocessIOChunker) Class
+                running git. subprocessio.ReactorSubprocessIOChunker runs it without
+                starting threads per request.
+            launcher (Default = None = processlauncher.get_launcher())
+                processlauncher.ProcessLauncher instance starting git.
         '''
         self.__dict__.update(kw)
 
@@ -454,7 +1379,8 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
         """WSGI Response producer for HTTP GET Git Smart HTTP /info/refs request."""
 
         dataObj = {}
-        answer = self.basic_checks(dataObj, environ, start_response)
+        with metrics.timed(environ, 'checks'):
+            answer = self.basic_checks(dataObj, environ, start_response)
         if answer:
             # non-Null answer = there was an issue in basic_checks and it's time to return an HTTP error response
             return answer
@@ -468,20 +1394,68 @@ class GitHTTPBackendInfoRefs(GitHTTPBackendBase):
         # It reads binary, per number of bytes specified.
         # if you do add '\n' as part of data, count it.
         smart_server_advert = '# service=%s' % git_command
-
+        prefix = hex(len(smart_server_advert)+4)[2:].rjust(4,'0') + smart_server_advert + '0000'
+        headers = [('Content-type','application/x-%s-advertisement' % str(git_command))]
+        if self.git_protocol_passthrough:
+            headers.append(('Vary', 'Git-Protocol'))
+
+        protocol = self.git_protocol(environ)
+        version = git_protocol_version(protocol)
+        # cached advertisements differ per protocol version.
+        cache_service = '%s v%s' % (git_command, version) if version else git_command
+        if version == 2:
+            # v2 clients get a capability advertisement straight from git,
+            # as with git-http-backend.
+            prefix = ''
+
+        cache = self.advertisement_cache
+        if cache:
+            fingerprint = responsecache.ref_state_fingerprint(repo_path)
+            cached = cache.get(repo_path, cache_service, fingerprint)
+            if cached is not None:
+                return self.package_response(
+                    [cached],
+                    environ,
+                    start_response,
+                    headers)
+
+        if self.ref_advertiser and not version:
+            if cache:
+                generation = cache.generation(repo_path)
+            refs = self.ref_advertiser.advertise(repo_path, git_command[4:])
+            if refs is not None:
+                data = prefix.encode('ascii') + refs
+                if cache:
+                    cache.put(repo_path, cache_service, fingerprint, data, generation)
+                return self.package_response(
+                    [data],
+                    environ,
+                    start_response,
+                    headers)
+
+        release = self.admit(repo_path, 'advertise-refs')
+        if release is False:
+            return self.overloaded(environ, start_response)
         try:
-            out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc --advertise-refs "%s"' % (git_command[4:], repo_path),
-                starting_values = [ str(hex(len(smart_server_advert)+4)[2:].rjust(4,'0') + smart_server_advert + '0000') ]
+            out = self.subprocess_chunker(
+                ['git', git_command[4:], '--stateless-rpc', '--advertise-refs', repo_path],
+                starting_values = [ str(prefix) ] if prefix else [],
+                **self.chunker_options(protocol, environ)
                 )
         except (EnvironmentError) as e:
+            if release:
+                release()
             environ['wsgi.errors'].write(str(e))
             return self.canned_handlers(environ, start_response, 'execution_failed')
 #        except Exception as e:
 #            environ['wsgi.errors'].write(str(e))
 #            return self.canned_handlers(environ, start_response, 'internal_server_error')
 
-        headers = [('Content-type','application/x-%s-advertisement' % str(git_command))]
+        if cache:
+            out = cache.wrap(out, repo_path, cache_service, fingerprint)
+        if release:
+            out = self.release_after(out, release)
+
         return self.package_response(
             out,
             environ,
@@ -500,6 +1474,8 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
     /repo_folder_name/info/refs (as implemented in a separate WSGI handler below)
     must reply in a specific way in order for the Git client to decide to talk here.
     '''
+    metrics_route = 'rpc'
+
     def __init__(self, **kw):
         '''
         content_path
@@ -508,9 +1484,80 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
             These include
                 bufsize (Default = 65536) Chunk size for WSGI file feeding
                 gzip_response (Default = False) Compress response body
+                    (receive-pack status reports. Packs are sent as is.)
+                gzip_level (Default = 6) zlib compression level for gzip_response
+                advertisement_cache (Default = None) responsecache.AdvertisementCache
+                    instance. Share it with GitHTTPBackendInfoRefs, so that
+                    pushes invalidate cached advertisements.
+                pack_cache (Default = None) responsecache.PackResponseCache
+                    instance caching upload-pack responses.
+                upload_pack_coalescer (Default = None) subprocessio.SubprocessIOCoalescer
+                    instance. Identical upload-pack requests running at the
+                    same time share the output of one git process.
+                repo_index (Default = None) repoindex.RepoIndex instance
+                    remembering which folders are repos.
+                request_body_peek_limit (Default = 1048576) Request bodies
+                    larger than this are neither cached nor coalesced.
+                max_gzip_request_size (Default = 104857600) Max decompressed
+                    size of gzip-encoded request bodies. None = no limit.
+                subprocess_chunker (Default = subprocessio.SubprocessIOChunker)
+                    Class running git. See GitHTTPBackendInfoRefs.
+                launcher (Default = None = processlauncher.get_launcher())
+                    processlauncher.ProcessLauncher instance starting git.
+                stdout_passthrough (Default = False) Return upload-pack
+                    output as a file-like over git's stdout pipe (through
+                    wsgi.file_wrapper, when the server offers one).
+                maintenance (Default = None) maintenance.MaintenanceScheduler
+                    instance running update-server-info (and repacking etc.)
+                    after pushes in the background. Without it,
+                    update-server-info runs on the request thread.
+                admission (Default = None) admission.AdmissionController
+                    instance limiting the number of git processes. Share it
+                    with GitHTTPBackendInfoRefs.
+                git_protocol_passthrough (Default = True) Pass Git-Protocol
+                    request header to git as GIT_PROTOCOL. Must be the same
+                    as that of GitHTTPBackendInfoRefs.
         '''
         self.__dict__.update(kw)
 
+    def peek_request_body(self, stdin, limit):
+        '''
+        Reads up to limit bytes of request body.
+
+        Returns a tuple of (body, stdin), where body is the whole request body
+        (a string) or None if the body is larger than limit. The returned stdin
+        is to be used in place of the one passed in, as part of it may have
+        been consumed.
+        '''
+        if isinstance(stdin, bytes):
+            if len(stdin) > limit:
+                return None, stdin
+            return stdin, stdin
+        chunks = []
+        size = 0
+        while size <= limit:
+            chunk = stdin.read(min(self.bufsize, limit + 1 - size))
+            if not chunk:
+                body = b''.join(chunks)
+                # empty string would make SubprocessIOChunker skip stdin feeding.
+                return body, body or io.BytesIO()
+            chunks.append(chunk)
+            size += len(chunk)
+        return None, PrefixedReader(b''.join(chunks), stdin)
+
+    def after_push(self, repo_path):
+        '''
+        Work to do once a push to the repo is done (git consumed the pushed
+        data and updated the refs.)
+        '''
+        if self.advertisement_cache:
+            self.advertisement_cache.invalidate(repo_path)
+        # updating refs manually after each push. Needed for pre-1.7.0.4 git clients using regular HTTP mode.
+        if self.maintenance:
+            self.maintenance.after_push(repo_path)
+        else:
+            maintenance.update_server_info(repo_path, self.launcher)
+
     def __call__(self, environ, start_response):
         """
         WSGI Response producer for HTTP POST Git Smart HTTP requests.
@@ -522,7 +1569,8 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
         # 3. prepare OUT content (encoding, header)
 
         dataObj = {}
-        answer = self.basic_checks(dataObj, environ, start_response)
+        with metrics.timed(environ, 'checks'):
+            answer = self.basic_checks(dataObj, environ, start_response)
         if answer:
             # this is a WSGI "trick". basic_checks have already prepared the headers,
             # and a response body (which is the 'answer') returned here.
@@ -567,21 +1615,97 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
             # This usually happens when git client asks for "clone" or "fetch" by giving a list
             # of hashes to send to it. That list is binary text and Git's HTTP client code compresses it by hand.
             # If our server did not transparently decode the body yet (and removed the HTTP_ACCEPT_ENCODING)
-            # we will do it manually:
+            # we will do it manually, as git consumes it:
             if environ.get('HTTP_CONTENT_ENCODING','') in ['gzip', 'x-gzip']:
-                # since we have decoded it, it's no longer true.
-                # del environ['HTTP_CONTENT_ENCODING']
-                tmpfile = StringIO.StringIO(stdin.read())
-                stdin = gzip.GzipFile(fileobj = tmpfile).read()
-                tmpfile.close()
-                del tmpfile
-                # environ['wsgi.errors'].write('stdin is "%s"\n' % stdin)
-                # environ['CONTENT_LENGTH'] = str(len(stdin))
-
-            out = subprocessio.SubprocessIOChunker(
-                r'git %s --stateless-rpc "%s"' % (git_command[4:], repo_path),
-                inputstream = stdin
-                )
+                stdin = GzipDecodingReader(stdin, self.max_gzip_request_size, self.bufsize)
+
+            headers = [('Content-type', 'application/x-%s-result' % str(git_command))]
+            cmd = ['git', git_command[4:], '--stateless-rpc', repo_path]
+            # protocol v2 requests are commands (ls-refs, fetch), which git
+            # understands only when told the protocol version.
+            protocol = self.git_protocol(environ)
+            kw = self.chunker_options(protocol, environ)
+
+            body = None
+            if git_command == 'git-upload-pack' and (self.pack_cache or self.upload_pack_coalescer):
+                body, stdin = self.peek_request_body(stdin, self.request_body_peek_limit)
+
+            flight_key = None
+            if body and self.upload_pack_coalescer:
+                # identical request running right now? Share its output.
+                flight_key = hashlib.sha1(
+                    repo_path.encode('utf8') + b'\0' + (protocol or '').encode('ascii') + b'\0' + body
+                    ).hexdigest()
+                joined = self.upload_pack_coalescer.join(flight_key)
+                if joined is not None:
+                    return self.package_response(joined, environ, start_response, headers)
+
+            cache_key = None
+            if body and self.pack_cache and len(body) <= self.pack_cache.max_request_bytes:
+                cache = self.pack_cache
+                normalized = responsecache.normalize_upload_pack_request(body, git_protocol_version(protocol))
+                if normalized:
+                    cache_key = cache.key(
+                        repo_path,
+                        responsecache.ref_state_fingerprint(repo_path),
+                        normalized
+                        )
+                    cached = cache.get(cache_key)
+                    if cached is None:
+                        if cache.lock(cache_key):
+                            # someone could have filled it between our .get() and .lock()
+                            cached = cache.get(cache_key)
+                            if cached is not None:
+                                cache.unlock(cache_key)
+                        else:
+                            # other worker is generating this very response. Waiting for it.
+                            cached = cache.wait(cache_key)
+                            cache_key = None
+                    if cached is not None:
+                        return self.package_response(cached, environ, start_response, headers)
+
+            release = self.admit(repo_path, git_command[4:])
+            if release is False:
+                if cache_key:
+                    self.pack_cache.unlock(cache_key)
+                return self.overloaded(environ, start_response)
+            try:
+                if flight_key:
+                    # the slot is held for as long as the shared git process
+                    # runs, not just for as long as we read its output.
+                    out = self.upload_pack_coalescer.run(flight_key, cmd, stdin, on_done = release, **kw)
+                    release = None
+                elif (self.stdout_passthrough and not cache_key
+                        and git_command == 'git-upload-pack'
+                        and issubclass(self.subprocess_chunker, subprocessio.SubprocessIOChunker)):
+                    # pack data goes from git's stdout to the client without passing through
+                    # our buffers, or, with a capable server, without passing through Python.
+                    out = self.subprocess_chunker(
+                        cmd,
+                        inputstream = stdin,
+                        chunk_size = self.bufsize,
+                        passthrough = True,
+                        **kw
+                        ).output
+                else:
+                    out = self.subprocess_chunker(
+                        cmd,
+                        inputstream = stdin,
+                        **kw
+                        )
+            except:
+                if cache_key:
+                    self.pack_cache.unlock(cache_key)
+                if release:
+                    release()
+                raise
+            if cache_key:
+                out = self.pack_cache.fill(cache_key, out)
+            if release:
+                out = self.release_after(out, release)
+        except (RequestBodyTooLarge) as e:
+            environ['wsgi.errors'].write(str(e))
+            return self.canned_handlers(environ, start_response, 'request_too_large')
         except (EnvironmentError) as e:
             environ['wsgi.errors'].write(str(e))
             return self.canned_handlers(environ, start_response, 'execution_failed')
@@ -590,10 +1714,10 @@ class GitHTTPBackendSmartHTTP(GitHTTPBackendBase):
             raise e
 
         if git_command == u'git-receive-pack':
-            # updating refs manually after each push. Needed for pre-1.7.0.4 git clients using regular HTTP mode.
-            subprocess.call(u'git --git-dir "%s" update-server-info' % repo_path, shell=True)
+            # refs are updated by git as it consumes the push, so the work
+            # depending on them is done only once the output is done.
+            out = ClosingIterator(out, lambda: self.after_push(repo_path))
 
-        headers = [('Content-type', 'application/x-%s-result' % git_command.encode('utf8'))]
         return self.package_response(
             out,
             environ,
@@ -622,6 +1746,130 @@ def assemble_WSGI_git_app(*args, **kw):
         Default of '' means that no cutting marker is used, and whole URI after FQDN is
         used to find file relative to content_path.
 
+    gzip_response (Defaults to False)
+        Compresses responses (gzip or deflate, per client's Accept-Encoding)
+        as they are streamed. Worth it for /info/refs advertisements of repos
+        with many refs and dumb HTTP text files. Content that is compressed
+        already (packs, loose objects, upload-pack results) is sent as is.
+
+    gzip_level (Defaults to 6)
+        zlib compression level for gzip_response, 1 (fastest) to 9 (smallest).
+
+    gzip_window_bits (Defaults to 15)
+        Compression window for gzip_response, 9 to 15. The compressor takes
+        2**(window_bits+2) bytes plus 128KB of memory per response.
+
+    advertisement_cache (Defaults to None)
+        A responsecache.AdvertisementCache instance. When given, responses to
+        /info/refs calls are cached until the refs of the repo change.
+
+    repo_index (Defaults to None)
+        A repoindex.RepoIndex instance. When given, the contents of repo
+        folders (checked on every request for being git repos) are remembered
+        instead of listed every time. Worth it on network file systems.
+
+    file_cache (Defaults to None)
+        A filecache.FileCache instance. When given, metadata of files served
+        over "dumb" HTTP is remembered, and files of git objects and packs
+        (which never change) are kept open and shared between requests.
+
+    cache_control (Defaults to StaticWSGIServer.cache_control)
+        List of (compiled regex, Cache-Control value) pairs for files served
+        over "dumb" HTTP. First regex found in the path picks the value.
+
+    pack_cache (Defaults to None)
+        A responsecache.PackResponseCache instance. When given, packs sent
+        in response to upload-pack requests are cached on disk and reused
+        for identical requests until the refs of the repo change.
+
+    upload_pack_coalescer (Defaults to None)
+        A subprocessio.SubprocessIOCoalescer instance. When given, identical
+        upload-pack requests arriving while one is being answered are served
+        from the output of the git process already running. That git
+        process keeps its admission slot until it exits.
+
+    max_gzip_request_size (Defaults to 104857600)
+        Gzip-encoded request bodies are decompressed as git reads them.
+        Bodies decompressing to more than this many bytes are cut off
+        (None = no limit).
+
+    stdout_passthrough (Defaults to False)
+        Hands git's stdout pipe (as subprocessio.SubprocessIOFile) over to the
+        WSGI server's wsgi.file_wrapper for upload-pack (fetch, clone)
+        responses, so that a server able to use sendfile()/splice() on it
+        (see simpleserver.py) moves pack data without copying it through
+        Python. Not used for responses filling pack_cache or shared through
+        upload_pack_coalescer, nor with other than the default subprocess_chunker.
+
+    ref_advertiser (Defaults to None)
+        An advertisement.RefAdvertiser instance. When given, /info/refs
+        responses are made by reading the refs (in Python) instead of
+        running git, except for repos (with extensions, alternates, hidden
+        refs etc.) only git knows how to advertise, and for versions of git
+        it was not checked against. Make it with the launcher given here.
+
+    git_protocol_passthrough (Defaults to True)
+        Git-Protocol request header is passed to git as GIT_PROTOCOL, same
+        as git-http-backend does, so that clients asking for wire protocol
+        v2 get it. In v2, /info/refs returns capabilities only and clients
+        ask for the refs they need (ls-refs command, with ref prefixes),
+        instead of getting all refs of the repo up front. Set to False to
+        make everybody speak protocol v0.
+
+    admission (Defaults to None)
+        An admission.AdmissionController instance. When given, the number
+        of git processes running at a time is limited (in total, per repo
+        and per service). Requests wait for their turn, /info/refs ones
+        first, and are answered with "503 Service Unavailable" (and
+        Retry-After header) when the wait is too long or the line too long.
+
+    maintenance (Defaults to None)
+        A maintenance.MaintenanceScheduler instance. When given, git
+        update-server-info runs after pushes on the scheduler's threads,
+        once per burst of pushes to a repo, instead of once per push on the
+        request thread. The scheduler also repacks pushed-to repos and
+        writes bitmaps, commit-graphs and multi-pack-indexes as needed.
+        Packs it deletes are dropped from file_cache.
+
+    subprocess_chunker (Defaults to subprocessio.SubprocessIOChunker)
+        The class running git subprocesses and streaming their output.
+        SubprocessIOChunker uses three threads per subprocess.
+        subprocessio.ReactorSubprocessIOChunker multiplexes the pipes of all
+        subprocesses in one (epoll-based) thread instead. (When using both
+        this and upload_pack_coalescer, give the same class to the coalescer.)
+
+    launcher (Defaults to None = processlauncher.get_launcher())
+        A processlauncher.ProcessLauncher instance starting git processes.
+        git runs without a shell in between, as found on PATH once, with a
+        small environment (see ProcessLauncher.env_keep) and none of our
+        file descriptors. The default processlauncher.SpawnLauncher uses
+        posix_spawn() where glibc allows. Give a launcher of your own to pick
+        git binary (executables = {'git': path}) or the environment.
+
+    metrics (Defaults to None)
+        A metrics.Metrics instance. When given, requests are metered: time
+        spent routing, checking, starting git, to the first byte and in
+        total (per route), bytes in and out, git processes running and the
+        CPU time and memory they take, and stalls on full output buffers.
+
+    metrics_path (Defaults to None = metrics are not served)
+        URI path (matched as is, no uri_marker) at which metrics are served
+        in Prometheus' text format, when metrics is given, say '/metrics'.
+        Metrics are labeled by route name (see metrics.py), phase, status code
+        and CPU mode only, no repo paths or users, but tell the traffic and
+        load of the server and are served without any access checks, so
+        limit access to it in the server if that matters. (Or mount the
+        metrics.Metrics instance, a WSGI app, yourself.)
+
+    profiler (Defaults to None)
+        A profiling.RequestProfiler instance. Requests it picks (a sampled
+        fraction, and those carrying its header with its secret token) are
+        profiled, from routing to the end of the response body's iteration,
+        into its directory, named after route and repo.
+
+    Any other named argument is passed on to (and overrides same-named
+    attributes of) the handler classes.
+
     returns WSGI application instance.
     '''
 
@@ -636,10 +1884,18 @@ def assemble_WSGI_git_app(*args, **kw):
         _d = default_options.pop(0)
         _a = args.pop(0)
         options[_d[0]] = _a
-    options['content_path'] = os.path.abspath(options['content_path'].decode('utf8'))
-    options['uri_marker'] = options['uri_marker'].decode('utf8')
+    options['content_path'] = os.path.abspath(_to_unicode(options['content_path']))
+    options['uri_marker'] = _to_unicode(options['uri_marker'])
+
+    scheduler = options.get('maintenance')
+    if scheduler and options.get('file_cache') and scheduler.file_cache is None:
+        # packs deleted by repacking are not to be kept open.
+        scheduler.file_cache = options['file_cache']
 
-    selector = WSGIHandlerSelector()
+    selector = WSGIHandlerSelector(
+        metrics = options.get('metrics'),
+        profiler = options.get('profiler')
+        )
     generic_handler = StaticWSGIServer(**options)
     git_inforefs_handler = GitHTTPBackendInfoRefs(**options)
     git_rpc_handler = GitHTTPBackendSmartHTTP(**options)
@@ -649,6 +1905,13 @@ def assemble_WSGI_git_app(*args, **kw):
     else:
         marker_regex = ''
 
+    metrics_path = options.get('metrics_path')
+    if selector.metrics and metrics_path:
+        selector.add(
+            '^' + re.escape(_to_unicode(metrics_path)) + '$',
+            GET = selector.metrics,
+            HEAD = selector.metrics
+            )
     selector.add(
         marker_regex + r'(?P<working_path>.*?)/info/refs\?.*?service=(?P<git_command>git-[^&]+).*$',
         GET = git_inforefs_handler,
@@ -717,6 +1980,13 @@ Options:
 
 --port (Defaults to 8080)
 
+--server (Defaults to 'cherrypy')
+	WSGI server to run. 'cherrypy' or 'simple'. The latter is the
+	wsgiref-based server in simpleserver.py, which needs nothing outside
+	of Python's standard library. On Linux it sends clone and fetch
+	responses from git's output straight to the client socket with
+	splice(), without copying pack data through Python.
+
 Examples:
 
 cd c:\myproject_workingfolder\.git
@@ -753,7 +2023,8 @@ c:\tools\git_http_backend\GitHttpBackend.py
     command_options = {
             'content_path' : '.',
             'uri_marker' : '',
-            'port' : '8080'
+            'port' : '8080',
+            'server' : 'cherrypy'
         }
     lastKey = None
     for item in sys.argv:
@@ -767,19 +2038,27 @@ c:\tools\git_http_backend\GitHttpBackend.py
     content_path = os.path.abspath( command_options['content_path'] )
 
     if 'help' in command_options:
-        print _help
+        print(_help)
     else:
+        use_simple_server = command_options['server'] == 'simple'
         app = assemble_WSGI_git_app(
             content_path = content_path,
             uri_marker = command_options['uri_marker'],
             performance_settings = {
                 'repo_auto_create':True
-                }
+                },
+            stdout_passthrough = use_simple_server
         )
 
-        # default Python's WSGI server. Replace with your choice of WSGI server
-        import cherrypy as wsgiserver
-        httpd = wsgiserver.CherryPyWSGIServer(('0.0.0.0',int(command_options['port'])),app)
+        if use_simple_server:
+            import simpleserver
+            httpd = simpleserver.make_server('0.0.0.0', int(command_options['port']), app)
+            httpd.start = httpd.serve_forever
+            httpd.stop = httpd.server_close
+        else:
+            # default Python's WSGI server. Replace with your choice of WSGI server
+            import cherrypy as wsgiserver
+            httpd = wsgiserver.CherryPyWSGIServer(('0.0.0.0',int(command_options['port'])),app)
 
         if command_options['uri_marker']:
             _s = '"/%s/".' % command_options['uri_marker']
@@ -791,7 +2070,7 @@ c:\tools\git_http_backend\GitHttpBackend.py
         else:
             _s = 'not chosen.'
             example_URI = 'http://localhost:%s/myrepo.git' % (command_options['port'])
-        print '''
+        print('''
 ===========================================================================
 Run this command with "--help" option to see available command-line options
 
@@ -805,7 +2084,7 @@ Example repo url would be:
 
 Use Keyboard Interrupt key combination (usually CTRL+C) to stop the server
 ===========================================================================
-''' % (command_options['port'], content_path, _s, example_URI)
+''' % (command_options['port'], content_path, _s, example_URI))
 
         try:
             httpd.start()
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+'''
+Module provides an ASGI application serving the same content and following
+the same rules as the WSGI application assembled by
+git_http_backend.assemble_WSGI_git_app.
+
+The WSGI application dedicates a server thread (and three more threads in
+subprocessio) to every request for as long as git runs. Here git processes
+are driven through asyncio.create_subprocess_exec and request and response
+bodies are streamed by the event loop, so one process can hold many
+concurrent long-running fetches without a thread per request.
+
+Routing (WSGIHandlerSelector.select) and repo checks (basic_checks) are
+those of git_http_backend. Requests for static content are handed to
+the StaticWSGIServer WSGI app, run (along with iteration of the response
+body) on threads of the loop's executor, as reading files may block for
+long enough (cold cache, NFS) to stall every connection. So are repo checks,
+advertisement cache lookups and advertisement.RefAdvertiser.
+
+This module requires Python 3.7 or newer.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import io
+import sys
+import zlib
+import asyncio
+from wsgiref.headers import Headers
+
+import git_http_backend
+import processlauncher
+import responsecache
+
+class StartResponse(object):
+    '''
+    Stand-in for WSGI's start_response. Captures status and headers set
+    by WSGI-style code (canned_handlers, basic_checks, StaticWSGIServer).
+    '''
+    def __init__(self):
+        self.status = '500 Internal Server Error'
+        self.headers = []
+
+    def __call__(self, status, headers, exc_info = None):
+        self.status = status
+        self.headers = headers
+
+def scope_to_environ(scope):
+    '''
+    Converts ASGI HTTP connection scope into WSGI-like environ dict, good
+    enough for the routing and checking code of git_http_backend.
+    '''
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope.get('path', ''),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'asgi.scope': scope
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+class ASGIGitApp(object):
+    '''
+    ASGI application wrapping a WSGIHandlerSelector (as returned by
+    git_http_backend.assemble_WSGI_git_app) and the handlers registered
+    with it.
+
+    Git Smart HTTP handlers (GitHTTPBackendInfoRefs, GitHTTPBackendSmartHTTP)
+    are replaced by asyncio-based equivalents. Their configuration
+    (content_path, repo_auto_create, advertisement_cache, has_access()
+    etc.) is honored. Other handlers are called as WSGI apps.
+    '''
+    chunk_size = 65536
+
+    def __init__(self, selector, **kw):
+        '''
+        Inputs:
+            selector (mandatory) A WSGIHandlerSelector instance.
+            chunk_size (Default = 65536) Max size of a chunk of response body.
+        '''
+        self.selector = selector
+        self.__dict__.update(kw)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type "%s"' % scope['type'])
+
+        environ = scope_to_environ(scope)
+        handler, matches, alternate_HTTP_verbs, path = self.selector.select(
+            environ['PATH_INFO'],
+            environ['REQUEST_METHOD'],
+            environ['QUERY_STRING']
+            )
+        if handler:
+            environ['PATH_INFO'] = path
+            environ['wsgiorg.routing_args'] = (list(matches.groups()), matches.groupdict())
+            if isinstance(handler, git_http_backend.GitHTTPBackendInfoRefs):
+                await self.info_refs(handler, environ, send)
+            elif isinstance(handler, git_http_backend.GitHTTPBackendSmartHTTP):
+                await self.rpc(handler, environ, receive, send)
+            else:
+                # WSGI apps, StaticWSGIServer mostly. stat(), open(), read()
+                # may block.
+                start_response = StartResponse()
+                body = await asyncio.get_running_loop().run_in_executor(None, handler, environ, start_response)
+                await self.send_response(send, start_response.status, start_response.headers, body, blocking = True)
+        elif alternate_HTTP_verbs:
+            await self.canned(
+                environ,
+                send,
+                'method_not_allowed',
+                headers = [('Allow', ', '.join(alternate_HTTP_verbs))]
+                )
+        else:
+            await self.canned(environ, send, 'not_found')
+
+    ####################
+    # Response plumbing
+    ####################
+
+    async def send_response(self, send, status, headers, body = (), blocking = False):
+        '''
+        Sends the response. blocking = iterating over body (not a list) may
+        block, so it is done on the loop's executor.
+        '''
+        blocking = blocking and not isinstance(body, (list, tuple))
+        loop = asyncio.get_running_loop()
+        chunks = iter(body)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(k.encode('latin-1'), str(v).encode('latin-1')) for k, v in headers]
+            })
+        try:
+            while True:
+                if blocking:
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                else:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('latin-1')
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def canned(self, environ, send, code, headers = []):
+        start_response = StartResponse()
+        body = self.selector.canned_handlers(environ, start_response, code, headers)
+        await self.send_response(send, start_response.status, start_response.headers, body)
+
+    async def admit(self, handler, environ, send, repo_path, service):
+        '''
+        Gets a slot for running git from handler.admission (waiting for it in
+        the controller's queue, without taking up a thread, if need be.)
+
+        Returns a callable releasing the slot, None if there is no admission
+        controller, or False if "503 Service Unavailable" was sent.
+        '''
+        admission = handler.admission
+        if not admission:
+            return None
+        if admission.timeout:
+            release = await self.wait_for_slot(admission, repo_path, service)
+        else:
+            release = admission.acquire(repo_path, service)
+        if release is None:
+            await self.canned(
+                environ,
+                send,
+                'service_unavailable',
+                headers = [('Retry-After', str(admission.retry_after))]
+                )
+            return False
+        return release
+
+    async def wait_for_slot(self, admission, repo_path, service):
+        '''
+        Waits up to admission.timeout seconds for a slot. Returns a callable
+        releasing it, or None if there is none to be had.
+        '''
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+        def set_admitted():
+            if not admitted.done():
+                admitted.set_result(True)
+        def notify():
+            # called from whatever thread releases the slot.
+            try:
+                loop.call_soon_threadsafe(set_admitted)
+            except RuntimeError:
+                # loop is closed. Nobody is waiting any more.
+                pass
+        waiter = admission.enqueue(repo_path, service, notify)
+        if waiter is None:
+            return None
+        try:
+            await asyncio.wait_for(admitted, admission.timeout)
+        except asyncio.TimeoutError:
+            if admission.withdraw(waiter, timed_out = True):
+                return None
+        except BaseException:
+            # cancelled (client went away.) The slot may have come anyway.
+            if not admission.withdraw(waiter):
+                admission.releaser(waiter)()
+            raise
+        return admission.releaser(waiter)
+
+    async def checks(self, handler, environ, send):
+        '''
+        Runs handler.basic_checks(). Returns dataObj on success or None if
+        an error response was sent.
+        '''
+        dataObj = {}
+        start_response = StartResponse()
+        # listdir(), stat() and, for repos created on the fly, git init.
+        answer = await asyncio.get_running_loop().run_in_executor(
+            None, handler.basic_checks, dataObj, environ, start_response)
+        if answer:
+            await self.send_response(send, start_response.status, start_response.headers, answer)
+            return None
+        return dataObj
+
+    ####################
+    # Git Smart HTTP
+    ####################
+
+    async def info_refs(self, handler, environ, send):
+        dataObj = await self.checks(handler, environ, send)
+        if dataObj is None:
+            return
+        git_command = dataObj['git_command']
+        repo_path = dataObj['repo_path']
+
+        smart_server_advert = '# service=%s' % git_command
+        prefix = (hex(len(smart_server_advert) + 4)[2:].rjust(4, '0') + smart_server_advert + '0000').encode('ascii')
+        headers = [('Content-type', 'application/x-%s-advertisement' % git_command)]
+        if handler.git_protocol_passthrough:
+            headers.append(('Vary', 'Git-Protocol'))
+        encoding = handler.response_encoding(environ, Headers(headers))
+
+        protocol = handler.git_protocol(environ)
+        version = git_http_backend.git_protocol_version(protocol)
+        cache_service = '%s v%s' % (git_command, version) if version else git_command
+        if version == 2:
+            prefix = b''
+
+        # refs, packs and cache files are read off the event loop.
+        loop = asyncio.get_running_loop()
+        cache = handler.advertisement_cache
+        on_complete = None
+        if cache:
+            fingerprint = await loop.run_in_executor(None, responsecache.ref_state_fingerprint, repo_path)
+            cached = await loop.run_in_executor(None, cache.get, repo_path, cache_service, fingerprint)
+            if cached is not None:
+                body = [cached]
+                if encoding:
+                    body = git_http_backend.CompressingIterator(
+                        body, encoding, handler.gzip_level, handler.gzip_window_bits)
+                await self.send_response(send, '200 OK', headers, body)
+                return
+            generation = cache.generation(repo_path)
+            def on_complete(data):
+                cache.put(repo_path, cache_service, fingerprint, data, generation)
+
+        if handler.ref_advertiser and not version:
+            refs = await loop.run_in_executor(None, handler.ref_advertiser.advertise, repo_path, git_command[4:])
+            if refs is not None:
+                if on_complete:
+                    await loop.run_in_executor(None, on_complete, prefix + refs)
+                body = [prefix + refs]
+                if encoding:
+                    body = git_http_backend.CompressingIterator(
+                        body, encoding, handler.gzip_level, handler.gzip_window_bits)
+                await self.send_response(send, '200 OK', headers, body)
+                return
+
+        release = await self.admit(handler, environ, send, repo_path, 'advertise-refs')
+        if release is False:
+            return
+        try:
+            await self.run_git(
+                environ,
+                send,
+                ['git', git_command[4:], '--stateless-rpc', '--advertise-refs', repo_path],
+                headers,
+                prefix = prefix,
+                on_complete = on_complete,
+                compressor = self.compressor(handler, encoding),
+                env = git_http_backend.git_env(protocol, handler.launcher),
+                launcher = handler.launcher
+                )
+        finally:
+            if release:
+                release()
+
+    async def rpc(self, handler, environ, receive, send):
+        dataObj = await self.checks(handler, environ, send)
+        if dataObj is None:
+            return
+        git_command = dataObj['git_command']
+        repo_path = dataObj['repo_path']
+
+        headers = [('Content-type', 'application/x-%s-result' % git_command)]
+        encoding = handler.response_encoding(environ, Headers(headers))
+        release = await self.admit(handler, environ, send, repo_path, git_command[4:])
+        if release is False:
+            return
+        try:
+            ok = await self.run_git(
+                environ,
+                send,
+                ['git', git_command[4:], '--stateless-rpc', repo_path],
+                headers,
+                compressor = self.compressor(handler, encoding),
+                receive = receive,
+                gzipped = environ.get('HTTP_CONTENT_ENCODING', '') in ['gzip', 'x-gzip'],
+                max_gzip_size = handler.max_gzip_request_size,
+                env = git_http_backend.git_env(handler.git_protocol(environ), handler.launcher),
+                launcher = handler.launcher
+                )
+        finally:
+            if release:
+                release()
+        if ok and git_command == 'git-receive-pack':
+            if handler.advertisement_cache:
+                handler.advertisement_cache.invalidate(repo_path)
+            # updating refs manually after each push. Needed for pre-1.7.0.4 git clients using regular HTTP mode.
+            if handler.maintenance:
+                handler.maintenance.after_push(repo_path)
+                return
+            launcher = handler.launcher or processlauncher.get_launcher()
+            process = await asyncio.create_subprocess_exec(
+                *launcher.argv(['git', '--git-dir', repo_path, 'update-server-info']),
+                env = launcher.env,
+                stdin = asyncio.subprocess.DEVNULL,
+                stdout = asyncio.subprocess.DEVNULL,
+                stderr = asyncio.subprocess.DEVNULL
+                )
+            await process.wait()
+
+    def compressor(self, handler, encoding):
+        '''
+        Returns zlib compression object for the Content-Encoding negotiated
+        by handler.response_encoding(), or None for uncompressed responses.
+        '''
+        if not encoding:
+            return None
+        return git_http_backend.response_compressor(
+            encoding, handler.gzip_level, handler.gzip_window_bits)
+
+    async def feed(self, stdin, receive, gzipped = False, max_gzip_size = None):
+        '''
+        Pipes request body into git's stdin, decompressing it on the fly when needed.
+        Decompressed body is cut off after max_gzip_size bytes, raising
+        RequestBodyTooLarge (once git's stdin is closed.)
+        '''
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+        size = 0
+        try:
+            while True:
+                message = await receive()
+                if message['type'] != 'http.request':
+                    break
+                data = message.get('body', b'')
+                while decoder and data:
+                    # max_length keeps one chunk from inflating into gigabytes.
+                    chunk = decoder.decompress(data, self.chunk_size)
+                    data = decoder.unconsumed_tail
+                    size += len(chunk)
+                    if max_gzip_size is not None and size > max_gzip_size:
+                        raise git_http_backend.RequestBodyTooLarge(
+                            'Decompressed request body is larger than %s bytes' % max_gzip_size)
+                    stdin.write(chunk)
+                    await stdin.drain()
+                if data:
+                    stdin.write(data)
+                    await stdin.drain()
+                if not message.get('more_body'):
+                    break
+            if decoder:
+                stdin.write(decoder.flush())
+        except (BrokenPipeError, ConnectionResetError, zlib.error):
+            # git sees the input cut short and fails.
+            pass
+        finally:
+            stdin.close()
+
+    async def read_errors(self, stream, limit = 16000):
+        '''
+        Reads git's error output to the end. Returns the last limit bytes of
+        it (same as subprocessio keeps.)
+        '''
+        tail = b''
+        while True:
+            chunk = await stream.read(self.chunk_size)
+            if not chunk:
+                return tail
+            tail = (tail + chunk)[-limit:]
+
+    async def run_git(self, environ, send, args, headers, prefix = b'', receive = None,
+            gzipped = False, max_gzip_size = None, on_complete = None, compressor = None, env = None, launcher = None):
+        '''
+        Runs git, streaming its output as the response body (compressed by
+        compressor, a zlib compression object, if given.)
+
+        Same as with SubprocessIOChunker, we decide if git failed by the
+        time first output shows up. If git exits with an error before
+        producing any output, "417 Execution failed" is sent.
+
+        launcher (Default: processlauncher.get_launcher()) finds git (args[0])
+        and gives the environment, unless env is given. asyncio starts git.
+
+        @return True if git ran to completion without errors.
+        '''
+        launcher = launcher or processlauncher.get_launcher()
+        process = await asyncio.create_subprocess_exec(
+            *launcher.argv(args),
+            stdin = asyncio.subprocess.PIPE if receive else asyncio.subprocess.DEVNULL,
+            stdout = asyncio.subprocess.PIPE,
+            stderr = asyncio.subprocess.PIPE,
+            env = launcher.env if env is None else env
+            )
+        feeding = None
+        if receive:
+            feeding = asyncio.ensure_future(self.feed(process.stdin, receive, gzipped, max_gzip_size))
+        errors = asyncio.ensure_future(self.read_errors(process.stderr))
+        recorded = [] if on_complete else None
+        try:
+            chunk = await process.stdout.read(self.chunk_size)
+            if not chunk and await process.wait():
+                environ['wsgi.errors'].write(
+                    "Subprocess exited due to an error.\n" + (await errors).decode('utf8', 'replace'))
+                # (feeding is done by the time git sees its input end.)
+                if feeding and feeding.done() and not feeding.cancelled() \
+                        and isinstance(feeding.exception(), git_http_backend.RequestBodyTooLarge):
+                    environ['wsgi.errors'].write(str(feeding.exception()))
+                    await self.canned(environ, send, 'request_too_large')
+                else:
+                    await self.canned(environ, send, 'execution_failed')
+                return False
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+                })
+            chunk = prefix + chunk
+            while chunk:
+                data = compressor.compress(chunk) if compressor else chunk
+                if data:
+                    await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+                if recorded is not None:
+                    recorded.append(chunk)
+                chunk = await process.stdout.read(self.chunk_size)
+            await send({
+                'type': 'http.response.body',
+                'body': compressor.flush() if compressor else b'',
+                'more_body': False
+                })
+            if await process.wait():
+                environ['wsgi.errors'].write(
+                    "Subprocess exited due to an error:\n" + (await errors).decode('utf8', 'replace'))
+                return False
+            if on_complete:
+                await asyncio.get_running_loop().run_in_executor(None, on_complete, b''.join(recorded))
+            return True
+        finally:
+            if process.returncode is None:
+                # client went away, or we did.
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+            if feeding and not feeding.done():
+                feeding.cancel()
+            elif feeding and not feeding.cancelled():
+                # retrieved, so that it is not reported as never retrieved.
+                feeding.exception()
+            if not errors.done():
+                errors.cancel()
+
+def assemble_ASGI_git_app(*args, **kw):
+    '''
+    Assembles ASGI application providing functionality of git-http-backend.
+
+    Takes the same arguments as git_http_backend.assemble_WSGI_git_app.
+    Note that pack_cache and upload_pack_coalescer are not used by the
+    asyncio engine.
+
+    returns ASGI application instance.
+    '''
+    return ASGIGitApp(git_http_backend.assemble_WSGI_git_app(*args, **kw))
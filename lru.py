@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+'''
+Module provides LRU, the ordered dict behind the caches of git_http_backend
+(route cache of WSGIHandlerSelector, responsecache, filecache, repoindex.)
+
+Entries are kept from the least to the most recently used. Callers do their
+own locking and decide when to drop entries (by count or by size.)
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from collections import OrderedDict
+
+class LRU(OrderedDict):
+    '''
+    OrderedDict kept in least to most recently used order.
+    '''
+    def touch(self, key):
+        '''
+        Marks the entry most recently used. Returns the entry or None if
+        there is none.
+        '''
+        entry = self.get(key)
+        if entry is None:
+            return None
+        if hasattr(self, 'move_to_end'):
+            # Python 3.2+
+            self.move_to_end(key)
+        else:
+            del self[key]
+            self[key] = entry
+        return entry
+
+    def add(self, key, value):
+        '''
+        Stores the entry as the most recently used one. Returns the entry it
+        replaced or None.
+        '''
+        old = self.pop(key, None)
+        self[key] = value
+        return old
+
+    def trim(self, max_entries):
+        '''
+        Drops least recently used entries beyond max_entries. Returns a list
+        of dropped (key, entry) tuples.
+        '''
+        dropped = []
+        while len(self) > max_entries:
+            dropped.append(self.popitem(last = False))
+        return dropped
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+'''
+Module provides a scheduler of housekeeping jobs git_http_backend runs on
+repos after pushes:
+- git update-server-info, needed by "dumb" HTTP clients.
+- "maintenance": repos receiving pushes only pile up small packs (one per
+  push) and loose objects, and never get reachability bitmaps or
+  commit-graphs, all of which make upload-pack (fetch, clone) slower.
+  Per counts of packs and loose objects, the job runs:
+    git repack -a -d -b (one pack, with bitmap), when there are too many
+        packs or loose objects,
+    git multi-pack-index write --bitmap, when there are a few packs,
+    git commit-graph write --reachable, after repacking or when there is
+        no commit-graph.
+  Maintenance of a repo is done at most once per min_interval seconds, by
+  at most max_heavy_jobs jobs at a time, with git's CPU priority lowered
+  (nice) and pack.threads limited. .status() tells what was done and what
+  is waiting. Packs it deletes are dropped from file_cache (a
+  filecache.FileCache), which would keep them open otherwise.
+
+Jobs run on threads of the scheduler, not on request threads, and only once
+the push is done (git consumed the pushed data and updated the refs.)
+Bursts of pushes to one repo make one run of the job: a job is run debounce
+seconds after the last request for it (but no later than max_delay seconds
+after the first one). Requests for a job that is running already make it
+run once more when it is done. At most max_workers jobs run at a time, and
+besides them, on threads of their own, max_heavy_jobs "maintenance" ones (see
+MaintenanceScheduler.heavy), so that a long repack does not hold up
+update-server-info, leaving "dumb" HTTP clients with stale info/refs.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import time
+import threading
+import processlauncher
+
+def run_git(repo_path, *args, **kw):
+    '''
+    Runs git command (args) against the repo. Returns git's exit code.
+
+    Named argument nice (Default: 0) is added to git's niceness (POSIX only),
+    launcher (Default: None = process-wide one) is the
+    processlauncher.ProcessLauncher instance to start git with.
+    '''
+    launcher = kw.get('launcher') or processlauncher.get_launcher()
+    return launcher.call(['git', '--git-dir', repo_path] + list(args), nice = kw.get('nice', 0))
+
+def update_server_info(repo_path, launcher = None):
+    return run_git(repo_path, 'update-server-info', launcher = launcher)
+
+def repo_stats(repo_path):
+    '''
+    Returns a dict describing the object store of the repo:
+        packs - number of packs (not counting .keep ones).
+        loose_objects - estimated number of loose objects (as git gc --auto
+            estimates it: 256 times the number of objects in objects/17.)
+        commit_graph - True if there is a commit-graph.
+        multi_pack_index - True if there is a multi-pack-index.
+    '''
+    objects = os.path.join(repo_path, 'objects')
+    try:
+        names = set(os.listdir(os.path.join(objects, 'pack')))
+    except (EnvironmentError, ValueError):
+        names = set()
+    try:
+        loose = len([n for n in os.listdir(os.path.join(objects, '17')) if len(n) >= 38])
+    except (EnvironmentError, ValueError):
+        loose = 0
+    return {
+        'packs': len([n for n in names if n.endswith('.pack') and n[:-5] + '.keep' not in names]),
+        'loose_objects': loose * 256,
+        'commit_graph': (
+            os.path.isfile(os.path.join(objects, 'info', 'commit-graph')) or
+            os.path.isfile(os.path.join(objects, 'info', 'commit-graphs', 'commit-graph-chain'))),
+        'multi_pack_index': 'multi-pack-index' in names
+    }
+
+class MaintenanceScheduler(object):
+    '''
+    Runs jobs (callables taking repo path) per repo, debounced and coalesced.
+
+    Counters:
+        requested - calls to .schedule().
+        coalesced - of these, ones folded into a job already pending.
+        runs - jobs run.
+        failures - jobs that raised or returned non-zero exit code.
+    '''
+    # names of jobs run by workers of their own (max_heavy_jobs of them.)
+    heavy = frozenset(['maintenance'])
+
+    # git command lines of maintenance actions. %(threads)d = pack_threads.
+    commands = {
+        'repack': ['-c', 'pack.threads=%(threads)d', 'repack', '-a', '-d', '-b', '-q'],
+        'multi-pack-index': ['multi-pack-index', 'write', '--bitmap'],
+        'commit-graph': ['commit-graph', 'write', '--reachable'],
+        'update-server-info': ['update-server-info']
+    }
+
+    def __init__(self, debounce = 1.0, max_delay = 10.0, max_workers = 2, jobs = None,
+            auto_maintenance = True, maintenance_delay = 30.0, min_interval = 600.0,
+            repack_packs = 50, repack_loose_objects = 6700, midx_packs = 10,
+            max_heavy_jobs = 1, nice = 10, pack_threads = 1, launcher = None, file_cache = None):
+        '''
+        @param debounce (Default: 1.0) Seconds to wait for more requests for
+            the same job before running it.
+        @param max_delay (Default: 10.0) Max seconds a job waits for the
+            requests to calm down.
+        @param max_workers (Default: 2) Max number of jobs (other than heavy
+            ones) running at a time.
+        @param jobs (Default: None) Dict of job name : callable(repo_path),
+            added to (or replacing) the default ones.
+        @param auto_maintenance (Default: True) Have .after_push() schedule
+            "maintenance" job too.
+        @param maintenance_delay (Default: 30.0) debounce of "maintenance" job.
+        @param min_interval (Default: 600.0) Min seconds between maintenance
+            runs (that did something) on the same repo.
+        @param repack_packs (Default: 50) Repack when there are this many packs.
+        @param repack_loose_objects (Default: 6700) Repack when there are
+            about this many loose objects (git gc --auto's default).
+        @param midx_packs (Default: 10) Write multi-pack-index when there are
+            this many packs (and not enough for repacking.)
+        @param max_heavy_jobs (Default: 1) Max number of maintenance jobs
+            running at a time (on workers of their own.) Others wait.
+        @param nice (Default: 10) Niceness added to maintenance git processes.
+        @param pack_threads (Default: 1) pack.threads for repacking.
+        @param launcher (Default: None = process-wide one)
+            processlauncher.ProcessLauncher instance starting git.
+        @param file_cache (Default: None) filecache.FileCache to drop the
+            packs deleted by maintenance from.
+        '''
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_workers = max_workers
+        self.jobs = {
+            'update-server-info': self.update_server_info,
+            'maintenance': self.maintain
+        }
+        if jobs:
+            self.jobs.update(jobs)
+        self.auto_maintenance = auto_maintenance
+        self.maintenance_delay = maintenance_delay
+        self.min_interval = min_interval
+        self.repack_packs = repack_packs
+        self.repack_loose_objects = repack_loose_objects
+        self.midx_packs = midx_packs
+        self.nice = nice
+        self.pack_threads = pack_threads
+        self.launcher = launcher
+        self.file_cache = file_cache
+        self.max_heavy_jobs = max_heavy_jobs
+        self.heavy_jobs = threading.Semaphore(max_heavy_jobs)
+        # repo path : dict of what maintenance found and did last time.
+        self.repos = {}
+        # (repo path, job name) : [due time, deadline]
+        self.pending = {}
+        self.running = set()
+        self.workers = []
+        self.heavy_workers = []
+        self.requested = 0
+        self.coalesced = 0
+        self.runs = 0
+        self.failures = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def update_server_info(self, repo_path):
+        return update_server_info(repo_path, self.launcher)
+
+    def after_push(self, repo_path):
+        '''
+        Schedules the jobs due after a push to the repo.
+        '''
+        self.schedule(repo_path, 'update-server-info')
+        if self.auto_maintenance:
+            self.schedule(repo_path, 'maintenance', self.maintenance_delay)
+
+    def schedule(self, repo_path, name = 'update-server-info', delay = None):
+        '''
+        Asks for the job to be run against the repo (soon, not now).
+        delay (Default: debounce) is the debounce for this request.
+        '''
+        if name not in self.jobs:
+            raise KeyError('Unknown maintenance job: %s' % name)
+        if delay is None:
+            delay = self.debounce
+        now = time.time()
+        key = (repo_path, name)
+        with self.condition:
+            self.requested += 1
+            entry = self.pending.get(key)
+            if entry:
+                self.coalesced += 1
+                entry[0] = min(now + delay, entry[1])
+            else:
+                self.pending[key] = [now + delay, now + max(delay, self.max_delay)]
+            heavy = name in self.heavy
+            workers = self.heavy_workers if heavy else self.workers
+            if len(workers) < (self.max_heavy_jobs if heavy else self.max_workers) and not self.closed:
+                t = threading.Thread(target = self._work, args = (heavy,))
+                t.daemon = True
+                workers.append(t)
+                t.start()
+            self.condition.notify_all()
+
+    def _defer(self, repo_path, name, due):
+        # puts the job (running now) back in the que, to run at due time.
+        with self.condition:
+            entry = self.pending.get((repo_path, name))
+            if entry:
+                entry[0] = entry[1] = max(entry[0], due)
+            else:
+                self.pending[(repo_path, name)] = [due, due]
+            self.condition.notify_all()
+
+    def plan(self, stats):
+        '''
+        Returns the list of maintenance actions (keys of .commands) to run
+        on a repo with the given repo_stats().
+        '''
+        if stats['packs'] >= self.repack_packs or stats['loose_objects'] >= self.repack_loose_objects:
+            # objects/info/packs lists the packs for "dumb" HTTP clients.
+            return ['repack', 'commit-graph', 'update-server-info']
+        actions = []
+        if stats['packs'] >= self.midx_packs:
+            actions.append('multi-pack-index')
+        if not stats['commit_graph']:
+            actions.append('commit-graph')
+        return actions
+
+    def maintain(self, repo_path):
+        '''
+        The "maintenance" job. Returns 0 if all went well.
+        '''
+        now = time.time()
+        with self.condition:
+            state = self.repos.setdefault(repo_path, {})
+            last = state.get('last_maintenance')
+        if last and now - last < self.min_interval:
+            self._defer(repo_path, 'maintenance', last + self.min_interval)
+            return 0
+        if not self.heavy_jobs.acquire(False):
+            # budget is used up. Trying later.
+            self._defer(repo_path, 'maintenance', now + self.maintenance_delay)
+            return 0
+        try:
+            stats = repo_stats(repo_path)
+            actions = self.plan(stats)
+            results = {}
+            packs = self._pack_files(repo_path)
+            for action in actions:
+                results[action] = run_git(
+                    repo_path,
+                    *[arg % {'threads': self.pack_threads} for arg in self.commands[action]],
+                    nice = self.nice,
+                    launcher = self.launcher
+                    )
+            if self.file_cache and actions:
+                for path in packs - self._pack_files(repo_path):
+                    self.file_cache.invalidate_path(path)
+        finally:
+            self.heavy_jobs.release()
+        with self.condition:
+            state.update(stats = stats, last_check = now, results = results)
+            if actions:
+                state['last_maintenance'] = now
+                state['duration'] = time.time() - now
+        return int(any(results.values()))
+
+    def _pack_files(self, repo_path):
+        folder = os.path.join(repo_path, 'objects', 'pack')
+        try:
+            return set(os.path.join(folder, name) for name in os.listdir(folder))
+        except (EnvironmentError, ValueError):
+            return set()
+
+    def status(self):
+        '''
+        Returns a dict describing the state of the scheduler: counters, jobs
+        pending (with the time they are due) and running, and what the last
+        maintenance job found and did (exit codes of git commands) per repo.
+        '''
+        with self.condition:
+            return {
+                'requested': self.requested,
+                'coalesced': self.coalesced,
+                'runs': self.runs,
+                'failures': self.failures,
+                'pending': sorted(
+                    (repo_path, name, entry[0]) for (repo_path, name), entry in self.pending.items()),
+                'running': sorted(self.running),
+                'repos': dict((repo_path, dict(state)) for repo_path, state in self.repos.items())
+            }
+
+    def _next_job(self, heavy):
+        # must be called with self.condition acquired.
+        # Returns (key, seconds to wait): ready (heavy or not) job's key or
+        # None and how long to wait for the next one to be due.
+        now = time.time()
+        wait = None
+        for key, (due, deadline) in self.pending.items():
+            if key in self.running or (key[1] in self.heavy) != heavy:
+                continue
+            if due <= now:
+                return key, 0
+            if wait is None or due - now < wait:
+                wait = due - now
+        return None, wait
+
+    def _work(self, heavy = False):
+        while True:
+            with self.condition:
+                while True:
+                    if self.closed:
+                        return
+                    key, wait = self._next_job(heavy)
+                    if key:
+                        break
+                    self.condition.wait(wait)
+                del self.pending[key]
+                self.running.add(key)
+            failed = True
+            try:
+                failed = self.jobs[key[1]](key[0])
+            except Exception as e:
+                sys.stderr.write('Maintenance job %s of %s failed: %s\n' % (key[1], key[0], e))
+            with self.condition:
+                self.running.discard(key)
+                self.runs += 1
+                if failed:
+                    self.failures += 1
+                self.condition.notify_all()
+
+    def wait(self, timeout = None):
+        '''
+        Waits until no job is pending or running.
+        Returns False if timeout (seconds) ran out first.
+        '''
+        end = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending or self.running:
+                if end is not None:
+                    if time.time() >= end:
+                        return False
+                    self.condition.wait(end - time.time())
+                else:
+                    self.condition.wait(1.0)
+        return True
+
+    def close(self):
+        '''
+        Stops the workers. Jobs still pending are dropped.
+        '''
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.condition.notify_all()
@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+'''
+Module provides metrics of the work git_http_backend does: where the time of
+requests goes, how many bytes come in and go out, how many git processes run
+and what they cost. Metrics are exposed in Prometheus' text format (version
+0.0.4) by the Metrics instance itself, a WSGI app to mount at some URI (see
+metrics_path option of git_http_backend.assemble_WSGI_git_app.)
+
+Requests are counted per route (see the "route" label):
+    info-refs/upload-pack, info-refs/receive-pack
+                    /info/refs requests (ref advertisements)
+    rpc/upload-pack, rpc/receive-pack
+                    fetches and clones, pushes
+    static          files served over "dumb" HTTP
+    metrics         the metrics
+    unrouted        requests matching no route
+    other           requests handled by other apps
+and are timed by phase (see the "phase" label of
+git_http_request_duration_seconds):
+    routing         finding the handler
+    checks          checking the request (path, access rights, repo)
+    spawn           starting git
+    first_byte      from the start of the request to the first byte of the
+                    response body leaving the app
+    total           from the start of the request to the end of the response
+Time to first byte and total of responses going through wsgi.file_wrapper
+are those of handing the file over to the server (the server takes it from
+there, see simpleserver.py), and their bytes are counted per Content-Length.
+
+CPU time and peak memory (RSS) of git processes come from wait4(), for
+processes started with processlauncher.SpawnLauncher.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import sys
+import time
+import bisect
+import threading
+
+# where the RequestMetrics of a request is kept in WSGI environ.
+ENVIRON_KEY = 'git_http_backend.metrics'
+
+# ru_maxrss is in kilobytes, except on Mac OS X.
+_RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+def request_metrics(environ):
+    '''
+    Returns the RequestMetrics of the request, or None if it is not metered.
+    '''
+    return environ.get(ENVIRON_KEY)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+class Histogram(object):
+    '''
+    Counts of observed values falling in each of the buckets (upper bounds,
+    ascending), with their sum and count.
+    '''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        '''
+        Returns a list of (upper bound, count of values not above it).
+        '''
+        total = 0
+        result = []
+        for bound, in_bucket in zip(self.buckets + (float('inf'),), self.counts):
+            total += in_bucket
+            result.append((bound, total))
+        return result
+
+class _Once(object):
+    # calls func the first time it is called, with arguments of that call.
+    def __init__(self, func):
+        self.func = func
+        self.lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self.lock:
+            func, self.func = self.func, None
+        if func:
+            func(*args)
+
+class Metrics(object):
+    '''
+    Collects counters, gauges and histograms, labeled by route, and renders
+    them in Prometheus' text format.
+
+    The instance is a WSGI app answering GET and HEAD with the metrics.
+    '''
+    prefix = 'git_http_'
+    # (type, help) by metric name, without the prefix.
+    descriptions = {
+        'request_duration_seconds': ('histogram', 'Time spent on requests, by phase.'),
+        'requests_total': ('counter', 'Requests answered, by status code.'),
+        'request_bytes_total': ('counter', 'Request body bytes read by the app.'),
+        'response_bytes_total': ('counter', 'Response body bytes returned by the app.'),
+        'subprocesses_total': ('counter', 'git processes started.'),
+        'subprocesses_active': ('gauge', 'git processes running (or not yet reaped).'),
+        'subprocess_cpu_seconds_total': ('counter', 'CPU time used by git processes, by mode.'),
+        'subprocess_max_rss_bytes': ('histogram', 'Peak resident set size of git processes.'),
+        'buffer_stalls_total': ('counter', 'Times reading git output paused on a full buffer.')
+    }
+    latency_buckets = (
+        0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+        2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+    # 1MB to 4GB
+    rss_buckets = tuple(float(1048576 << i) for i in range(0, 13))
+    metrics_route = 'metrics'
+
+    def __init__(self, latency_buckets = None):
+        '''
+        @param latency_buckets (Default: Metrics.latency_buckets) Upper
+            bounds (in seconds) of buckets of request_duration_seconds.
+        '''
+        if latency_buckets:
+            self.latency_buckets = tuple(sorted(latency_buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _add(self, name, labels, value):
+        # must be called with self.lock acquired.
+        key = (name, labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def _observe(self, name, labels, value, buckets):
+        # must be called with self.lock acquired.
+        key = (name, labels)
+        histogram = self.values.get(key)
+        if histogram is None:
+            histogram = self.values[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def inc(self, name, labels = (), value = 1):
+        '''
+        Adds value to the counter (or gauge, value may be negative) of that
+        name and labels (a tuple of (label name, value) pairs.)
+        '''
+        with self.lock:
+            self._add(name, labels, value)
+
+    def observe(self, name, labels = (), value = 0, buckets = None):
+        '''
+        Adds value to the histogram of that name and labels.
+        '''
+        with self.lock:
+            self._observe(name, labels, value, buckets or self.latency_buckets)
+
+    def get(self, name, labels = ()):
+        '''
+        Returns the value of a counter or gauge (a Histogram for histograms),
+        None if it was never touched.
+        '''
+        with self.lock:
+            return self.values.get((name, labels))
+
+    def request(self, environ):
+        '''
+        Starts metering a request. Returns its RequestMetrics (also put into
+        environ, see request_metrics()).
+        '''
+        request = environ[ENVIRON_KEY] = RequestMetrics(self)
+        return request
+
+    def process_started(self, route):
+        '''
+        Records the start of a git process.
+
+        Returns a callable to call once the process is gone, with the
+        process' resource.struct_rusage, if there is one. (It does something
+        the first time it is called only.)
+        '''
+        labels = (('route', route),)
+        with self.lock:
+            self._add('subprocesses_total', labels, 1)
+            self._add('subprocesses_active', labels, 1)
+        return _Once(lambda rusage = None: self.process_exited(route, rusage))
+
+    def process_exited(self, route, rusage = None):
+        labels = (('route', route),)
+        with self.lock:
+            self._add('subprocesses_active', labels, -1)
+            if rusage is not None:
+                self._add('subprocess_cpu_seconds_total', labels + (('mode', 'user'),), rusage.ru_utime)
+                self._add('subprocess_cpu_seconds_total', labels + (('mode', 'system'),), rusage.ru_stime)
+                self._observe('subprocess_max_rss_bytes', labels,
+                    float(rusage.ru_maxrss * _RSS_SCALE), self.rss_buckets)
+
+    def render(self):
+        '''
+        Returns the metrics in Prometheus' text format.
+        '''
+        with self.lock:
+            values = sorted(
+                (name, labels, value if not isinstance(value, Histogram) else value.cumulative() + [value.sum])
+                for (name, labels), value in self.values.items())
+        lines = []
+        last = None
+        for name, labels, value in values:
+            full_name = self.prefix + name
+            if name != last:
+                last = name
+                kind, description = self.descriptions.get(name, ('untyped', name))
+                lines.append('# HELP %s %s' % (full_name, description))
+                lines.append('# TYPE %s %s' % (full_name, kind))
+            if isinstance(value, list):
+                total = value.pop()
+                for bound, observed in value:
+                    lines.append('%s_bucket%s %d' % (
+                        full_name, _format_labels(labels + (('le', _format_value(bound)),)), observed))
+                # (the last, +Inf, bucket has all the values.)
+                lines.append('%s_sum%s %s' % (full_name, _format_labels(labels), _format_value(total)))
+                lines.append('%s_count%s %d' % (full_name, _format_labels(labels), observed))
+            else:
+                lines.append('%s%s %s' % (full_name, _format_labels(labels), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response):
+        body = self.render().encode('utf8')
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-cache')
+            ])
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return [b'']
+        return [body]
+
+class CountingReader(object):
+    '''
+    File-like counting the bytes read from source (wsgi.input.)
+    '''
+    def __init__(self, source):
+        self.source = source
+        self.count = 0
+
+    def read(self, *args):
+        data = self.source.read(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.source.readline(*args)
+        self.count += len(data)
+        return data
+
+    def readlines(self, *args):
+        lines = self.source.readlines(*args)
+        self.count += sum(len(line) for line in lines)
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.readline()
+        if not data:
+            raise StopIteration
+        return data
+    __next__ = next
+
+class MeteredResponse(object):
+    '''
+    Wraps a WSGI response iterable, counting the bytes of the body and
+    telling RequestMetrics when the first of them goes out and when the
+    response is done (exhausted or closed, whichever comes first.)
+    '''
+    def __init__(self, source, request):
+        self.source = source
+        self.iterator = iter(source)
+        self.request = request
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            data = next(self.iterator)
+        except StopIteration:
+            self.request.finish()
+            raise
+        if data:
+            request = self.request
+            if not request.bytes_out:
+                request.first_byte()
+            request.bytes_out += len(data)
+        return data
+    __next__ = next
+
+    def close(self):
+        try:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+        finally:
+            self.request.finish()
+
+class _Timed(object):
+    def __init__(self, request, phase):
+        self.request = request
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.request.phase(self.phase, time.time() - self.start)
+
+class _NotTimed(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_not_timed = _NotTimed()
+
+def timed(environ, phase):
+    '''
+    Returns a context manager recording the time spent in it as the phase
+    of the request (if the request is metered.)
+    '''
+    request = environ.get(ENVIRON_KEY)
+    if request is None:
+        return _not_timed
+    return _Timed(request, phase)
+
+class RequestMetrics(object):
+    '''
+    Metrics of one request, recorded into Metrics when the response is done,
+    under the route the request turned out to take (.route).
+
+    Also passed to subprocessio chunkers (metrics argument), which report
+    git processes they start (.process_started()) and buffer stalls
+    (.stalled()) through it.
+    '''
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.time()
+        self.route = 'unrouted'
+        self.phases = []
+        self.status = None
+        self.headers = None
+        self.reader = None
+        self.bytes_out = 0
+        self.finished = False
+
+    def phase(self, name, seconds):
+        self.phases.append((name, seconds))
+
+    def first_byte(self):
+        self.phase('first_byte', time.time() - self.start)
+
+    def start_response(self, start_response):
+        '''
+        Returns start_response remembering the status and the headers.
+        '''
+        def metered_start_response(status, headers, exc_info = None):
+            self.status = status
+            self.headers = headers
+            return start_response(status, headers, exc_info)
+        return metered_start_response
+
+    def wrap_input(self, environ):
+        stdin = environ.get('wsgi.input')
+        if stdin is not None:
+            self.reader = environ['wsgi.input'] = CountingReader(stdin)
+
+    def wrap_response(self, result):
+        '''
+        Returns the response body iterable, made to report back to us.
+        '''
+        if isinstance(result, (list, tuple)):
+            # all there is, is there.
+            size = sum(len(data) for data in result)
+            if size:
+                self.first_byte()
+            self.bytes_out += size
+            self.finish()
+            return result
+        if hasattr(result, 'filelike'):
+            # wsgi.file_wrapper. Wrapping it would keep the server from
+            # recognizing it (and sending the file with sendfile() etc.)
+            self.first_byte()
+            for name, value in self.headers or []:
+                if name.lower() == 'content-length' and value.isdigit():
+                    self.bytes_out += int(value)
+            close = getattr(result, 'close', None)
+            def metered_close():
+                try:
+                    if close:
+                        close()
+                finally:
+                    self.finish()
+            try:
+                result.close = metered_close
+            except AttributeError:
+                self.finish()
+            return result
+        return MeteredResponse(result, self)
+
+    def process_started(self, seconds):
+        '''
+        Records the start of a git process, see Metrics.process_started().
+        '''
+        self.phase('spawn', seconds)
+        return self.metrics.process_started(self.route)
+
+    def stalled(self):
+        self.metrics.inc('buffer_stalls_total', (('route', self.route),))
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        total = time.time() - self.start
+        labels = (('route', self.route),)
+        metrics = self.metrics
+        with metrics.lock:
+            for name, seconds in self.phases:
+                metrics._observe('request_duration_seconds', labels + (('phase', name),),
+                    seconds, metrics.latency_buckets)
+            metrics._observe('request_duration_seconds', labels + (('phase', 'total'),),
+                total, metrics.latency_buckets)
+            metrics._add('requests_total', labels + (('code', (self.status or '000')[:3]),), 1)
+            if self.reader is not None:
+                metrics._add('request_bytes_total', labels, self.reader.count)
+            metrics._add('response_bytes_total', labels, self.bytes_out)
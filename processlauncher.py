@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+'''
+Module provides launchers: the objects starting the subprocesses (git)
+subprocessio and git_http_backend run.
+
+ProcessLauncher starts them with subprocess.Popen. Commands are argv lists,
+with the executable (git) looked up on PATH once, not per request. Commands
+given as strings are still run by the shell. Subprocesses get a small
+environment (ours, cut down to ProcessLauncher.env_keep) and none of our
+file descriptors but stdin, stdout and stderr.
+
+SpawnLauncher starts them with posix_spawn() (libc's, through ctypes).
+Unlike fork(), it does not copy the page tables of the (big, threaded)
+server process, and it closes the file descriptors in the child with one
+close_range() instead of Python 2's close() of every possible one. It needs
+glibc 2.34 or later (posix_spawn_file_actions_addclosefrom_np) and falls
+back to ProcessLauncher's way elsewhere. (On Python 3.10+, subprocess.Popen
+uses vfork() and close_range() itself, and does about as well.)
+
+get_launcher() returns the process-wide launcher: a SpawnLauncher.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import sys
+import errno
+import signal
+import threading
+import subprocess
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+PIPE = subprocess.PIPE
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str, bytes)
+
+def _fsencode(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode(sys.getfilesystemencoding() or 'utf8')
+
+def which(name, path = None):
+    '''
+    Returns the full path of executable name found on path (Default: PATH),
+    or None if there is none.
+    '''
+    if os.path.dirname(name):
+        return name if os.path.isfile(name) and os.access(name, os.X_OK) else None
+    extensions = ['']
+    if os.name == 'nt':
+        extensions += os.environ.get('PATHEXT', '.EXE').lower().split(os.pathsep)
+    for folder in (path or os.environ.get('PATH', os.defpath)).split(os.pathsep):
+        for extension in extensions:
+            candidate = os.path.join(folder, name + extension)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                return os.path.abspath(candidate)
+    return None
+
+def set_cloexec(fd):
+    if fcntl:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def pipe():
+    '''
+    Returns (read fd, write fd) of a new pipe, not inherited by subprocesses
+    (except as their stdin/out/err). Python 3 makes them this way already.
+    '''
+    r, w = os.pipe()
+    set_cloexec(r)
+    set_cloexec(w)
+    return r, w
+
+class ProcessLauncher(object):
+    '''
+    Starts subprocesses with subprocess.Popen.
+
+    Counters:
+        spawned - subprocesses started.
+    '''
+    # variables of our environment subprocesses get.
+    env_keep = (
+        'PATH', 'HOME', 'USER', 'LOGNAME', 'TMPDIR', 'TZ',
+        'LANG', 'LANGUAGE', 'LC_ALL', 'LC_CTYPE', 'LC_MESSAGES',
+        'XDG_CONFIG_HOME', 'GIT_EXEC_PATH', 'GIT_NAMESPACE', 'GIT_USER_AGENT',
+        'SYSTEMROOT', 'COMSPEC', 'PATHEXT', 'TEMP', 'TMP'
+    )
+    # ... and those with names starting with these.
+    env_keep_prefixes = ('GIT_CONFIG', 'GIT_TRACE')
+
+    def __init__(self, env = None, executables = None):
+        '''
+        @param env (Default: None) Dict with the environment of subprocesses.
+            Default: ours, cut down to env_keep and env_keep_prefixes.
+        @param executables (Default: None) Dict of name : full path of
+            executables, say {'git': '/opt/git/bin/git'}. Others are looked
+            up on PATH when first needed.
+        '''
+        if env is None:
+            env = dict(
+                (k, v) for k, v in os.environ.items()
+                if k in self.env_keep or k.startswith(self.env_keep_prefixes)
+                )
+        self.env = env
+        self.executables = dict(executables or {})
+        self.spawned = 0
+        self.lock = threading.Lock()
+
+    def environ(self, extra = None):
+        '''
+        Returns a copy of the subprocesses' environment, updated with extra (dict).
+        '''
+        env = dict(self.env)
+        env.update(extra or {})
+        return env
+
+    def which(self, name):
+        '''
+        Returns the full path of executable name (or name, if it is nowhere
+        to be found.) Remembers what it found.
+        '''
+        path = self.executables.get(name)
+        if path is None:
+            path = which(name, self.env.get('PATH'))
+            if path is None:
+                return name
+            with self.lock:
+                self.executables[name] = path
+        return path
+
+    def argv(self, cmd):
+        '''
+        Returns argv list for cmd (a list), executable's full path first.
+        '''
+        args = list(cmd)
+        args[0] = self.which(args[0])
+        return args
+
+    def spawn(self, cmd, stdin = None, stdout = PIPE, stderr = PIPE, env = None, nice = 0):
+        '''
+        Starts cmd: argv list, or a string (a shell command line).
+
+        stdin, stdout, stderr are same as for subprocess.Popen: PIPE, None
+        (= ours), file descriptor or file object. env (Default: None =
+        self.env) is the environment of the subprocess. nice is added to
+        the niceness of the subprocess (POSIX only.)
+
+        Returns subprocess.Popen or a work-alike (SpawnedProcess).
+        '''
+        shell = isinstance(cmd, string_types)
+        process = subprocess.Popen(
+            cmd if shell else self.argv(cmd),
+            bufsize = -1,
+            shell = shell,
+            stdin = stdin,
+            stdout = stdout,
+            stderr = stderr,
+            env = self.env if env is None else env,
+            # redirecting std* does not mix with close_fds on Windows.
+            close_fds = os.name != 'nt',
+            preexec_fn = (lambda: os.nice(nice)) if nice and hasattr(os, 'nice') else None
+            )
+        self.spawned += 1
+        return process
+
+    def call(self, cmd, env = None, nice = 0):
+        '''
+        Runs cmd with stdin, stdout and stderr on os.devnull and waits for it.
+        Returns its exit code.
+        '''
+        null = open(os.devnull, 'r+b')
+        try:
+            return self.spawn(cmd, null, null, null, env, nice).wait()
+        finally:
+            null.close()
+
+def _libc_functions(*names):
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        return [getattr(libc, name) for name in names]
+    except (OSError, AttributeError, TypeError):
+        return None
+
+_spawn_functions = os.name == 'posix' and _libc_functions(
+    'posix_spawn',
+    'posix_spawn_file_actions_init',
+    'posix_spawn_file_actions_adddup2',
+    'posix_spawn_file_actions_addclosefrom_np',
+    'posix_spawn_file_actions_destroy',
+    'posix_spawnattr_init',
+    'posix_spawnattr_setflags',
+    'posix_spawnattr_setsigdefault',
+    'posix_spawnattr_setsigmask',
+    'posix_spawnattr_destroy',
+    'sigemptyset',
+    'sigaddset'
+    )
+
+# glibc's values. (addclosefrom_np is glibc's too.)
+POSIX_SPAWN_SETSIGDEF = 0x04
+POSIX_SPAWN_SETSIGMASK = 0x08
+# more than glibc's sizeof(posix_spawn_file_actions_t), sizeof(posix_spawnattr_t), sizeof(sigset_t)
+_FILE_ACTIONS_SIZE = 256
+_ATTR_SIZE = 1024
+_SIGSET_SIZE = 256
+
+# spawned processes dropped before being waited for. Reaped later, same as subprocess does it.
+_active = []
+_active_lock = threading.Lock()
+
+def _cleanup():
+    with _active_lock:
+        for process in _active[:]:
+            if process.poll() is not None:
+                _active.remove(process)
+
+class SpawnedProcess(object):
+    '''
+    The part of subprocess.Popen interface subprocessio uses, for processes
+    started by SpawnLauncher.
+
+    Processes are reaped with wait4(), leaving their resource usage (a
+    resource.struct_rusage) in .rusage. Callables in .on_exit are called
+    (once) with it, when the process is reaped (None if the exit status was
+    taken by someone else.)
+
+    A process reaped by someone else (say, a SIGCHLD handler) has -1 for
+    .returncode: its exit status is unknown, which is no success.
+    '''
+    def __init__(self, pid, args, stdin = None, stdout = None, stderr = None):
+        self.pid = pid
+        self.args = args
+        self.stdin = stdin
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = None
+        self.rusage = None
+        self.on_exit = []
+        self.lock = threading.Lock()
+
+    def _set_status(self, status, rusage = None):
+        if os.WIFSIGNALED(status):
+            self._set_returncode(-os.WTERMSIG(status), rusage)
+        elif os.WIFEXITED(status):
+            self._set_returncode(os.WEXITSTATUS(status), rusage)
+
+    def _set_returncode(self, returncode, rusage = None):
+        self.returncode = returncode
+        self.rusage = rusage
+        callbacks, self.on_exit = self.on_exit, []
+        for callback in callbacks:
+            try:
+                callback(rusage)
+            except Exception:
+                pass
+
+    def _waitpid(self, flags):
+        # must be called with self.lock acquired.
+        while self.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(self.pid, flags)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    # reaped by someone else. Exit code is lost.
+                    self._set_returncode(-1)
+                    break
+                raise
+            if pid == self.pid:
+                self._set_status(status, rusage)
+            if flags:
+                break
+
+    def poll(self):
+        if self.returncode is None and self.lock.acquire(False):
+            # (if the lock is taken, .wait() is on it.)
+            try:
+                self._waitpid(os.WNOHANG)
+            finally:
+                self.lock.release()
+        return self.returncode
+
+    def wait(self):
+        with self.lock:
+            self._waitpid(0)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, sig)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def __del__(self):
+        if self.returncode is None and _active is not None:
+            # zombie until reaped.
+            with _active_lock:
+                _active.append(self)
+
+class SpawnLauncher(ProcessLauncher):
+    '''
+    Starts subprocesses with posix_spawn(). Falls back to subprocess.Popen
+    where posix_spawn() with closefrom is not to be had (and for nice
+    subprocesses.)
+
+    Subprocesses get SIGPIPE and SIGXFSZ handlers reset to defaults (Python
+    ignores these) and an empty signal mask.
+    '''
+    available = bool(_spawn_functions)
+
+    def spawn(self, cmd, stdin = None, stdout = PIPE, stderr = PIPE, env = None, nice = 0):
+        if not self.available or nice:
+            return ProcessLauncher.spawn(self, cmd, stdin, stdout, stderr, env, nice)
+        _cleanup()
+        if isinstance(cmd, string_types):
+            args = ['/bin/sh', '-c', cmd]
+        else:
+            args = self.argv(cmd)
+        env = self.env if env is None else env
+
+        to_close = [] # ours, once the child has its copies.
+        parent_ends = [None, None, None]
+        child_fds = [None, None, None]
+        try:
+            for i, target in enumerate((stdin, stdout, stderr)):
+                if target == PIPE:
+                    r, w = pipe()
+                    fd, parent_ends[i] = (r, w) if i == 0 else (w, r)
+                    to_close.append(fd)
+                elif target is None:
+                    continue
+                else:
+                    fd = target if isinstance(target, int) else target.fileno()
+                if fd < 3:
+                    # could be clobbered by dup2() of a lower std* before it's dup'ed itself.
+                    fd = fcntl.fcntl(fd, fcntl.F_DUPFD, 3)
+                    set_cloexec(fd)
+                    to_close.append(fd)
+                child_fds[i] = fd
+            pid = self._posix_spawn(args, env, child_fds)
+        except:
+            for fd in to_close + [fd for fd in parent_ends if fd is not None]:
+                os.close(fd)
+            raise
+        for fd in to_close:
+            os.close(fd)
+        self.spawned += 1
+        return SpawnedProcess(
+            pid,
+            args,
+            parent_ends[0] is not None and os.fdopen(parent_ends[0], 'wb', -1) or None,
+            parent_ends[1] is not None and os.fdopen(parent_ends[1], 'rb', -1) or None,
+            parent_ends[2] is not None and os.fdopen(parent_ends[2], 'rb', -1) or None
+            )
+
+    def _posix_spawn(self, args, env, child_fds):
+        (posix_spawn, actions_init, adddup2, addclosefrom, actions_destroy,
+            attr_init, setflags, setsigdefault, setsigmask, attr_destroy,
+            sigemptyset, sigaddset) = _spawn_functions
+        argv = (ctypes.c_char_p * (len(args) + 1))(*([_fsencode(a) for a in args] + [None]))
+        envp = (ctypes.c_char_p * (len(env) + 1))(
+            *([_fsencode(k) + b'=' + _fsencode(v) for k, v in env.items()] + [None]))
+        actions = ctypes.create_string_buffer(_FILE_ACTIONS_SIZE)
+        attr = ctypes.create_string_buffer(_ATTR_SIZE)
+        sigdefault = ctypes.create_string_buffer(_SIGSET_SIZE)
+        sigmask = ctypes.create_string_buffer(_SIGSET_SIZE)
+        pid = ctypes.c_int()
+        actions_init(actions)
+        attr_init(attr)
+        try:
+            for target, fd in enumerate(child_fds):
+                if fd is not None:
+                    adddup2(actions, fd, target)
+            addclosefrom(actions, 3)
+            sigemptyset(sigdefault)
+            for name in ('SIGPIPE', 'SIGXFSZ'):
+                if hasattr(signal, name):
+                    sigaddset(sigdefault, getattr(signal, name))
+            sigemptyset(sigmask)
+            setsigdefault(attr, sigdefault)
+            setsigmask(attr, sigmask)
+            setflags(attr, ctypes.c_short(POSIX_SPAWN_SETSIGDEF | POSIX_SPAWN_SETSIGMASK))
+            # returns error number (not -1.) exec() failures show up here too.
+            error = posix_spawn(ctypes.byref(pid), argv[0], actions, attr, argv, envp)
+        finally:
+            attr_destroy(attr)
+            actions_destroy(actions)
+        if error:
+            raise OSError(error, '%s: %s' % (os.strerror(error), args[0]))
+        return pid.value
+
+_launcher = None
+_launcher_lock = threading.Lock()
+
+def get_launcher():
+    '''
+    Returns the process-wide launcher (a SpawnLauncher), creating it if needed.
+    '''
+    global _launcher
+    with _launcher_lock:
+        if _launcher is None:
+            _launcher = SpawnLauncher()
+        return _launcher
+
+def set_launcher(launcher):
+    '''
+    Makes launcher the process-wide one (the one get_launcher() returns.)
+    '''
+    global _launcher
+    with _launcher_lock:
+        _launcher = launcher
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+'''
+Module provides profiling of single requests, for seeing why requests to a
+particular repo are slow without profiling the whole server.
+
+RequestProfiler, given to WSGIHandlerSelector (profiler option of
+git_http_backend.assemble_WSGI_git_app), picks requests to profile:
+    - a sample_rate fraction of all requests, and
+    - requests carrying header_name header with token as value (when a
+      token is set), say:
+        git -c http.extraHeader="X-Git-Http-Profile: <token>" fetch
+and profiles their whole lifecycle in the thread serving them: routing,
+the handler and iteration of the response body. (Work of other threads,
+like subprocessio's readers, is not in it. Neither is sending of files
+the server takes over through wsgi.file_wrapper.)
+
+Profiles are written to directory, named
+    <time>-<pid>-<number>-<route>-<repo>.<format>
+with formats:
+    pstats      cProfile's data, for pstats.Stats, snakeviz etc.
+    collapsed   stacks of the thread sampled every sample_interval
+                seconds, as "frame;frame;frame count" lines (for
+                flamegraph.pl, speedscope etc.)
+where repo is the working_path the request's route matched.
+
+One request at a time gets a cProfile profile ('pstats'). Requests picked
+while one is being profiled get just their stacks sampled (if 'collapsed'
+is among formats) or are not profiled (counted as busy.) On Python 3.12
+and newer cProfile sees all threads of the process, not just the one
+serving the request, so 'pstats' profiles taken under load have the work
+of other requests in them. 'collapsed' profiles are of the request's
+thread only.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import re
+import sys
+import time
+import hmac
+import random
+import cProfile
+import itertools
+import threading
+from collections import defaultdict
+
+# where the RequestProfile of a request is kept in WSGI environ.
+ENVIRON_KEY = 'git_http_backend.profile'
+
+# numbers profiles, keeping names of those written in the same second apart.
+_sequence = itertools.count(1)
+
+# held by the RequestProfile having the cProfile profiler. (Python 3.12+
+# does not allow two at once.)
+_cprofile_lock = threading.Lock()
+
+def request_profile(environ):
+    '''
+    Returns the RequestProfile of the request, or None if it is not profiled.
+    '''
+    return environ.get(ENVIRON_KEY)
+
+def _file_name_part(value, max_length = 80):
+    value = re.sub(r'[^A-Za-z0-9._-]+', '_', value).strip('_.')
+    return value[-max_length:] or '-'
+
+def _constant_time_equal(a, b):
+    if hasattr(hmac, 'compare_digest'):
+        return hmac.compare_digest(a, b)
+    return len(a) == len(b) and not sum(ord(x) ^ ord(y) for x, y in zip(a, b))
+
+class StackSampler(threading.Thread):
+    '''
+    Counts stacks of the thread (identified by thread_ident), taken every
+    interval seconds while .active is set.
+    '''
+    def __init__(self, thread_ident, interval = 0.005):
+        super(StackSampler, self).__init__()
+        self.daemon = True
+        self.thread_ident = thread_ident
+        self.interval = interval
+        self.active = threading.Event()
+        self.stopped = False
+        self.stacks = defaultdict(int)
+
+    def run(self):
+        while not self.stopped:
+            self.active.wait()
+            frame = sys._current_frames().get(self.thread_ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            del frame
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped = True
+        self.active.set()
+
+    def collapsed(self):
+        return ''.join('%s %d\n' % item for item in sorted(self.stacks.items()))
+
+class RequestProfile(object):
+    '''
+    Profile of one request. .enable() and .disable() bracket the parts of
+    its lifecycle run by WSGIHandlerSelector and the server.
+    '''
+    def __init__(self, profiler, environ):
+        self.profiler = profiler
+        self.environ = environ
+        self.errors = environ.get('wsgi.errors')
+        self.route = 'unrouted'
+        self.profile = None
+        if 'pstats' in profiler.formats and _cprofile_lock.acquire(False):
+            self.profile = cProfile.Profile()
+        self.sampler = None
+        if 'collapsed' in profiler.formats:
+            self.sampler = StackSampler(threading.current_thread().ident, profiler.sample_interval)
+            self.sampler.start()
+        self.done = False
+
+    def enable(self):
+        if self.sampler:
+            self.sampler.thread_ident = threading.current_thread().ident
+            self.sampler.active.set()
+        if self.profile:
+            try:
+                self.profile.enable()
+            except ValueError:
+                # another (not ours) profiler is on. Doing without.
+                self.profile = None
+                _cprofile_lock.release()
+
+    def disable(self):
+        if self.profile:
+            self.profile.disable()
+        if self.sampler:
+            self.sampler.active.clear()
+
+    def wrap_response(self, result):
+        '''
+        Returns the response body iterable, profiled as it is iterated over.
+        '''
+        if isinstance(result, (list, tuple)):
+            self.finish()
+            return result
+        if hasattr(result, 'filelike'):
+            # wsgi.file_wrapper. The server sends it on its own.
+            self.finish()
+            return result
+        return ProfiledResponse(result, self)
+
+    def file_name(self):
+        matches = (self.environ.get('wsgiorg.routing_args') or ([], {}))[1]
+        repo = matches.get('working_path') or ''
+        return '%s-%d-%d-%s-%s' % (
+            time.strftime('%Y%m%d-%H%M%S'),
+            os.getpid(),
+            next(_sequence),
+            _file_name_part(self.route),
+            _file_name_part(repo))
+
+    def finish(self):
+        self.disable()
+        if self.done:
+            return
+        self.done = True
+        if self.sampler:
+            self.sampler.stop()
+        path = os.path.join(self.profiler.directory, self.file_name())
+        try:
+            if self.profile:
+                self.profile.dump_stats(path + '.pstats')
+            if self.sampler:
+                with open(path + '.collapsed', 'w') as f:
+                    f.write(self.sampler.collapsed())
+        except (EnvironmentError, ValueError) as e:
+            self.profiler.failed += 1
+            if self.errors:
+                self.errors.write('Could not write profile %s: %s\n' % (path, e))
+        else:
+            self.profiler.written += 1
+        finally:
+            if self.profile:
+                _cprofile_lock.release()
+        self.environ = None
+
+class ProfiledResponse(object):
+    '''
+    Wraps a WSGI response iterable, profiling its iteration and closing.
+    The profile is written when the response is exhausted, fails or is
+    closed, or, failing all that (server dropped it), when it is collected.
+    '''
+    def __init__(self, source, profile):
+        self.source = source
+        self.iterator = iter(source)
+        self.profile = profile
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        self.profile.enable()
+        try:
+            return next(self.iterator)
+        except BaseException:
+            # exhausted, or failed. Servers may not close() it then.
+            self.profile.finish()
+            raise
+        finally:
+            self.profile.disable()
+    __next__ = next
+
+    def close(self):
+        if not self.profile.done:
+            self.profile.enable()
+        try:
+            if hasattr(self.source, 'close'):
+                self.source.close()
+        finally:
+            self.profile.finish()
+
+    def __del__(self):
+        # frees cProfile (see _cprofile_lock) for other requests.
+        if not self.profile.done:
+            self.profile.finish()
+
+class RequestProfiler(object):
+    '''
+    Picks requests to profile and writes their profiles.
+
+    Counters:
+        profiled - requests profiled.
+        written - profiles written.
+        failed - profiles that could not be written.
+        busy - requests picked but not profiled, as another one was.
+    '''
+    header_name = 'X-Git-Http-Profile'
+
+    def __init__(self, directory, sample_rate = 0.0, token = None, formats = ('pstats',),
+            sample_interval = 0.005, header_name = None):
+        '''
+        @param directory Folder to write the profiles into (created if needed.)
+        @param sample_rate (Default: 0.0) Fraction of requests to profile,
+            0.0 (none) to 1.0 (all).
+        @param token (Default: None = no header) Secret that header_name
+            header must carry for the request to be profiled.
+        @param formats (Default: ('pstats',)) Any of 'pstats', 'collapsed'.
+        @param sample_interval (Default: 0.005) Seconds between stack
+            samples, for 'collapsed'.
+        @param header_name (Default: 'X-Git-Http-Profile') Request header
+            asking for a profile.
+        '''
+        for name in formats:
+            if name not in ('pstats', 'collapsed'):
+                raise ValueError('Unknown profile format: %s' % name)
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.token = token
+        self.formats = tuple(formats)
+        self.sample_interval = sample_interval
+        if header_name:
+            self.header_name = header_name
+        self.environ_key = 'HTTP_' + self.header_name.upper().replace('-', '_')
+        self.profiled = 0
+        self.written = 0
+        self.failed = 0
+        self.busy = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def wanted(self, environ):
+        '''
+        Tells if the request is to be profiled.
+        '''
+        asked = environ.get(self.environ_key)
+        if asked and self.token and _constant_time_equal(str(asked), str(self.token)):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def request(self, environ):
+        '''
+        Returns a RequestProfile for the request (also put into environ, see
+        request_profile()), or None if the request is not to be profiled.
+        '''
+        if not self.wanted(environ):
+            return None
+        profile = RequestProfile(self, environ)
+        if not (profile.profile or profile.sampler):
+            self.busy += 1
+            return None
+        self.profiled += 1
+        environ[ENVIRON_KEY] = profile
+        return profile
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+'''
+Module provides an index of the folders git_http_backend checks for being git
+repos, so that answering a request does not take listing the repo folder.
+
+Every request needs to know if the path it points at is a repo folder (has
+the right files and folders in it.) On network file systems (NFS) listing a
+folder is a round trip to the file server. RepoIndex remembers the names
+found in a folder and reuses them:
+
+- On Linux, folders are watched with inotify (read by a thread of its own)
+  and entries are dropped as soon as something is added to, removed from or
+  renamed in the folder.
+  (inotify sees only the changes made through the local kernel. Changes made
+  by other NFS clients are caught by the ttl check below.)
+- Entries older than ttl seconds are revalidated with a stat() of the folder.
+  Folder's modification time changes when entries are added or removed,
+  so the folder is listed again only when it changed.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import errno
+import select
+import struct
+import threading
+from lru import LRU
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event {int wd; uint32_t mask, cookie, len; char name[];}
+EVENT_HEADER = struct.Struct('iIII')
+
+def _libc_function(name, *argtypes):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    function.restype = ctypes.c_int
+    function.argtypes = argtypes
+    def call(*args):
+        result = function(*args)
+        if result < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+    return call
+
+if ctypes:
+    inotify_init1 = _libc_function('inotify_init1', ctypes.c_int)
+    inotify_add_watch = _libc_function('inotify_add_watch', ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    inotify_rm_watch = _libc_function('inotify_rm_watch', ctypes.c_int, ctypes.c_int)
+else:
+    inotify_init1 = inotify_add_watch = inotify_rm_watch = None
+
+# stands for modification time of folders known to have changed.
+CHANGED = object()
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (EnvironmentError, ValueError):
+        return None
+
+def _listdir(path):
+    try:
+        return frozenset(i.lower() for i in os.listdir(path))
+    except (EnvironmentError, ValueError):
+        return frozenset()
+
+class RepoIndex(object):
+    '''
+    Remembers the (lowercased) names of entries of folders.
+
+    Counters:
+        hits - lookups answered from memory.
+        revalidations - lookups of expired entries answered after a stat().
+        misses - lookups that took listing the folder.
+    '''
+    def __init__(self, ttl = 5.0, max_entries = 16384, use_inotify = True):
+        '''
+        @param ttl (Default: 5.0) Seconds an entry is trusted without checking
+            the folder's modification time. None = until inotify says otherwise.
+            (Use None only with local file systems and inotify available.)
+        @param max_entries (Default: 16384) Max number of folders remembered
+            (and watched.) Least recently used ones are forgotten first.
+        @param use_inotify (Default: True) Watch folders with inotify, where available.
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # path : [names, mtime, time checked, inotify watch descriptor]
+        self.entries = LRU()
+        self.watches = {}
+        self.generations = {}
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.inotify_fd = None
+        if use_inotify and inotify_init1:
+            try:
+                self.inotify_fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            except OSError:
+                pass
+            else:
+                t = threading.Thread(target = self._watch_events)
+                t.daemon = True
+                t.start()
+
+    def listdir(self, path):
+        '''
+        Returns a frozenset of lowercased names of entries of the folder at
+        path, or an empty frozenset if there is no such folder.
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[1] is not CHANGED and (self.ttl is None or now - entry[2] < self.ttl):
+                self.entries.touch(path)
+                self.hits += 1
+                return entry[0]
+            generation = self.generations.get(path, 0)
+
+        # file system calls are done without holding the lock.
+        mtime = _mtime(path)
+        if entry and mtime == entry[1]:
+            with self.lock:
+                if self.entries.get(path) is entry and generation == self.generations.get(path, 0):
+                    entry[2] = now
+                    self.revalidations += 1
+                    return entry[0]
+        # watching before listing, so that no change goes unnoticed.
+        wd = self._watch(path) if mtime is not None else None
+        names = _listdir(path)
+        with self.lock:
+            self.misses += 1
+            if wd is not None and wd not in self.watches:
+                # watch was removed while we were listing the folder.
+                wd = None
+            if generation != self.generations.get(path, 0):
+                # folder changed while we were listing it. Next lookup rechecks.
+                mtime, now = CHANGED, 0
+            self._store(path, [names, mtime, now, wd])
+        return names
+
+    def invalidate(self, path):
+        '''
+        Makes next lookup of path recheck the folder.
+        Use it after creating or removing a repo.
+        '''
+        with self.lock:
+            self._invalidate(path)
+
+    def _invalidate(self, path):
+        # must be called with self.lock acquired.
+        self.generations[path] = self.generations.get(path, 0) + 1
+        entry = self.entries.get(path)
+        if entry:
+            entry[1] = CHANGED
+            entry[2] = 0
+
+    def _store(self, path, entry):
+        # must be called with self.lock acquired.
+        old = self.entries.add(path, entry)
+        if entry[3] is not None:
+            self.watches.setdefault(entry[3], set()).add(path)
+        if old and old[3] != entry[3]:
+            self._unwatch(path, old[3])
+        for _p, _e in self.entries.trim(self.max_entries):
+            self.generations.pop(_p, None)
+            self._unwatch(_p, _e[3])
+
+    def _watch(self, path):
+        if self.inotify_fd is None:
+            return None
+        try:
+            wd = inotify_add_watch(
+                self.inotify_fd,
+                path.encode('utf8') if not isinstance(path, bytes) else path,
+                WATCH_MASK)
+        except (OSError, UnicodeError):
+            # ENOSPC (out of watches), ENOENT, ENOTDIR etc. Falling back on ttl.
+            return None
+        with self.lock:
+            self.watches.setdefault(wd, set())
+        return wd
+
+    def _unwatch(self, path, wd):
+        # must be called with self.lock acquired.
+        paths = self.watches.get(wd)
+        if paths is None:
+            return
+        paths.discard(path)
+        if not paths:
+            del self.watches[wd]
+            try:
+                inotify_rm_watch(self.inotify_fd, wd)
+            except OSError:
+                pass
+
+    def _watch_events(self):
+        while True:
+            fd = self.inotify_fd
+            if fd is None:
+                return
+            try:
+                # waking up now and then to notice .close()
+                select.select([fd], [], [], 1.0)
+            except (select.error, EnvironmentError, ValueError):
+                pass
+            with self.lock:
+                self._read_events()
+
+    def _read_events(self):
+        # must be called with self.lock acquired.
+        if self.inotify_fd is None:
+            return
+        while True:
+            try:
+                data = os.read(self.inotify_fd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                # EAGAIN = no more events
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    for path in list(self.entries):
+                        self._invalidate(path)
+                    continue
+                for path in list(self.watches.get(wd, ())):
+                    self._invalidate(path)
+                if mask & IN_IGNORED:
+                    # folder is gone and kernel dropped the watch.
+                    for path in self.watches.pop(wd, ()):
+                        if path in self.entries:
+                            self.entries[path][3] = None
+
+    def close(self):
+        '''
+        Stops watching folders. (Entries are then checked per ttl only.)
+        '''
+        with self.lock:
+            if self.inotify_fd is not None:
+                os.close(self.inotify_fd)
+                self.inotify_fd = None
+            self.watches = {}
+            for entry in self.entries.values():
+                entry[3] = None
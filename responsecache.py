@@ -0,0 +1,754 @@
+#!/usr/bin/env python
+'''
+Module provides caches for the responses git_http_backend produces by running
+git subprocesses, along with the helpers needed to decide if a cached response
+is still valid for a given repo.
+
+Responses generated by git depend only on the state of the repo. The refs
+advertisement (/info/refs) in particular changes only when refs change, so we
+key the cached data on a cheap "fingerprint" of repo's ref state - stat data of
+HEAD, packed-refs and all loose refs - instead of asking git every time.
+The same is true for the packs upload-pack sends in reply to a given set of
+wants and haves, so those are cached (on disk) too.
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+from lru import LRU
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+def _b(s):
+    if isinstance(s, text_type):
+        return s.encode('utf8')
+    return s
+
+def _stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return b'-'
+    return _b('%d:%d:%r' % (st.st_ino, st.st_size, st.st_mtime))
+
+def ref_state_fingerprint(repo_path):
+    '''
+    Returns a hex string that changes every time any of the repo's refs change.
+
+    We don't read any of the refs. Stat data (inode, size, mtime) of HEAD,
+    packed-refs and of every file under refs/ is enough, because git updates
+    refs by renaming a freshly written lock file over the old one.
+
+    @param repo_path A path to the (bare) repo folder.
+    @return A string (40 hex chars)
+    '''
+    h = hashlib.sha1()
+    for name in ('HEAD', 'packed-refs'):
+        h.update(_b(name) + b'=' + _stat_signature(os.path.join(repo_path, name)) + b'\n')
+    refs_root = os.path.join(repo_path, 'refs')
+    for root, dirs, files in os.walk(refs_root):
+        dirs.sort() # walk order is filesystem-specific. We need it stable.
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            h.update(_b(path[len(refs_root):]) + b'=' + _stat_signature(path) + b'\n')
+    return h.hexdigest()
+
+class RecordingIterator(object):
+    '''
+    Iterator wrapper that passes through the chunks of the wrapped iterator
+    while keeping a copy of them. Once the wrapped iterator is exhausted, the
+    recorded content is handed to a callback. If the wrapped iterator is closed
+    or errors out before it is exhausted, the recording is discarded.
+
+    Recording stops (and is discarded) once it exceeds max_bytes.
+    '''
+    def __init__(self, source, on_complete, max_bytes = None):
+        self.source = source
+        self.on_complete = on_complete
+        self.max_bytes = max_bytes
+        self.chunks = []
+        self.size = 0
+        self.recording = True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            chunk = next(self.source)
+        except StopIteration:
+            if self.recording:
+                self.recording = False
+                self.on_complete(b''.join(self.chunks))
+                self.chunks = []
+            raise
+        if self.recording:
+            self.size += len(chunk)
+            if self.max_bytes is not None and self.size > self.max_bytes:
+                self.recording = False
+                self.chunks = []
+            else:
+                self.chunks.append(bytes(chunk))
+        return chunk
+    __next__ = next
+
+    def close(self):
+        self.recording = False
+        self.chunks = []
+        try:
+            self.source.close()
+        except AttributeError:
+            pass
+
+class AdvertisementCache(object):
+    '''
+    LRU cache of refs advertisement responses (the body of /info/refs replies).
+
+    Entries are stored per (repo_path, service) and carry the ref state
+    fingerprint they were generated for. A lookup with a different fingerprint
+    is a miss, so at most one (the latest) advertisement per repo and service
+    is ever held. Memory use is capped by max_bytes; least recently used
+    entries are dropped to make room.
+
+    When cache_dir is given, entries are also written to (and looked up in)
+    that folder, allowing several worker processes to share the cache.
+    On-disk usage is capped by max_disk_bytes, oldest files are removed first.
+
+    Since fingerprints are based on stat data, changes made within the
+    resolution of the filesystem's mtime may go unnoticed. Code that changes
+    refs (receive-pack handler) must call .invalidate(repo_path) when it is done.
+    '''
+
+    def __init__(self, max_bytes = 16777216, cache_dir = None, max_disk_bytes = 268435456):
+        '''
+        @param max_bytes (Default: 16 MB) In-memory budget for cached content.
+        @param cache_dir (Default: None) Folder for shared on-disk cache. Created if missing.
+        @param max_disk_bytes (Default: 256 MB) On-disk budget for cached content.
+        '''
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = LRU()
+        self.size = 0
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir and not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def _file_prefix(self, repo_path):
+        return hashlib.sha1(_b(repo_path)).hexdigest()
+
+    def _file_path(self, repo_path, service):
+        return os.path.join(
+            self.cache_dir,
+            '%s.%s' % (self._file_prefix(repo_path), hashlib.sha1(_b(service)).hexdigest()[:16])
+            )
+
+    def get(self, repo_path, service, fingerprint):
+        '''
+        Returns the cached advertisement (bytes) or None if there is no
+        advertisement cached for this ref state.
+        '''
+        key = (repo_path, service)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == fingerprint:
+                self.entries.touch(key)
+                self.hits += 1
+                return entry[1]
+        data = self._disk_get(repo_path, service, fingerprint)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._store(key, fingerprint, data)
+        return data
+
+    def generation(self, repo_path):
+        '''
+        Returns a token to be passed to .put() along with the data
+        generated after this call. If the repo is invalidated in the meantime,
+        .put() discards the data as potentially stale.
+        '''
+        with self.lock:
+            return self.generations.get(repo_path, 0)
+
+    def put(self, repo_path, service, fingerprint, data, generation = None):
+        with self.lock:
+            if generation is not None and generation != self.generations.get(repo_path, 0):
+                return
+            self._store((repo_path, service), fingerprint, data)
+        self._disk_put(repo_path, service, fingerprint, data)
+
+    def _store(self, key, fingerprint, data):
+        # must be called with self.lock acquired.
+        old = self.entries.pop(key, None)
+        if old:
+            self.size -= len(old[1])
+        if len(data) > self.max_bytes:
+            return
+        self.entries[key] = (fingerprint, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _k, (_f, _d) = self.entries.popitem(last = False)
+            self.size -= len(_d)
+
+    def invalidate(self, repo_path):
+        '''
+        Drops all cached advertisements for a given repo, in memory and on disk.
+        '''
+        with self.lock:
+            self.generations[repo_path] = self.generations.get(repo_path, 0) + 1
+            for key in [k for k in self.entries if k[0] == repo_path]:
+                self.size -= len(self.entries.pop(key)[1])
+        if self.cache_dir:
+            prefix = self._file_prefix(repo_path) + '.'
+            for name in os.listdir(self.cache_dir):
+                if name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+
+    def wrap(self, output, repo_path, service, fingerprint):
+        '''
+        Returns an iterator passing through the chunks of output, storing the
+        complete output in the cache once output is exhausted.
+        '''
+        generation = self.generation(repo_path)
+        def on_complete(data):
+            self.put(repo_path, service, fingerprint, data, generation)
+        return RecordingIterator(output, on_complete, self.max_bytes)
+
+    ####################
+    # On-disk storage
+    ####################
+
+    def _disk_get(self, repo_path, service, fingerprint):
+        if not self.cache_dir:
+            return None
+        try:
+            f = open(self._file_path(repo_path, service), 'rb')
+        except IOError:
+            return None
+        try:
+            if f.readline().strip() != _b(fingerprint):
+                return None
+            return f.read()
+        finally:
+            f.close()
+
+    def _disk_put(self, repo_path, service, fingerprint, data):
+        if not self.cache_dir or len(data) > self.max_disk_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(prefix = '.tmp', dir = self.cache_dir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(_b(fingerprint) + b'\n')
+                f.write(data)
+            finally:
+                f.close()
+            # rename is atomic, readers in other processes see either old or new file.
+            os.rename(tmp_path, self._file_path(repo_path, service))
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._disk_prune()
+
+    def _disk_prune(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        while total > self.max_disk_bytes and files:
+            _m, size, path = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+def read_pkt_lines(data):
+    '''
+    Splits a string of Git pkt-line-formatted data into a list of payloads.
+    Flush packets (0000) are returned as None, delimiter packets (0001) as ''.
+
+    @return A list or None, if the data is not well-formed pkt-line data.
+    '''
+    lines = []
+    i = 0
+    while i < len(data):
+        try:
+            size = int(data[i:i + 4], 16)
+        except ValueError:
+            return None
+        if size == 0:
+            lines.append(None)
+            size = 4
+        elif size < 4:
+            lines.append(b'')
+            size = 4
+        elif i + size > len(data):
+            return None
+        else:
+            lines.append(data[i + 4:i + size])
+        i += size
+    return lines
+
+def normalize_upload_pack_request(data, protocol_version = 0):
+    '''
+    Returns a canonical form of an upload-pack (stateless-rpc) request body,
+    such that requests differing only in the order of wants, order of
+    capabilities, or in the client's agent string have the same normalized
+    form.
+
+    Only requests carrying "done" are normalized. These are the requests
+    answered with a pack. Anything else, (or anything we don't understand)
+    returns None, which means "don't cache".
+
+    @param data A string with the (decompressed) body of the request.
+    @param protocol_version (Default: 0) Wire protocol version the request
+        is made in. Version 2 requests are "command=fetch" requests.
+    @return A string or None
+    '''
+    lines = read_pkt_lines(data)
+    if not lines:
+        return None
+    if protocol_version == 2:
+        return _normalize_fetch_command(lines)
+    wants = []
+    haves = []
+    capabilities = set()
+    other = []
+    done = False
+    for line in lines:
+        if line is None:
+            continue
+        line = line.rstrip(b'\n')
+        if line.startswith(b'want '):
+            parts = line.split(b' ')
+            wants.append(parts[1])
+            capabilities.update(
+                c for c in parts[2:]
+                if c and not c.startswith(b'agent=') and not c.startswith(b'session-id=')
+                )
+        elif line.startswith(b'have '):
+            # order of haves changes the order of ACKs in the answer, keeping it.
+            haves.append(line[5:])
+        elif line == b'done':
+            done = True
+        elif line.split(b' ')[0] in (b'shallow', b'deepen', b'deepen-since', b'deepen-not', b'filter'):
+            other.append(line)
+        else:
+            return None
+    if not done or not wants:
+        return None
+    return b'\n'.join([
+        b'want ' + b' '.join(sorted(wants)),
+        b'capabilities ' + b' '.join(sorted(capabilities)),
+        b'other ' + b'|'.join(sorted(other)),
+        b'have ' + b' '.join(haves),
+        b'done'
+        ])
+
+# arguments of protocol v2 "fetch" command.
+_fetch_flags = (b'thin-pack', b'no-progress', b'include-tag', b'ofs-delta', b'sideband-all')
+_fetch_other = (b'shallow', b'deepen', b'deepen-since', b'deepen-not', b'deepen-relative', b'filter', b'want-ref')
+
+def _normalize_fetch_command(lines):
+    # command=fetch, capabilities, delimiter (''), arguments, flush (None).
+    # git sends the first two sections without trailing newlines.
+    if lines[0] is None or lines[0].rstrip(b'\n') != b'command=fetch' or b'' not in lines:
+        return None
+    delimiter = lines.index(b'')
+    capabilities = set()
+    for line in lines[1:delimiter]:
+        if line is None:
+            return None
+        line = line.rstrip(b'\n')
+        if line.startswith(b'server-option='):
+            # could mean anything to the server's hooks.
+            return None
+        if not line.startswith(b'agent=') and not line.startswith(b'session-id='):
+            capabilities.add(line)
+    wants = []
+    haves = []
+    other = []
+    done = False
+    for line in lines[delimiter + 1:]:
+        if line is None:
+            continue
+        line = line.rstrip(b'\n')
+        if line.startswith(b'want '):
+            wants.append(line[5:])
+        elif line.startswith(b'have '):
+            haves.append(line[5:])
+        elif line == b'done':
+            done = True
+        elif line in _fetch_flags:
+            capabilities.add(line)
+        elif line.split(b' ')[0] in _fetch_other:
+            other.append(line)
+        else:
+            return None
+    if not done or not (wants or other):
+        return None
+    return b'\n'.join([
+        b'command=fetch',
+        b'want ' + b' '.join(sorted(set(wants))),
+        b'capabilities ' + b' '.join(sorted(capabilities)),
+        b'other ' + b'|'.join(sorted(other)),
+        b'have ' + b' '.join(haves),
+        b'done'
+        ])
+
+class PackResponseCache(object):
+    '''
+    On-disk cache of upload-pack responses.
+
+    Entries are keyed on repo path, ref state fingerprint and normalized
+    request body (see normalize_upload_pack_request). Each entry is a file
+    in cache_dir, named after the key. Cache hits are returned as open file
+    objects, fit for serving through wsgi.file_wrapper.
+
+    The cache is filled as the response streams to the first client (see
+    .fill()). While that happens, a lock file marks the entry as "being filled"
+    for all processes sharing the cache_dir, so that other workers wait for
+    the entry (see .wait()) instead of generating the same pack again.
+    The lock file is flock()ed by the filling worker (where fcntl is
+    available), so that a worker dying mid-fill frees it right away.
+    Elsewhere lock files older than stale_lock_age are taken to be
+    abandoned.
+
+    Counters:
+        hits, misses - .get() calls finding / not finding the entry.
+        wait_hits, wait_misses - .wait() calls getting the entry filled by
+            the other worker / giving up on it.
+
+    Total size of cached files is capped by max_bytes. Least recently used
+    (served or filled) entries are removed first.
+    '''
+
+    def __init__(self, cache_dir, max_bytes = 1073741824, max_entry_bytes = 268435456,
+            max_request_bytes = 1048576, fill_wait = 30, stale_lock_age = 60):
+        '''
+        @param cache_dir A folder for cached files. Created if missing.
+        @param max_bytes (Default: 1 GB) Total size budget for cached files.
+        @param max_entry_bytes (Default: 256 MB) Responses larger than this are not cached.
+        @param max_request_bytes (Default: 1 MB) Requests with bodies larger than this are not cached.
+        @param fill_wait (Default: 30) Seconds to wait for an entry being filled by other worker.
+        @param stale_lock_age (Default: 60) Age in seconds after which fill
+            lock is considered abandoned, where fcntl is not available.
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_request_bytes = max_request_bytes
+        self.fill_wait = fill_wait
+        self.stale_lock_age = stale_lock_age
+        self.hits = 0
+        self.misses = 0
+        self.wait_hits = 0
+        self.wait_misses = 0
+        # key : file descriptor of the (flock()ed) lock file we hold.
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def key(self, repo_path, fingerprint, normalized_request):
+        h = hashlib.sha1(_b(repo_path))
+        h.update(b'\0' + _b(fingerprint) + b'\0')
+        h.update(normalized_request)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pack')
+
+    def _lock_path(self, key):
+        return os.path.join(self.cache_dir, key + '.lock')
+
+    def get(self, key):
+        '''
+        Returns an open (binary) file object with cached response or None.
+        '''
+        f = self._open(key)
+        if f is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return f
+
+    def _open(self, key):
+        path = self._path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            # mtime is our "last used" marker for eviction.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    def lock(self, key):
+        '''
+        Marks the entry as "being filled."
+
+        @return True if the lock was acquired, False if someone else holds it.
+        '''
+        if fcntl:
+            return self._flock(key)
+        path = self._lock_path(key)
+        for attempt in (0, 1):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return True
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    return False
+            try:
+                if time.time() - os.stat(path).st_mtime > self.stale_lock_age:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            return False
+        return False
+
+    def _flock(self, key):
+        path = self._lock_path(key)
+        for attempt in (0, 1, 2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_WRONLY, 0o644)
+            except OSError:
+                return False
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                return False
+            try:
+                # the holder could have removed the file (unlocking) between
+                # our open and flock. Then our lock is on a gone file.
+                if os.fstat(fd).st_ino == os.stat(path).st_ino:
+                    os.ftruncate(fd, 0)
+                    os.write(fd, ('%d\n' % os.getpid()).encode('ascii'))
+                    with self.locks_lock:
+                        self.locks[key] = fd
+                    return True
+            except OSError:
+                pass
+            os.close(fd)
+        return False
+
+    def _locked(self, key):
+        # is the entry being filled by a live worker?
+        path = self._lock_path(key)
+        if not fcntl:
+            return os.path.exists(path)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return True
+        finally:
+            os.close(fd)
+        # left behind by a worker gone mid-fill.
+        return False
+
+    def unlock(self, key):
+        try:
+            os.remove(self._lock_path(key))
+        except OSError:
+            pass
+        with self.locks_lock:
+            fd = self.locks.pop(key, None)
+        if fd is not None:
+            os.close(fd)
+
+    def wait(self, key, timeout = None):
+        '''
+        Waits for the entry to be filled by someone else.
+
+        @return An open file object or None if the fill was abandoned or
+            did not complete in time.
+        '''
+        if timeout is None:
+            timeout = self.fill_wait
+        deadline = time.time() + timeout
+        delay = 0.05
+        while time.time() < deadline:
+            if not self._locked(key):
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+        f = self._open(key)
+        if f is None:
+            self.wait_misses += 1
+        else:
+            self.wait_hits += 1
+        return f
+
+    def fill(self, key, output):
+        '''
+        Returns an iterator passing through the chunks of output while
+        writing them to a temporary file. Once output is exhausted (and the
+        process behind it, if any, exited cleanly), the file becomes the
+        cache entry. Caller must hold the lock (see .lock()), the iterator
+        releases it when done.
+        '''
+        return PackCacheFiller(self, key, output)
+
+    def _commit(self, key, tmp_path):
+        os.rename(tmp_path, self._path(key))
+        self.unlock(key)
+        self.prune()
+
+    def prune(self):
+        files = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pack'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        while total > self.max_bytes and files:
+            _m, size, path = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+class PackCacheFiller(object):
+    '''
+    Iterator, tee-ing the output into PackResponseCache entry.
+    See PackResponseCache.fill()
+    '''
+    def __init__(self, cache, key, output):
+        self.cache = cache
+        self.key = key
+        self.output = output
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(prefix = '.tmp', dir = cache.cache_dir)
+        self.file = os.fdopen(fd, 'wb')
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            chunk = next(self.output)
+        except StopIteration:
+            self._finish()
+            raise
+        except:
+            self._abandon()
+            raise
+        if self.file:
+            self.size += len(chunk)
+            if self.size > self.cache.max_entry_bytes:
+                self._abandon()
+            else:
+                try:
+                    self.file.write(chunk)
+                except (IOError, OSError):
+                    self._abandon()
+        return chunk
+    __next__ = next
+
+    def _finish(self):
+        if not self.file:
+            return
+        process = getattr(self.output, 'process', None)
+        if process is not None and process.wait():
+            self._abandon()
+            return
+        try:
+            self.file.close()
+            self.file = None
+            self.cache._commit(self.key, self.tmp_path)
+        except (IOError, OSError):
+            self._abandon()
+
+    def _abandon(self):
+        if self.file:
+            try:
+                self.file.close()
+            except (IOError, OSError):
+                pass
+            self.file = None
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+            self.cache.unlock(self.key)
+
+    def close(self):
+        self._abandon()
+        try:
+            self.output.close()
+        except AttributeError:
+            pass
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+'''
+Module provides a threaded WSGI server built on Python's wsgiref, for
+running git_http_backend without installing a third-party server.
+
+On top of wsgiref, the server:
+- reads request bodies sent with "Transfer-Encoding: chunked" (large pushes)
+  and limits wsgi.input to Content-Length otherwise, so that apps reading
+  wsgi.input to EOF (as git_http_backend does) get their EOF.
+- sends responses returned through wsgi.file_wrapper without copying the
+  data through Python, where the platform allows: pipes (git's stdout, see
+  subprocessio.SubprocessIOFile) are moved with splice(), regular files
+  with sendfile(). Both are Linux system calls. Elsewhere, and for other
+  kinds of file-likes, the response is copied by reading and writing as usual.
+  File-likes with .remaining attribute (git_http_backend.RangeFile) have
+  only that many bytes sent, from .offset if they have one (descriptors
+  shared through filecache.FileCache) or from the current file position.
+  (The server's wsgi.file_wrapper tells apps so, see RangeFileWrapper.)
+
+Copyright (c) 2011  Daniel Dotsenko <dotsa@hotmail.com>
+
+This file is part of git_http_backend.py Project.
+
+git_http_backend.py Project is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 2.1 of the License, or
+(at your option) any later version.
+
+git_http_backend.py Project is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with git_http_backend.py Project.  If not, see <http://www.gnu.org/licenses/>.
+'''
+import os
+import stat
+import errno
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+from wsgiref.util import FileWrapper
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+def _libc_function(name, restype, *argtypes):
+    if ctypes is None:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    function.restype = restype
+    function.argtypes = argtypes
+    def call(*args):
+        result = function(*args)
+        if result < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return result
+    return call
+
+if hasattr(os, 'splice'):
+    # Python 3.10+
+    def splice(src, dst, count):
+        return os.splice(src, dst, count, flags = SPLICE_F_MOVE | SPLICE_F_MORE)
+else:
+    _splice = ctypes and _libc_function(
+        'splice', ctypes.c_ssize_t,
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint)
+    if _splice:
+        def splice(src, dst, count):
+            return _splice(src, None, dst, None, count, SPLICE_F_MOVE | SPLICE_F_MORE)
+    else:
+        splice = None
+
+if hasattr(os, 'sendfile'):
+    # Python 3.3+
+    def sendfile(src, dst, count, offset = None):
+        return os.sendfile(dst, src, offset, count)
+else:
+    _sendfile = ctypes and _libc_function(
+        'sendfile64', ctypes.c_ssize_t,
+        ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+    if _sendfile:
+        def sendfile(src, dst, count, offset = None):
+            if offset is None:
+                return _sendfile(dst, src, None, count)
+            # sendfile() with an offset leaves the file position alone.
+            return _sendfile(dst, src, ctypes.byref(ctypes.c_int64(offset)), count)
+    else:
+        sendfile = None
+
+class LimitedReader(object):
+    '''
+    File-like returning at most length bytes of source file-like.
+    '''
+    def __init__(self, source, length):
+        self.source = source
+        self.remaining = length
+
+    def read(self, size = -1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b''
+        data = self.source.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size = -1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b''
+        data = self.source.readline(size)
+        self.remaining -= len(data)
+        return data
+
+class ChunkedReader(object):
+    '''
+    File-like returning the decoded contents of a "Transfer-Encoding: chunked"
+    request body.
+    '''
+    def __init__(self, source):
+        self.source = source
+        self.remaining = 0
+        self.eof = False
+
+    def _next_chunk(self):
+        line = self.source.readline(1024)
+        try:
+            self.remaining = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError('Invalid chunk size line in chunked request body')
+        if not self.remaining:
+            # skipping trailers
+            while self.source.readline(1024).strip():
+                pass
+            self.eof = True
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            chunks = []
+            data = self.read(65536)
+            while data:
+                chunks.append(data)
+                data = self.read(65536)
+            return b''.join(chunks)
+        if self.eof or not size:
+            return b''
+        if not self.remaining:
+            self._next_chunk()
+            if self.eof:
+                return b''
+        data = self.source.read(min(size, self.remaining))
+        if not data:
+            raise IOError('Chunked request body ended prematurely')
+        self.remaining -= len(data)
+        if not self.remaining:
+            # CRLF closing the chunk's data
+            self.source.readline(1024)
+        return data
+
+    def readline(self, size = -1):
+        line = []
+        while size is None or size < 0 or len(line) < size:
+            c = self.read(1)
+            if not c:
+                break
+            line.append(c)
+            if c == b'\n':
+                break
+        return b''.join(line)
+
+class RangeFileWrapper(FileWrapper):
+    '''
+    wsgi.file_wrapper of the server. Tells apps (by sends_ranges) that of
+    file-likes with .remaining and .offset attributes, just that range is
+    sent, leaving the file position alone.
+    '''
+    sends_ranges = True
+
+class FileTransferServerHandler(ServerHandler):
+    '''
+    wsgiref's ServerHandler sending wsgi.file_wrapper responses with
+    splice() or sendfile(), whichever fits the file descriptor at hand.
+    '''
+    transfer_size = 1048576
+    wsgi_file_wrapper = RangeFileWrapper
+
+    def sendfile(self):
+        filelike = self.result.filelike
+        try:
+            src = filelike.fileno()
+            dst = self.stdout.fileno()
+            mode = os.fstat(src).st_mode
+        except (AttributeError, IOError, OSError, ValueError):
+            return False
+        if stat.S_ISFIFO(mode):
+            move = splice
+        elif stat.S_ISREG(mode):
+            move = sendfile
+        else:
+            move = None
+        if move is None:
+            return False
+
+        if not self.headers_sent:
+            self.send_headers()
+        pending = getattr(filelike, 'pending', b'')
+        if pending:
+            # data already read off the pipe by subprocessio.SubprocessIOFile
+            filelike.pending = b''
+            self._write(pending)
+            self.bytes_sent += len(pending)
+        self._flush()
+
+        # byte ranges (git_http_backend.RangeFile) end before the end of file.
+        remaining = getattr(filelike, 'remaining', None)
+        offset = getattr(filelike, 'offset', None) if move is sendfile else None
+        moved = False
+        while remaining is None or remaining > 0:
+            size = self.transfer_size if remaining is None else min(remaining, self.transfer_size)
+            try:
+                if offset is None:
+                    sent = move(src, dst, size)
+                else:
+                    sent = move(src, dst, size, offset)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EINVAL, errno.ENOSYS) and not moved:
+                    # not supported for this pair of descriptors. Copying.
+                    for data in self.result:
+                        self.write(data)
+                    return True
+                raise
+            if not sent:
+                return True
+            moved = True
+            self.bytes_sent += sent
+            if offset is not None:
+                offset += sent
+                filelike.offset = offset
+            if remaining is not None:
+                remaining -= sent
+                filelike.remaining = remaining
+        return True
+
+class RequestHandler(WSGIRequestHandler):
+    '''
+    wsgiref's request handler using FileTransferServerHandler and presenting
+    the request body as a file-like that ends where the body ends.
+    '''
+    def handle(self):
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            body = ChunkedReader(self.rfile)
+        else:
+            body = LimitedReader(self.rfile, int(self.headers.get('Content-Length') or 0))
+
+        handler = FileTransferServerHandler(
+            body, self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def make_server(host, port, app):
+    '''
+    Returns a ThreadingWSGIServer instance serving app on host:port.
+    Call its .serve_forever() to run it.
+    '''
+    server = ThreadingWSGIServer((host, port), RequestHandler)
+    server.set_app(app)
+    return server
@@ -26,7 +26,23 @@ along with git_http_backend.py Project.  If not, see <http://www.gnu.org/license
 from collections import deque
 import threading
 import subprocess
+import processlauncher
+import tempfile
+import select
+import errno
+import time
+import io
 import os
+try:
+    import fcntl
+except ImportError:
+    # Windows. IOReactor is not available there.
+    fcntl = None
+
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
 
 class StreamFeeder(threading.Thread):
     """
@@ -34,16 +50,18 @@ class StreamFeeder(threading.Thread):
     This thread allows a thread to seep data from a file-like into a pipe
     without blocking the main thread.
     We close inpipe once the end of the source stream is reached.
+    If reading the source fails, the exception is kept as .error.
     """
     def __init__(self, source):
         super(StreamFeeder,self).__init__()
         self.daemon = True
         filelike = False
         self.bytes = b''
+        self.error = None
         if type(source) in (type(''),bytes,bytearray): # string-like
             self.bytes = bytes(source)
         else: # can be either file pointer or file-like
-            if type(source) in (int, long): # file pointer it is
+            if isinstance(source, integer_types): # file pointer it is
                 ## converting file descriptor (int) stdin into file-like
                 try:
                     source = os.fdopen(source, 'rb', 16384)
@@ -57,26 +75,94 @@ class StreamFeeder(threading.Thread):
         if not filelike and not self.bytes:
             raise TypeError("StreamFeeder's source object must be a readable file-like, a file descriptor, or a string-like.")
         self.source = source
-        self.readiface, self.writeiface = os.pipe()
+        self.readiface, self.writeiface = processlauncher.pipe()
 
     def run(self):
         t = self.writeiface
-        if self.bytes:
-            os.write(t, self.bytes)
-        else:
-            s = self.source
-            b = s.read(4096)
-            while b:
-                os.write(t, b)
+        try:
+            if self.bytes:
+                os.write(t, self.bytes)
+            else:
+                s = self.source
                 b = s.read(4096)
-        os.close(t)
+                while b:
+                    try:
+                        os.write(t, b)
+                    except OSError:
+                        # subprocess is gone. Why is reported through its output.
+                        return
+                    b = s.read(4096)
+        except (IOError, OSError) as e:
+            # source failed (say, git_http_backend.RequestBodyTooLarge).
+            # Subprocess sees the input cut short and fails, but the reason
+            # is ours to report.
+            self.error = e
+        finally:
+            os.close(t)
 
     @property
     def output(self):
         return self.readiface
 
+class BufferPool(object):
+    '''
+    Thread-safe pool of reusable, same-size bytearrays.
+
+    Used by BufferedGenerator in pool mode to read subprocess output into
+    preallocated buffers with readinto() instead of allocating a new string
+    for every chunk. One pool may be shared by any number of generators.
+
+    allocated counts buffers ever created, reused counts buffers handed out
+    again. With a pool in steady use, allocated stays flat while reused grows.
+    '''
+    def __init__(self, chunk_size = 65536, max_free = 64):
+        '''
+        @param chunk_size (Default: 65536) Size of each buffer in bytes.
+        @param max_free (Default: 64) Max number of idle buffers kept for reuse.
+        '''
+        self.chunk_size = chunk_size
+        self.max_free = max_free
+        self.free = []
+        self.lock = threading.Lock()
+        self.allocated = 0
+        self.reused = 0
+
+    def get(self):
+        with self.lock:
+            if self.free:
+                self.reused += 1
+                return self.free.pop()
+            self.allocated += 1
+        return bytearray(self.chunk_size)
+
+    def put(self, buf):
+        with self.lock:
+            if len(self.free) < self.max_free:
+                self.free.append(buf)
+
+    @property
+    def idle(self):
+        return len(self.free)
+
 class InputStreamChunker(threading.Thread):
-    def __init__(self, source, target, buffer_size, chunk_size):
+    '''
+    Thread reading chunks from source into target deque.
+
+    The deque is a bounded buffer: once buffer_size bytes are in it, reading
+    pauses until the consumer takes something out. (If bottomless, reading never pauses and the oldest chunks
+    are dropped instead.) Both sides wait on, and signal through, one
+    threading.Condition - there is no polling.
+
+    If pool (a BufferPool) is given, chunks are (buffer, length) tuples of
+    pooled bytearrays filled with readinto(). Whatever is readable right away
+    is coalesced into one chunk, up to the pool's chunk size. Buffers count
+    against buffer_size in full, so one reader holds at most
+    buffer_size / pool.chunk_size + 2 of them.
+
+    on_pause (if given) is called (in the thread, with the condition's lock
+    held) every time reading pauses for the buffer being full.
+    '''
+    def __init__(self, source, target, buffer_size, chunk_size, bottomless = False, condition = None, pool = None, on_pause = None):
 
         super(InputStreamChunker,self).__init__()
 
@@ -84,14 +170,19 @@ class InputStreamChunker(threading.Thread):
 
         self.source = source
         self.target = target
-        self.chunk_count_max = int(buffer_size / chunk_size) + 1
+        self.buffer_size = buffer_size
         self.chunk_size = chunk_size
+        self.bottomless = bottomless
+        self.pool = pool
+        self.on_pause = on_pause
 
-        self.data_added = threading.Event()
-        self.data_added.clear()
+        self.cond = condition or threading.Condition()
+        self.size = sum(len(x) for x in target)
+        self.paused = False
 
-        self.keep_reading = threading.Event()
-        self.keep_reading.set()
+        self.data_added = threading.Event()
+        if target:
+            self.data_added.set()
 
         self.EOF = threading.Event()
         self.EOF.clear()
@@ -102,6 +193,8 @@ class InputStreamChunker(threading.Thread):
     def stop(self):
         self.go.clear()
         self.EOF.set()
+        with self.cond:
+            self.cond.notify_all()
         try:
             # this is not proper, but is done to force the reader thread let go of
             # the input because, if successful, .close() will send EOF down the pipe.
@@ -109,56 +202,119 @@ class InputStreamChunker(threading.Thread):
         except:
             pass
 
-    def run(self):
+    def read_chunks(self):
         s = self.source
-        t = self.target
         cs = self.chunk_size
-        ccm = self.chunk_count_max
-        kr = self.keep_reading
-        da = self.data_added
-        go = self.go
         b = s.read(cs)
-        while b and go.is_set():
-            if len(t) > ccm:
-                kr.clear()
-                kr.wait(2)
-#                # this only works on 2.7.x and up
-#                if not kr.wait(10):
-#                    raise Exception("Timed out while waiting for input to be read.")
-                # instead we'll use this
-                if len(t) > ccm + 3:
-                    raise IOError("Timed out while waiting for input from subprocess.")
-            t.append(b)
-            da.set()
+        while b:
+            yield b, len(b)
             b = s.read(cs)
-        self.EOF.set()
-        da.set() # for cases when done but there was no input.
+
+    def read_pooled_chunks(self):
+        pool = self.pool
+        s = self.source
+        try:
+            fd = s.fileno()
+            # unbuffered reads of what is there, not blocking until buffer is full.
+            raw = io.FileIO(fd, 'r', closefd = False)
+        except (AttributeError, IOError, OSError, ValueError):
+            fd = None
+            raw = s
+        while True:
+            buf = pool.get()
+            view = memoryview(buf)
+            size = len(buf)
+            n = raw.readinto(view)
+            while n and n < size and fd is not None and select.select([fd], [], [], 0)[0]:
+                # coalescing what is already waiting in the pipe.
+                more = raw.readinto(view[n:])
+                if not more:
+                    break
+                n += more
+            if not n:
+                pool.put(buf)
+                return
+            yield buf, n
+
+    def run(self):
+        t = self.target
+        bs = self.buffer_size
+        cond = self.cond
+        go = self.go
+        pool = self.pool
+        chunks = self.read_pooled_chunks() if pool else self.read_chunks()
+        try:
+            for b, l in chunks:
+                if not go.is_set():
+                    if pool:
+                        pool.put(b)
+                    break
+                if pool:
+                    # buffer held counts in full, no matter how much is in it.
+                    b, l = (b, l), len(b)
+                with cond:
+                    if self.bottomless:
+                        while t and self.size + l > bs:
+                            self.discard(t.popleft())
+                    else:
+                        if self.size >= bs and self.on_pause:
+                            self.on_pause()
+                        while self.size >= bs and go.is_set():
+                            self.paused = True
+                            cond.notify_all()
+                            cond.wait()
+                        self.paused = False
+                    t.append(b)
+                    self.size += l
+                    self.data_added.set()
+                    cond.notify_all()
+        except (IOError, OSError, ValueError):
+            # source was closed under us by stop()
+            pass
+        finally:
+            with cond:
+                self.EOF.set()
+                self.data_added.set() # for cases when done but there was no input.
+                cond.notify_all()
+
+    def discard(self, chunk):
+        if type(chunk) is tuple:
+            self.size -= len(chunk[0])
+            self.pool.put(chunk[0])
+        else:
+            self.size -= len(chunk)
 
 class BufferedGenerator():
     '''
     Class behaves as a non-blocking, buffered pipe reader.
     Reads chunks of data (through a thread)
     from a blocking pipe, and attaches these to an array (Deque) of chunks.
-    Reading is halted in the thread when max chunks is internally buffered.
-    The .next() may operate in blocking or non-blocking fashion by yielding
-    '' if no data is ready
-    to be sent or by not returning until there is some data to send
+    Reading is halted in the thread when buffer_size bytes are internally buffered.
+    The .next() does not return until there is some data to send.
     When we get EOF from underlying source pipe we raise the marker to raise
     StopIteration after the last chunk of data is yielded.
-    '''
 
-    def __init__(self, source, buffer_size = 65536, chunk_size = 4096, starting_values = [], bottomless = False):
+    Several generators may share one threading.Condition (condition argument)
+    to allow waiting for a change in any of them.
 
-        if bottomless:
-            maxlen = int(buffer_size / chunk_size)
-        else:
-            maxlen = None
+    In pool mode (pool argument set to a BufferPool) output is read into
+    reusable buffers and .next() returns memoryview objects (chunk_size is
+    then ignored in favor of the pool's chunk size). A returned memoryview
+    is only valid until the following call to .next() or .close(), when its
+    buffer goes back to the pool. Consumers (WSGI servers) must be done with
+    (i.e. have written out) a chunk before asking for the next one.
+
+    on_pause is passed on to InputStreamChunker.
+    '''
 
-        self.data = deque(starting_values, maxlen)
+    def __init__(self, source, buffer_size = 65536, chunk_size = 4096, starting_values = [], bottomless = False, condition = None, pool = None, on_pause = None):
 
-        self.worker = InputStreamChunker(source, self.data, buffer_size, chunk_size)
-        if starting_values:
-            self.worker.data_added.set()
+        self.data = deque(starting_values)
+        self.pool = pool
+        self.lent = None
+
+        self.worker = InputStreamChunker(source, self.data, buffer_size, chunk_size, bottomless, condition, pool, on_pause)
+        self.cond = self.worker.cond
         self.worker.start()
 
     ####################
@@ -169,14 +325,30 @@ class BufferedGenerator():
         return self
 
     def next(self):
-        while not len(self.data) and not self.worker.EOF.is_set():
-            self.worker.data_added.clear()
-            self.worker.data_added.wait(0.2)
-        if len(self.data):
-            self.worker.keep_reading.set()
-            return bytes(self.data.popleft())
-        elif self.worker.EOF.is_set():
-            raise StopIteration
+        if self.lent is not None:
+            self.pool.put(self.lent)
+            self.lent = None
+        with self.cond:
+            while not self.data and not self.worker.EOF.is_set():
+                self.cond.wait()
+            if self.data:
+                b = self.data.popleft()
+                if not self.data:
+                    self.worker.data_added.clear()
+                if type(b) is tuple:
+                    b, l = b
+                    self.worker.size -= len(b)
+                    self.lent = b
+                    b = memoryview(b)[:l]
+                else:
+                    self.worker.size -= len(b)
+                    b = bytes(b)
+                if self.worker.paused:
+                    self.cond.notify_all()
+                return b
+        raise StopIteration
+
+    __next__ = next
 
     def throw(self, type, value=None, traceback=None):
         if not self.worker.EOF.is_set():
@@ -194,6 +366,13 @@ class BufferedGenerator():
             self.throw(GeneratorExit)
         except (GeneratorExit, StopIteration):
             pass
+        if self.pool:
+            with self.cond:
+                while self.data:
+                    self.worker.discard(self.data.popleft())
+            if self.lent is not None:
+                self.pool.put(self.lent)
+                self.lent = None
 
     def __del__(self):
         self.close()
@@ -214,7 +393,7 @@ class BufferedGenerator():
 
     @property
     def reading_paused(self):
-        return not self.worker.keep_reading.is_set()
+        return self.worker.paused
 
     @property
     def done_reading_event(self):
@@ -256,18 +435,138 @@ class BufferedGenerator():
         '''
         return len(self.data)
 
+    @property
+    def size(self):
+        '''
+        returns int. Combined size (in bytes) of the buffered chunks.
+        '''
+        return self.worker.size
+
     def prepend(self, x):
-        self.data.appendleft(x)
+        with self.cond:
+            self.data.appendleft(x)
+            self.worker.size += len(x)
+            self.cond.notify_all()
 
     def append(self, x):
-        self.data.append(x)
+        with self.cond:
+            self.data.append(x)
+            self.worker.size += len(x)
+            self.cond.notify_all()
 
     def extend(self, o):
-        self.data.extend(o)
+        for x in o:
+            self.append(x)
 
     def __getitem__(self, i):
         return self.data[i]
 
+class SubprocessIOFile(object):
+    '''
+    File-like over the stdout pipe of a subprocess, as exposed by
+    SubprocessIOChunker in passthrough mode (.output attribute).
+
+    .fileno() returns the pipe's file descriptor, so that a WSGI server's
+    wsgi.file_wrapper can move the data with sendfile()/splice() instead
+    of reading it into Python. Data already taken off the pipe is in
+    .pending and must be sent before anything read from the fd directly.
+    .read() takes care of that on its own.
+
+    Callables in .on_close are called (once) when the file is closed.
+    '''
+    def __init__(self, process, error, pending = b'', chunk_size = 65536):
+        self.process = process
+        self.error = error
+        self.pending = pending
+        self.chunk_size = chunk_size
+        self.fd = process.stdout.fileno()
+        self.done_reading = False
+        self.on_close = []
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            chunks = [self.pending]
+            self.pending = b''
+            chunk = self.read(self.chunk_size)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(self.chunk_size)
+            return b''.join(chunks)
+        if self.pending:
+            data, self.pending = self.pending[:size], self.pending[size:]
+            return data
+        if self.done_reading or not size:
+            return b''
+        data = os.read(self.fd, size)
+        if not data:
+            self.done_reading = True
+            if self.process.wait():
+                raise EnvironmentError("Subprocess exited due to an error:\n" + ''.join(self.error))
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.read(self.chunk_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    __next__ = next
+
+    @property
+    def length(self):
+        return 1 if self.pending else 0
+
+    def close(self):
+        try:
+            if self.process.poll() is None:
+                self.process.terminate()
+        except:
+            pass
+        try:
+            self.process.stdout.close()
+        except:
+            pass
+        try:
+            self.error.close()
+        except:
+            pass
+        try:
+            # reaping it.
+            self.process.wait()
+        except:
+            pass
+        callbacks, self.on_close = self.on_close, []
+        for callback in callbacks:
+            callback()
+
+    def __del__(self):
+        self.close()
+
+def _process_started(metrics, process, started):
+    '''
+    Reports the subprocess, started at the time started, to metrics (a
+    metrics.RequestMetrics, or None.)
+
+    Returns a callable to call once we are done with the subprocess, or None.
+    Processes reporting their end on their own (.on_exit, see
+    processlauncher.SpawnedProcess) are reported, with their resource
+    usage, when they are reaped instead.
+    '''
+    if not metrics:
+        return None
+    exited = metrics.process_started(time.time() - started)
+    on_exit = getattr(process, 'on_exit', None)
+    if on_exit is None:
+        return exited
+    on_exit.append(exited)
+    return None
+
 class SubprocessIOChunker():
     '''
     Processor class wrapping handling of subprocess IO.
@@ -294,7 +593,8 @@ class SubprocessIOChunker():
     response.
 
     The real or perceived subprocess error is trapped and raised as one of
-    EnvironmentError family of exceptions
+    EnvironmentError family of exceptions. So is the error reading the input
+    stream, if it failed, as it is.
 
     Example usage:
     #    try:
@@ -313,50 +613,95 @@ class SubprocessIOChunker():
 
 
     '''
-    def __init__(self, cmd, inputstream = None, buffer_size = 65536, chunk_size = 4096, starting_values = []):
+    def __init__(self, cmd, inputstream = None, buffer_size = 65536, chunk_size = 4096, starting_values = [], pool = None, passthrough = False, env = None, launcher = None, metrics = None):
         '''
         Initializes SubprocessIOChunker
 
-        @param cmd A Subprocess.Popen style "cmd". Can be string or array of strings
+        @param cmd An argv list, or a string (a shell command line.)
         @param inputstream (Default: None) A file-like, string, or file pointer.
         @param buffer_size (Default: 65536) A size of total buffer per stream in bytes.
         @param chunk_size (Default: 4096) A max size of a chunk. Actual chunk may be smaller.
         @param starting_values (Default: []) An array of strings to put in front of output que.
+        @param pool (Default: None) A BufferPool. If set, output is read in pool
+            mode, see BufferedGenerator.
+        @param passthrough (Default: False) If True, output is not read by a
+            thread, but left in the pipe and .output is a SubprocessIOFile
+            exposing it. Only the first chunk is read to detect errors.
+        @param env (Default: None = launcher's) Environment of the subprocess.
+        @param launcher (Default: None = process-wide launcher)
+            processlauncher.ProcessLauncher instance starting the subprocess.
+        @param metrics (Default: None) metrics.RequestMetrics instance to
+            report the start and the end of the subprocess and buffer
+            stalls to.
         '''
 
+        input_streamer = None
         if inputstream:
             input_streamer = StreamFeeder(inputstream)
             input_streamer.start()
             inputstream = input_streamer.output
 
-        _p = subprocess.Popen(cmd,
-            bufsize = -1,
-            shell = True,
-            stdin = inputstream,
-            stdout = subprocess.PIPE,
-            stderr = subprocess.PIPE
-            )
-
-        bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size, starting_values)
-        bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless = True)
-
-        while not bg_out.done_reading and not bg_out.reading_paused and not bg_err.length:
-            # doing this until we reach either end of file, or end of buffer.
-            bg_out.data_added_event.wait(1)
-            bg_out.data_added_event.clear()
+        started = time.time()
+        try:
+            _p = (launcher or processlauncher.get_launcher()).spawn(cmd, stdin = inputstream, env = env)
+        finally:
+            if input_streamer:
+                # the subprocess has its copy. Ours would keep the feeder
+                # writing (blocked) after the subprocess is gone.
+                os.close(inputstream)
+        self.exited = _process_started(metrics, _p, started)
+
+        # both readers signal the same condition, so that we wake up on
+        # either output or error showing up.
+        cond = threading.Condition()
+        bg_err = BufferedGenerator(_p.stderr, 16000, 1, bottomless = True, condition = cond)
+
+        if passthrough:
+            first = os.read(_p.stdout.fileno(), chunk_size)
+            if not first:
+                with cond:
+                    while not bg_err.done_reading:
+                        cond.wait()
+                _p.wait()
+            bg_out = SubprocessIOFile(_p, bg_err, b''.join(starting_values) + first, chunk_size)
+            if self.exited:
+                bg_out.on_close.append(self.exited)
+        else:
+            bg_out = BufferedGenerator(_p.stdout, buffer_size, chunk_size, starting_values, condition = cond, pool = pool,
+                on_pause = metrics and metrics.stalled)
+
+        with cond:
+            while not passthrough and not bg_out.done_reading and not bg_out.reading_paused and not bg_err.length:
+                # doing this until we reach either end of file, or end of buffer.
+                cond.wait()
+            if bg_out.done_reading:
+                # all output is in. Let the error stream and the exit code catch up.
+                while not bg_err.done_reading:
+                    cond.wait()
+        if bg_out.done_reading:
+            _p.wait()
 
         # at this point it's still ambiguous if we are done reading or just full buffer.
         # Either way, if error (returned by ended process, or implied based on 
         # presence of stuff in stderr output) we error out.
         # Else, we are happy.
         _returncode = _p.poll()
-        if _returncode or (_returncode == None and bg_err.length):
+        input_error = input_streamer and input_streamer.error
+        if _returncode or (_returncode == None and bg_err.length) or input_error:
             try:
                 _p.terminate()
             except:
                 pass
-            bg_out.stop()
+            if passthrough:
+                bg_out.close()
+            else:
+                bg_out.stop()
             bg_err.stop()
+            if self.exited:
+                self.exited()
+            if input_error:
+                # (the input fails before the subprocess sees it end.)
+                raise input_error
             raise EnvironmentError("Subprocess exited due to an error.\n" + "".join(bg_err))
 
         self.process = _p
@@ -388,7 +733,715 @@ class SubprocessIOChunker():
             self.error.close()
         except:
             pass
+        try:
+            # reaping it.
+            self.process.wait()
+        except:
+            pass
+        if getattr(self, 'exited', None):
+            self.exited()
+
+    def __del__(self):
+        # in passthrough mode the output file-like may outlive us. It closes itself.
+        if not isinstance(getattr(self, 'output', None), SubprocessIOFile):
+            self.close()
+
+class IOReactor(threading.Thread):
+    '''
+    A single thread multiplexing I/O over any number of non-blocking file
+    descriptors with epoll (or poll, where epoll is not available).
+
+    Handlers are called in the reactor's thread as handler(fd, events) and
+    must not block. Registration calls may come from any thread, they are
+    queued and executed by the reactor's thread.
+    '''
+    def __init__(self):
+        super(IOReactor, self).__init__()
+        self.daemon = True
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.timeout_scale = 1
+        else:
+            self.poller = select.poll()
+            self.timeout_scale = 1000
+        self.pid = os.getpid()
+        self.handlers = {}
+        self.pending = deque()
+        self.wake_read, self.wake_write = os.pipe()
+        set_nonblocking(self.wake_read)
+        set_nonblocking(self.wake_write)
+        self.poller.register(self.wake_read, select.POLLIN)
+
+    def call(self, func, *args):
+        '''
+        Runs func(*args) in the reactor's thread.
+        '''
+        self.pending.append((func, args))
+        try:
+            os.write(self.wake_write, b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN: # pipe is full = reactor is being woken up already.
+                raise
+
+    def register(self, fd, events, handler):
+        self.call(self.add_handler, fd, events, handler)
+
+    def unregister(self, fd, handler = None):
+        self.call(self.remove_handler, fd, handler)
+
+    def add_handler(self, fd, events, handler):
+        # reactor's thread only.
+        self.handlers[fd] = handler
+        self.poller.register(fd, events)
+
+    def remove_handler(self, fd, handler = None):
+        # reactor's thread only. With handler given, only if fd is still
+        # watched for it: once closed, the fd number may be someone else's.
+        if handler is not None and self.handlers.get(fd) != handler:
+            return
+        if self.handlers.pop(fd, None):
+            self.poller.unregister(fd)
+
+    def run(self):
+        while True:
+            try:
+                events = self.poller.poll(1 * self.timeout_scale)
+            except (IOError, OSError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.wake_read:
+                    try:
+                        while os.read(self.wake_read, 4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                handler = self.handlers.get(fd)
+                if handler:
+                    try:
+                        handler(fd, event)
+                    except Exception:
+                        self.remove_handler(fd, handler)
+            while self.pending:
+                func, args = self.pending.popleft()
+                try:
+                    func(*args)
+                except Exception:
+                    # one request's trouble must not take the reactor down for all.
+                    pass
+
+_reactor = None
+_reactor_lock = threading.Lock()
+
+def get_reactor():
+    '''
+    Returns the process-wide IOReactor, starting it if needed.
+    (A reactor inherited through fork() has no thread behind it, so forked
+    worker processes get their own.)
+    '''
+    global _reactor
+    with _reactor_lock:
+        if _reactor is None or _reactor.pid != os.getpid():
+            _reactor = IOReactor()
+            _reactor.start()
+        return _reactor
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+class ReactorSubprocessIOChunker(object):
+    '''
+    Drop-in alternative to SubprocessIOChunker that starts no threads.
+
+    Output and error pipes of the subprocess are read by the process-wide
+    IOReactor thread. Input, if any, is written into the subprocess by the
+    calling thread while the instance is being initialized, as that thread is
+    blocked waiting for the first output anyway. (Input is read from the
+    request body, which no non-blocking machinery can hurry up.) Only when
+    a subprocess interleaves input and output, and stops reading input until
+    its output is consumed, the remaining input is fed by a helper thread.
+
+    Reading from the output pipe pauses when buffer_size bytes are buffered
+    and resumes when the consumer catches up.
+
+    Same as with SubprocessIOChunker, the real or perceived subprocess error
+    is trapped and raised as one of EnvironmentError family of exceptions,
+    and so is the error reading the input, as it is.
+    '''
+    def __init__(self, cmd, inputstream = None, buffer_size = 65536, chunk_size = 4096, starting_values = [], reactor = None, env = None, launcher = None, metrics = None, startup_timeout = 600):
+        '''
+        Initializes ReactorSubprocessIOChunker
+
+        @param cmd An argv list, or a string (a shell command line.)
+        @param inputstream (Default: None) A file-like, string, or file pointer.
+        @param buffer_size (Default: 65536) A size of total buffer per stream in bytes.
+        @param chunk_size (Default: 4096) A max size of a chunk. Actual chunk may be smaller.
+        @param starting_values (Default: []) An array of strings to put in front of output que.
+        @param reactor (Default: None = process-wide reactor) IOReactor instance.
+        @param env (Default: None = launcher's) Environment of the subprocess.
+        @param launcher (Default: None = process-wide launcher)
+            processlauncher.ProcessLauncher instance starting the subprocess.
+        @param metrics (Default: None) metrics.RequestMetrics instance, see
+            SubprocessIOChunker.
+        @param startup_timeout (Default: 600) Max seconds to wait for the
+            first output (or for the end of it) after the input is fed.
+            Past it the subprocess is terminated and EnvironmentError raised.
+        '''
+        self.reactor = reactor or get_reactor()
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.data = deque(starting_values)
+        self.data_size = sum(len(i) for i in starting_values)
+        self.errors = deque()
+        self.errors_size = 0
+        self.cond = threading.Condition()
+        self.done_reading = False
+        self.done_reading_errors = False
+        self.reading_paused = False
+        self.closed = False
+        self.metrics = metrics
+        self.input_error = None
+
+        started = time.time()
+        _p = (launcher or processlauncher.get_launcher()).spawn(
+            cmd,
+            stdin = inputstream and subprocess.PIPE or None,
+            env = env
+            )
+        self.exited = _process_started(metrics, _p, started)
+        self.process = _p
+        self.out_fd = _p.stdout.fileno()
+        self.err_fd = _p.stderr.fileno()
+        set_nonblocking(self.out_fd)
+        set_nonblocking(self.err_fd)
+        self.reactor.register(self.out_fd, select.POLLIN, self.on_output)
+        self.reactor.register(self.err_fd, select.POLLIN, self.on_error)
+
+        if inputstream:
+            self.feed(_p.stdin, inputstream)
+            if self.input_error:
+                self.close()
+                raise self.input_error
+
+        deadline = time.time() + startup_timeout
+        timed_out = False
+        with self.cond:
+            while not self.done_reading and not self.reading_paused and not self.errors_size:
+                # doing this until we reach either end of file, or end of buffer.
+                if time.time() > deadline:
+                    timed_out = True
+                    break
+                self.cond.wait(1)
+            if self.done_reading:
+                # all output is in. Let the error stream and the exit code catch up.
+                while not self.done_reading_errors:
+                    if time.time() > deadline:
+                        timed_out = True
+                        break
+                    self.cond.wait(1)
+        if timed_out:
+            self.close()
+            raise EnvironmentError("Subprocess gave no output in %s seconds." % startup_timeout)
+        if self.done_reading:
+            _p.wait()
+
+        # same as SubprocessIOChunker, error if the process ended badly or
+        # if it is still running but reported something in stderr.
+        _returncode = _p.poll()
+        if _returncode or (_returncode == None and self.errors_size):
+            self.close()
+            raise EnvironmentError("Subprocess exited due to an error.\n" + "".join(self.errors))
+
+    def feed(self, stdin, source):
+        '''
+        Writes all of source into the subprocess' stdin. Runs in the
+        calling thread. If the subprocess stops taking input until its output
+        is consumed (consumer can start only after __init__ returns), the
+        rest of the input is handed to a helper thread.
+        '''
+        if type(source) in (type(''), bytes, bytearray):
+            pending, source = bytes(source), None
+        else:
+            pending = b''
+            if isinstance(source, int):
+                source = os.fdopen(source, 'rb', 16384)
+        fd = stdin.fileno()
+        set_nonblocking(fd)
+        try:
+            while True:
+                if not pending:
+                    pending = source and source.read(65536)
+                    if not pending:
+                        break
+                try:
+                    pending = pending[os.write(fd, pending):]
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        # subprocess is not reading (likely exited). The reason
+                        # will show up in return code and stderr.
+                        break
+                    with self.cond:
+                        stuck = self.reading_paused
+                    if stuck:
+                        t = threading.Thread(target = self.feed_blocking, args = (stdin, pending, source))
+                        t.daemon = True
+                        t.start()
+                        return
+                    select.select([], [fd], [], 0.1)
+        except (IOError, OSError) as e:
+            # source failed (say, git_http_backend.RequestBodyTooLarge).
+            self.input_error = e
+        try:
+            stdin.close()
+        except (IOError, OSError):
+            pass
+
+    def feed_blocking(self, stdin, pending, source):
+        fd = stdin.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        try:
+            while pending:
+                os.write(fd, pending)
+                pending = source and source.read(65536)
+        except (IOError, OSError):
+            pass
+        finally:
+            try:
+                stdin.close()
+            except (IOError, OSError):
+                pass
+
+    ####################
+    # Reactor's thread
+    ####################
+
+    def read_fd(self, fd):
+        try:
+            return os.read(fd, self.chunk_size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            return b''
+
+    def on_output(self, fd, events):
+        b = self.read_fd(fd)
+        if b is None:
+            return
+        with self.cond:
+            if b:
+                self.data.append(b)
+                self.data_size += len(b)
+                if self.data_size >= self.buffer_size:
+                    self.reading_paused = True
+                    self.reactor.remove_handler(fd, self.on_output)
+                    if self.metrics:
+                        self.metrics.stalled()
+            else:
+                self.done_reading = True
+                self.reactor.remove_handler(fd, self.on_output)
+                self.process.stdout.close()
+            self.cond.notify_all()
+
+    def on_error(self, fd, events):
+        b = self.read_fd(fd)
+        if b is None:
+            return
+        with self.cond:
+            if b:
+                # keeping only the tail of the error output.
+                self.errors.append(b)
+                self.errors_size += len(b)
+                while self.errors_size > 16000 and len(self.errors) > 1:
+                    self.errors_size -= len(self.errors.popleft())
+            else:
+                self.done_reading_errors = True
+                self.reactor.remove_handler(fd, self.on_error)
+                self.process.stderr.close()
+            self.cond.notify_all()
+
+    def shutdown(self):
+        for fd, pipe, handler in (
+                (self.out_fd, self.process.stdout, self.on_output),
+                (self.err_fd, self.process.stderr, self.on_error)):
+            if pipe.closed:
+                # closed at end of file. fd may be another chunker's by now.
+                continue
+            self.reactor.remove_handler(fd, handler)
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+    ####################
+    # Generator's methods
+    ####################
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.process.poll():
+            raise EnvironmentError("Subprocess exited due to an error:\n" + ''.join(self.errors))
+        with self.cond:
+            while not self.data and not self.done_reading:
+                self.cond.wait(1)
+            if not self.data:
+                raise StopIteration
+            b = self.data.popleft()
+            self.data_size -= len(b)
+            if self.reading_paused and self.data_size < self.buffer_size:
+                self.reading_paused = False
+                self.reactor.register(self.out_fd, select.POLLIN, self.on_output)
+        return b
+    __next__ = next
+
+    def throw(self, type, value=None, traceback=None):
+        if self.data or not self.done_reading:
+            raise type(value)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.process.terminate()
+            # reaping it.
+            self.process.wait()
+        except:
+            pass
+        if getattr(self, 'exited', None):
+            self.exited()
+        # fds may be closed only after the reactor stopped watching them.
+        self.reactor.call(self.shutdown)
 
     def __del__(self):
         self.close()
 
+class CoalescedFlight(object):
+    '''
+    One running subprocess whose output is shared by many readers.
+
+    Output of the subprocess is pumped (by a separate thread) to readers
+    (see CoalescedOutput), each reading at own pace. While there is one
+    reader, output is kept in memory: all of it, for readers who may join,
+    until memory_limit bytes were made, then (no more joining) just what the
+    reader has yet to take. Once a second reader joins, output goes to a
+    spool file instead, which readers read through their own file
+    descriptors. Joining ends once max_spool bytes were made. From then on
+    the spool is started over each time all readers caught up with it and
+    it holds max_spool bytes.
+
+    So the pump waits for readers only when the slowest of them is
+    memory_limit (one reader) or max_spool (more readers) bytes behind.
+    '''
+    def __init__(self, coalescer, key, spool_dir = None, memory_limit = 1048576, max_spool = 268435456):
+        self.coalescer = coalescer
+        self.key = key
+        self.spool_dir = spool_dir
+        self.memory_limit = memory_limit
+        self.max_spool = max_spool
+        self.ready = threading.Event()
+        self.cond = threading.Condition()
+        self.size = 0
+        self.outputs = []
+        self.joinable = True
+        self.done = False
+        self.aborted = False
+        self.error = None
+        self.output = None
+        # output kept in memory (from offset memory_base) until spilled
+        # into spool file (holding output from offset spool_base.)
+        self.memory = bytearray()
+        self.memory_base = 0
+        self.spool_fd = None
+        self.spool_path = None
+        self.spool_base = 0
+        # callables to call once the flight is over.
+        self.on_done = []
+
+    def start(self, output):
+        self.output = output
+        t = threading.Thread(target = self.pump)
+        t.daemon = True
+        t.start()
+
+    def fail(self, error):
+        self.error = error
+        self.finish()
+
+    def full(self):
+        # must be called with self.cond acquired.
+        if self.memory is not None:
+            return not self.joinable and len(self.memory) >= self.memory_limit
+        if self.size - self.spool_base < self.max_spool:
+            return False
+        if min(output.offset for output in self.outputs) < self.size:
+            return True
+        # everybody has read everything spooled. Starting over.
+        os.ftruncate(self.spool_fd, 0)
+        os.lseek(self.spool_fd, 0, 0)
+        self.spool_base = self.size
+        return False
+
+    def pump(self):
+        try:
+            for chunk in self.output:
+                with self.cond:
+                    while not self.aborted and self.full():
+                        self.cond.wait(1)
+                    if self.aborted:
+                        break
+                    if self.memory is not None:
+                        self.memory += chunk
+                    else:
+                        os.write(self.spool_fd, chunk)
+                    self.size += len(chunk)
+                    closing = self.joinable and self.size >= (
+                        self.memory_limit if self.memory is not None else self.max_spool)
+                    if closing:
+                        self.joinable = False
+                    self.cond.notify_all()
+                if closing:
+                    self.coalescer.forget(self)
+        except EnvironmentError as e:
+            self.error = e
+        finally:
+            try:
+                self.output.close()
+            except:
+                pass
+            self.finish()
+
+    def finish(self):
+        self.coalescer.forget(self)
+        with self.cond:
+            self.done = True
+            self.joinable = False
+            if self.spool_fd is not None:
+                os.close(self.spool_fd)
+                try:
+                    # all readers have their own file descriptors by now.
+                    os.remove(self.spool_path)
+                except OSError:
+                    pass
+            self.cond.notify_all()
+        self.ready.set()
+        while self.on_done:
+            self.on_done.pop(0)()
+
+    def spill(self):
+        # must be called with self.cond acquired, while joinable (so memory
+        # holds all of the output.)
+        self.spool_fd, self.spool_path = tempfile.mkstemp(prefix = 'subprocessio', dir = self.spool_dir)
+        os.write(self.spool_fd, bytes(self.memory))
+        self.memory = None
+        for output in self.outputs:
+            output.open()
+
+    def attach(self):
+        '''
+        Returns a new CoalescedOutput, or None if the flight takes no more
+        readers. Called with coalescer's lock acquired.
+        '''
+        with self.cond:
+            if not self.joinable:
+                return None
+            if self.outputs and self.memory is not None:
+                self.spill()
+            output = CoalescedOutput(self)
+            if self.memory is None:
+                output.open()
+            self.outputs.append(output)
+            return output
+
+    def detach(self, output):
+        with self.cond:
+            self.outputs.remove(output)
+            # the pump may be waiting for this one.
+            self.cond.notify_all()
+            if self.outputs or self.done:
+                return
+            # nobody wants the output any more. stopping the subprocess.
+            self.aborted = True
+        self.coalescer.forget(self)
+
+class CoalescedOutput(object):
+    '''
+    Iterator over output of a CoalescedFlight. Behaves like SubprocessIOChunker
+    as far as WSGI server is concerned.
+    '''
+    def __init__(self, flight, chunk_size = 65536):
+        self.flight = flight
+        self.chunk_size = chunk_size
+        self.offset = 0
+        self.fd = None
+        self.closed = False
+
+    def open(self):
+        self.fd = os.open(self.flight.spool_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        flight = self.flight
+        flight.ready.wait()
+        with flight.cond:
+            while self.offset >= flight.size and not flight.done:
+                flight.cond.wait(1)
+            available = min(flight.size - self.offset, self.chunk_size)
+            if available and self.fd is None:
+                start = self.offset - flight.memory_base
+                data = bytes(flight.memory[start:start + available])
+                self.offset += len(data)
+                if not flight.joinable:
+                    # nobody else is going to read it.
+                    del flight.memory[:self.offset - flight.memory_base]
+                    flight.memory_base = self.offset
+                    flight.cond.notify_all()
+                return data
+            position = self.offset - flight.spool_base
+        if not available:
+            if flight.error:
+                raise EnvironmentError("Subprocess exited due to an error:\n" + str(flight.error))
+            raise StopIteration
+        # spool is not started over before we read what we are behind.
+        os.lseek(self.fd, position, 0)
+        data = os.read(self.fd, available)
+        with flight.cond:
+            self.offset += len(data)
+            flight.cond.notify_all()
+        return data
+    __next__ = next
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # (detached first, so that no spool gets opened for us after.)
+        self.flight.detach(self)
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+
+    def __del__(self):
+        self.close()
+
+class SubprocessIOCoalescer(object):
+    '''
+    "Single flight" wrapper around SubprocessIOChunker.
+
+    Callers asking for output of a subprocess under a key that names an
+    already running subprocess get attached as readers to that subprocess'
+    output, instead of starting a new one. The key must capture everything
+    that makes the output what it is, usually the command and a digest of
+    the input.
+
+    Example usage:
+    #    coalescer = SubprocessIOCoalescer()
+    #    try:
+    #        answer = coalescer.run(
+    #            hashlib.sha1(cmd + input).hexdigest(),
+    #            cmd,
+    #            input
+    #            )
+    #    except (EnvironmentError) as e:
+    #        print str(e)
+    #        raise e
+    #
+    #    return answer
+    '''
+    def __init__(self, spool_dir = None, chunker = None, memory_limit = 1048576, max_spool = 268435456):
+        '''
+        @param spool_dir (Default: None = system's temp folder) Folder for spool files.
+        @param chunker (Default: SubprocessIOChunker) Class used for running subprocesses.
+        @param memory_limit (Default: 1048576) Bytes of output kept in memory
+            while a subprocess has one reader. Others may join it only
+            until it made that much output.
+        @param max_spool (Default: 268435456) Max size of spool file of a
+            subprocess with more readers. Others may join it only until it
+            made that much output.
+        '''
+        self.spool_dir = spool_dir
+        self.memory_limit = memory_limit
+        self.max_spool = max_spool
+        self.chunker = chunker or SubprocessIOChunker
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.started = 0
+        self.joined = 0
+
+    def forget(self, flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+    def join(self, key):
+        '''
+        Returns an iterator over output of a subprocess running under the
+        key, or None if there is no such subprocess (or it is too far along
+        to be joined.)
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                return None
+            output = flight.attach()
+            if output is None:
+                return None
+            self.joined += 1
+        flight.ready.wait()
+        if flight.error and not flight.size:
+            output.close()
+            raise EnvironmentError(str(flight.error))
+        return output
+
+    def run(self, key, cmd, inputstream = None, on_done = None, **kw):
+        '''
+        Returns an iterator over output of the subprocess. The subprocess is
+        started only if there is not one running under the same key already.
+
+        on_done (say, releasing an admission slot) is called once the
+        subprocess started for the caller is done with (which may be after
+        the caller's reader is), or right away when the caller joins one
+        running already.
+
+        Other arguments are same as for SubprocessIOChunker.
+
+        Raises EnvironmentError in the same cases SubprocessIOChunker does.
+        '''
+        while True:
+            output = self.join(key)
+            if output is not None:
+                if on_done:
+                    on_done()
+                return output
+            with self.lock:
+                flight = self.flights.get(key)
+                if flight is not None and flight.joinable:
+                    # started by someone else just now. Joining it.
+                    continue
+                # (one too far along to be joined is replaced.)
+                flight = self.flights[key] = CoalescedFlight(
+                    self, key, self.spool_dir, self.memory_limit, self.max_spool)
+                if on_done:
+                    flight.on_done.append(on_done)
+                # attaching the leader right away. Otherwise, readers
+                # attaching and leaving before the leader does, abort the flight.
+                output = flight.attach()
+                self.started += 1
+                break
+        try:
+            chunker = self.chunker(cmd, inputstream, **kw)
+        except EnvironmentError as e:
+            flight.fail(e)
+            raise
+        flight.start(chunker)
+        flight.ready.set()
+        return output
@@ -0,0 +1,125 @@
+import io
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+import admission
+import git_http_backend
+
+class MainTestCase(unittest.TestCase):
+
+    def acquire_later(self, controller, repo_path, service, results):
+        def run():
+            results.append((service, repo_path, controller.acquire(repo_path, service)))
+        waiting = controller.status()['waiting']
+        t = threading.Thread(target = run)
+        t.daemon = True
+        t.start()
+        # letting it get in line.
+        while controller.status()['waiting'] == waiting:
+            time.sleep(0.01)
+        return t
+
+    def test_01_limits(self):
+        controller = admission.AdmissionController(
+            max_total = 3, max_per_repo = 2, max_per_service = {'upload-pack': 1}, timeout = 0.05)
+        a1 = controller.acquire('a', 'advertise-refs')
+        a2 = controller.acquire('a', 'advertise-refs')
+        self.assertTrue(a1 and a2)
+        # per repo
+        self.assertEqual(controller.acquire('a', 'receive-pack'), None)
+        # per service
+        b1 = controller.acquire('b', 'upload-pack')
+        self.assertTrue(b1)
+        self.assertEqual(controller.acquire('c', 'upload-pack'), None)
+        # total
+        self.assertEqual(controller.acquire('c', 'advertise-refs'), None)
+        self.assertEqual(controller.timed_out, 3)
+        a1()
+        a1()
+        c1 = controller.acquire('c', 'advertise-refs', timeout = 0)
+        self.assertTrue(c1)
+        for release in (a2, b1, c1):
+            release()
+        status = controller.status()
+        self.assertEqual((status['running'], status['waiting'], status['admitted']), (0, 0, 4))
+
+    def test_02_queue_and_priorities(self):
+        controller = admission.AdmissionController(max_total = 1, max_queue = 3, timeout = 5)
+        release = controller.acquire('a', 'upload-pack')
+        results = []
+        threads = [
+            self.acquire_later(controller, 'a', 'upload-pack', results),
+            self.acquire_later(controller, 'b', 'receive-pack', results),
+            self.acquire_later(controller, 'c', 'advertise-refs', results)
+            ]
+        self.assertEqual(controller.status()['waiting'], 3)
+        # line is full
+        self.assertEqual(controller.acquire('d', 'advertise-refs'), None)
+        self.assertEqual(controller.rejected, 1)
+        for i in range(3):
+            release()
+            while len(results) < i + 1:
+                time.sleep(0.01)
+            release = results[-1][2]
+        release()
+        for t in threads:
+            t.join()
+        self.assertEqual(
+            [service for service, repo_path, release in results],
+            ['advertise-refs', 'receive-pack', 'upload-pack'])
+        self.assertEqual(controller.status()['running'], 0)
+
+    def test_03_overloaded_response(self):
+        base_path = tempfile.mkdtemp()
+        try:
+            subprocess.call(['git', 'init', '--quiet', '--bare', os.path.join(base_path, 'repo.git')])
+            app = git_http_backend.assemble_WSGI_git_app(
+                content_path = base_path,
+                admission = admission.AdmissionController(max_total = 0, timeout = 0, retry_after = 7)
+                )
+            status = []
+            def start_response(s, h, exc_info = None):
+                status.append((s, dict(h)))
+            app({
+                'PATH_INFO': '/repo.git/info/refs',
+                'QUERY_STRING': 'service=git-upload-pack',
+                'REQUEST_METHOD': 'GET',
+                'wsgi.input': io.BytesIO(),
+                'wsgi.errors': io.StringIO()
+                }, start_response)
+            self.assertEqual(status[0][0], '503 Service Unavailable')
+            self.assertEqual(status[0][1]['Retry-After'], '7')
+        finally:
+            shutil.rmtree(base_path, True)
+
+    def test_04_enqueue(self):
+        controller = admission.AdmissionController(max_total = 1, max_queue = 1)
+        notified = []
+        first = controller.enqueue('a', 'upload-pack', lambda: notified.append('first'))
+        self.assertEqual(notified, ['first'])
+        second = controller.enqueue('a', 'upload-pack', lambda: notified.append('second'))
+        self.assertEqual(controller.enqueue('a', 'upload-pack', lambda: None), None)
+        self.assertEqual(controller.rejected, 1)
+        controller.releaser(first)()
+        self.assertEqual(notified, ['first', 'second'])
+        # given up on after getting the slot. The slot is to be released.
+        self.assertFalse(controller.withdraw(second))
+        controller.releaser(second)()
+        third = controller.enqueue('a', 'upload-pack', lambda: None)
+        fourth = controller.enqueue('a', 'upload-pack', lambda: notified.append('fourth'))
+        self.assertTrue(controller.withdraw(fourth, timed_out = True))
+        controller.releaser(third)()
+        self.assertEqual(notified, ['first', 'second'])
+        status = controller.status()
+        self.assertEqual((status['running'], status['waiting'], status['timed_out']), (0, 0, 1))
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
@@ -0,0 +1,151 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+import advertisement
+import processlauncher
+
+GIT_ENV = dict(
+    os.environ,
+    GIT_AUTHOR_NAME = 'a', GIT_AUTHOR_EMAIL = 'a@b',
+    GIT_COMMITTER_NAME = 'a', GIT_COMMITTER_EMAIL = 'a@b'
+    )
+
+class MainTestCase(unittest.TestCase):
+    '''
+    Golden tests: RefAdvertiser's output is compared to that of git itself.
+    '''
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.base_path, 'repo.git')
+        self.work_path = os.path.join(self.base_path, 'work')
+        self.advertiser = advertisement.RefAdvertiser()
+        if not self.advertiser.enabled:
+            self.skipTest('git of a version advertisement.py knows is needed')
+        self.git('init', '--quiet', '--bare', self.repo_path)
+        self.git('init', '--quiet', self.work_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def git(self, *args, **kw):
+        process = subprocess.Popen(
+            ['git'] + list(args),
+            cwd = kw.get('cwd', self.base_path),
+            env = GIT_ENV,
+            stdin = subprocess.PIPE,
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE
+            )
+        output = process.communicate(kw.get('input'))[0]
+        self.assertEqual(process.returncode, 0, args)
+        return output
+
+    def work(self, *args):
+        return self.git(*args, cwd = self.work_path)
+
+    def commit(self, message):
+        with open(os.path.join(self.work_path, 'file'), 'w') as f:
+            f.write(message + '\n')
+        self.work('add', 'file')
+        self.work('commit', '--quiet', '-m', message)
+
+    def push(self, *args):
+        self.work('push', '--quiet', self.repo_path, *args)
+
+    def assertSameAsGit(self, service = None):
+        for service in ([service] if service else ['upload-pack', 'receive-pack']):
+            expected = self.git(service, '--stateless-rpc', '--advertise-refs', self.repo_path)
+            self.assertEqual(self.advertiser.advertise(self.repo_path, service), expected, service)
+
+    def assertFallsBack(self):
+        for service in ('upload-pack', 'receive-pack'):
+            self.assertEqual(self.advertiser.advertise(self.repo_path, service), None)
+
+    def test_01_empty_and_unborn(self):
+        self.assertSameAsGit()
+        self.commit('1')
+        self.push('HEAD:refs/heads/feature')
+        # HEAD points at (missing) master.
+        self.assertSameAsGit()
+
+    def test_02_loose_and_packed_refs(self):
+        self.commit('1')
+        self.push('HEAD:refs/heads/master')
+        self.work('tag', 'light')
+        self.work('tag', '-a', '-m', 'annotated', 'v1')
+        self.work('tag', '-a', '-m', 'nested', 'v2', 'v1')
+        self.push('--tags')
+        self.assertSameAsGit()
+        self.git('--git-dir', self.repo_path, 'pack-refs', '--all')
+        self.assertSameAsGit()
+        # loose refs (with objects in packs) next to the packed ones.
+        self.commit('2')
+        self.work('tag', '-a', '-m', 'annotated', 'v3')
+        self.push('HEAD:refs/heads/master', 'HEAD:refs/heads/a/b', '--tags')
+        self.git('--git-dir', self.repo_path, 'repack', '-a', '-d', '-q')
+        self.assertSameAsGit()
+        self.git('--git-dir', self.repo_path, 'symbolic-ref', 'HEAD', 'refs/heads/a/b')
+        self.assertSameAsGit()
+        # detached HEAD
+        sha = self.git('--git-dir', self.repo_path, 'rev-parse', 'master').strip()
+        with open(os.path.join(self.repo_path, 'HEAD'), 'wb') as f:
+            f.write(sha + b'\n')
+        self.assertSameAsGit()
+
+    def test_03_missing_objects(self):
+        self.commit('1')
+        self.push('HEAD:refs/heads/master')
+        with open(os.path.join(self.repo_path, 'refs', 'heads', 'broken'), 'w') as f:
+            f.write('1' * 40 + '\n')
+        self.assertSameAsGit()
+        self.git('--git-dir', self.repo_path, 'pack-refs', '--all')
+        self.assertSameAsGit()
+
+    def test_04_config(self):
+        self.commit('1')
+        self.push('HEAD:refs/heads/master')
+        for args in (
+                ('uploadpack.allowTipSHA1InWant', 'true'),
+                ('uploadpack.allowFilter', 'yes'),
+                ('uploadpack.allowAnySHA1InWant', 'true'),
+                ('uploadpack.allowReachableSHA1InWant', 'false'),
+                ('receive.advertisePushOptions', '1'),
+                ('receive.advertiseAtomic', 'off'),
+                ('repack.useDeltaBaseOffset', 'false')):
+            self.git('--git-dir', self.repo_path, 'config', *args)
+            self.assertSameAsGit()
+
+    def test_05_fallbacks(self):
+        self.commit('1')
+        self.push('HEAD:refs/heads/master')
+        self.git('--git-dir', self.repo_path, 'config', 'transfer.hideRefs', 'refs/hidden')
+        self.assertFallsBack()
+        self.git('--git-dir', self.repo_path, 'config', '--unset', 'transfer.hideRefs')
+        self.git('--git-dir', self.repo_path, 'symbolic-ref', 'refs/heads/alias', 'refs/heads/master')
+        self.assertFallsBack()
+        self.assertEqual(self.advertiser.fallbacks, 4)
+
+    def test_06_git_version_and_agent(self):
+        class Launcher(processlauncher.ProcessLauncher):
+            version = b'git version 2.39.5 (Some Build)'
+            def spawn(self, cmd, **kw):
+                if cmd[1:] == ['version']:
+                    cmd = ['printf', '%s\\n', self.version]
+                return processlauncher.ProcessLauncher.spawn(self, cmd, **kw)
+        launcher = Launcher()
+        self.assertEqual(advertisement.RefAdvertiser(launcher = launcher).agent, b'git/2.39.5.(Some.Build)')
+        launcher.env['GIT_USER_AGENT'] = 'my agent\x01'
+        self.assertEqual(advertisement.RefAdvertiser(launcher = launcher).agent, b'my.agent.')
+        # versions not checked against are left to git.
+        launcher.version = b'git version 9.99.0'
+        self.assertFalse(advertisement.RefAdvertiser(launcher = launcher).enabled)
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
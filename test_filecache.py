@@ -0,0 +1,118 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from wsgiref.util import setup_testing_defaults
+import filecache
+import git_http_backend
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def write(self, name, data):
+        path = os.path.join(self.base_path, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_01_metadata(self):
+        cache = filecache.FileCache()
+        path = self.write('HEAD', b'ref: refs/heads/master\n')
+        self.assertEqual(cache.get('HEAD'), None)
+        cache.put('HEAD', path, os.stat(path), 'info')
+        self.assertEqual(cache.get('HEAD'), 'info')
+        self.assertEqual((cache.misses, cache.revalidations), (1, 1))
+        # mutable files are checked for changes.
+        self.write('HEAD', b'ref: refs/heads/other\n')
+        t = time.time() + 10
+        os.utime(path, (t, t))
+        self.assertEqual(cache.get('HEAD'), None)
+        self.assertEqual(cache.misses, 2)
+
+        # immutable ones are not.
+        path = self.write('pack', b'PACK')
+        cache.put('pack', path, os.stat(path), 'pack info', True)
+        os.remove(path)
+        self.assertEqual(cache.get('pack'), 'pack info')
+        self.assertEqual(cache.hits, 1)
+        cache.invalidate('pack')
+        self.assertEqual(cache.get('pack'), None)
+
+        # ttl spares the stat() of mutable files.
+        cache = filecache.FileCache(ttl = 60)
+        path = self.write('HEAD', b'')
+        cache.put('HEAD', path, os.stat(path), 'info')
+        os.remove(path)
+        self.assertEqual(cache.get('HEAD'), 'info')
+
+        cache = filecache.FileCache(max_entries = 2)
+        for name in ('a', 'b', 'c'):
+            path = self.write(name, b'')
+            cache.put(name, path, os.stat(path), name, True)
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+
+    def test_02_open_files(self):
+        cache = filecache.FileCache(max_open = 2)
+        if not cache.max_open:
+            self.skipTest('pread is not available')
+        paths = [self.write(name, name.encode('ascii') * 10) for name in ('a', 'b', 'c')]
+        fd, release = cache.open(paths[0])
+        fd2, release2 = cache.open(paths[0])
+        self.assertEqual(fd, fd2)
+        self.assertEqual(filecache.pread(fd, 3, 8), b'aa')
+        release2()
+        for path in paths[1:]:
+            cache.open(path)[1]()
+        # the least recently used one is evicted, but stays open until released.
+        self.assertEqual(list(cache.open_files), paths[1:])
+        self.assertEqual(filecache.pread(fd, 1, 0), b'a')
+        release()
+        self.assertRaises(OSError, os.fstat, fd)
+        fds = [handle[0] for handle in cache.open_files.values()]
+        cache.close()
+        self.assertEqual(cache.open_files, {})
+        for fd in fds:
+            self.assertRaises(OSError, os.fstat, fd)
+
+    def test_03_foreign_file_wrapper(self):
+        class PositionalFileWrapper(object):
+            # sends the descriptor from its position on, moving it, as
+            # sendfile() of some servers does.
+            def __init__(self, filelike, block_size = 8192):
+                self.filelike = filelike
+            def __iter__(self):
+                fd = self.filelike.fileno()
+                data = os.read(fd, 1000000)
+                while data:
+                    yield data
+                    data = os.read(fd, 1000000)
+
+        data = b''.join(bytes(bytearray([i % 251])) for i in range(100000))
+        self.write('pack-1.pack', data)
+        app = git_http_backend.assemble_WSGI_git_app(
+            content_path = self.base_path, file_cache = filecache.FileCache())
+        for first, last in ((1000, 1999), (5, 9), (0, 99999), (99990, 99999)):
+            environ = {'PATH_INFO': '/pack-1.pack', 'REQUEST_METHOD': 'GET',
+                'HTTP_RANGE': 'bytes=%d-%d' % (first, last), 'wsgi.file_wrapper': PositionalFileWrapper}
+            setup_testing_defaults(environ)
+            headers = []
+            result = app(environ, lambda s, h, exc_info = None: headers.extend(h))
+            length = int(dict(headers)['Content-Length'])
+            body = b''.join(result)[:length]
+            if hasattr(result, 'close'):
+                result.close()
+            self.assertEqual(body, data[first:last + 1])
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
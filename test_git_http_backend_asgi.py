@@ -0,0 +1,327 @@
+import os
+import io
+import zlib
+import gzip
+import shutil
+import asyncio
+import tempfile
+import threading
+import unittest
+import subprocess
+
+import admission
+import advertisement
+import responsecache
+import git_http_backend
+import git_http_backend_asgi
+
+def call(app, method, path, query_string = b'', body = b'', headers = []):
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {'type': 'http.disconnect'}
+    async def send(message):
+        sent.append(message)
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query_string,
+        'headers': headers
+        }
+    asyncio.run(app(scope, receive, send))
+    start = sent[0]
+    return (
+        start['status'],
+        dict((k.decode(), v.decode()) for k, v in start['headers']),
+        b''.join(m.get('body', b'') for m in sent[1:])
+        )
+
+def pkt(line):
+    return ('%04x' % (len(line) + 4)).encode('ascii') + line
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.base_path, 'repo.git')
+        work_path = os.path.join(self.base_path, 'work')
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', self.repo_path])
+        subprocess.check_call(['git', 'init', '--quiet', work_path])
+        with open(os.path.join(work_path, 'file.txt'), 'w') as f:
+            f.write('This is a test\n')
+        subprocess.check_call(['git', 'add', 'file.txt'], cwd = work_path)
+        subprocess.check_call(
+            ['git', '-c', 'user.name=test', '-c', 'user.email=test@localhost', 'commit', '--quiet', '-m', 'Initial'],
+            cwd = work_path)
+        subprocess.check_call(['git', 'push', '--quiet', self.repo_path, 'HEAD:refs/heads/master'], cwd = work_path)
+        self.head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = work_path).strip()
+        self.app = git_http_backend_asgi.assemble_ASGI_git_app(self.base_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def test_01_info_refs(self):
+        status, headers, body = call(self.app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-type'], 'application/x-git-upload-pack-advertisement')
+        advert = subprocess.check_output(
+            ['git', 'upload-pack', '--stateless-rpc', '--advertise-refs', self.repo_path])
+        self.assertEqual(body, b'001d# service=git-upload-pack0000' + advert)
+
+    def test_02_upload_pack(self):
+        request = pkt(b'want ' + self.head + b' ofs-delta\n') + b'0000' + pkt(b'done\n')
+        status, headers, body = call(
+            self.app, 'POST', '/repo.git/git-upload-pack', body = request,
+            headers = [(b'content-type', b'application/x-git-upload-pack-request')])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-type'], 'application/x-git-upload-pack-result')
+        self.assertEqual(body[:8], b'0008NAK\n')
+        self.assertEqual(body[8:12], b'PACK')
+
+    def test_03_errors(self):
+        status, headers, body = call(self.app, 'GET', '/other.git/info/refs', b'service=git-upload-pack')
+        self.assertEqual(status, 404)
+        status, headers, body = call(self.app, 'GET', '/repo.git/info/refs', b'service=git-bogus-pack')
+        self.assertEqual(status, 400)
+        status, headers, body = call(self.app, 'GET', '/repo.git/HEAD')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'ref: refs/heads/master\n')
+
+    def test_04_gzip_request(self):
+        request = gzip.compress(
+            pkt(b'want ' + self.head + b' ofs-delta side-band-64k no-progress\n') + b'0000' + pkt(b'done\n'))
+        headers = [(b'content-encoding', b'gzip')]
+        status, headers_out, body = call(
+            self.app, 'POST', '/repo.git/git-upload-pack', body = request, headers = headers)
+        self.assertEqual(status, 200)
+        self.assertEqual(body[:8], b'0008NAK\n')
+        # decompressed body over the limit is cut off.
+        app = git_http_backend_asgi.assemble_ASGI_git_app(self.base_path, max_gzip_request_size = 20)
+        status, headers_out, body = call(
+            app, 'POST', '/repo.git/git-upload-pack', body = request, headers = headers)
+        self.assertEqual(status, 413)
+
+    def test_05_gzip_response(self):
+        negotiate = git_http_backend.negotiate_content_encoding
+        self.assertEqual(negotiate('deflate, gzip'), 'gzip')
+        self.assertEqual(negotiate('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(negotiate('x-gzip'), 'gzip')
+        self.assertEqual(negotiate('*;q=0.1, gzip;q=0'), 'deflate')
+        self.assertEqual(negotiate('identity'), None)
+        self.assertEqual(negotiate(''), None)
+
+        app = git_http_backend_asgi.assemble_ASGI_git_app(self.base_path, gzip_response = True)
+        status, headers, plain = call(app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack')
+        self.assertEqual(headers['Vary'], 'Git-Protocol, Accept-Encoding')
+        self.assertTrue('Content-Encoding' not in headers)
+        status, headers, body = call(app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack',
+            headers = [(b'accept-encoding', b'deflate, gzip')])
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), plain)
+        status, headers, body = call(app, 'GET', '/repo.git/HEAD',
+            headers = [(b'accept-encoding', b'deflate')])
+        self.assertEqual(headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(body), b'ref: refs/heads/master\n')
+
+        # packs and loose objects are compressed already.
+        objects = os.path.join(self.repo_path, 'objects')
+        folder = [f for f in os.listdir(objects) if len(f) == 2][0]
+        name = os.listdir(os.path.join(objects, folder))[0]
+        status, headers, body = call(app, 'GET', '/repo.git/objects/%s/%s' % (folder, name),
+            headers = [(b'accept-encoding', b'gzip')])
+        self.assertEqual(headers['Content-Type'], 'application/x-git-loose-object')
+        self.assertTrue('Content-Encoding' not in headers)
+        request = pkt(b'want ' + self.head + b' ofs-delta side-band-64k no-progress\n') + b'0000' + pkt(b'done\n')
+        status, headers, body = call(app, 'POST', '/repo.git/git-upload-pack', body = request,
+            headers = [(b'accept-encoding', b'gzip')])
+        self.assertTrue('Content-Encoding' not in headers)
+        self.assertEqual(body[:8], b'0008NAK\n')
+
+    def test_06_routing(self):
+        app = git_http_backend_asgi.assemble_ASGI_git_app(self.base_path, uri_marker = 'my')
+        status, headers, body = call(app, 'PUT', '/x/my/repo.git/git-upload-pack')
+        self.assertEqual(status, 405)
+        status, headers, body = call(app, 'GET', '/x/my/repo.git/info/refs', b'service=git-upload-pack')
+        self.assertEqual(status, 200)
+        status, headers, body = call(app, 'GET', '/x/nope/repo.git/HEAD')
+        self.assertEqual(status, 404)
+        # (the router is tested in test_git_http_backend_wsgi.py)
+
+    def test_07_ranges(self):
+        parse = git_http_backend.parse_byte_ranges
+        self.assertEqual(parse('bytes=0-9,20-,-5', 100), [(0, 9), (20, 99), (95, 99)])
+        self.assertEqual(parse('bytes=50-200', 100), [(50, 99)])
+        self.assertEqual(parse('bytes=100-,-0', 100), [])
+        self.assertEqual(parse('bytes=9-1', 100), None)
+        self.assertEqual(parse('bytes=a-', 100), None)
+        self.assertEqual(parse('items=0-1', 100), None)
+
+        app = git_http_backend_asgi.assemble_ASGI_git_app(self.base_path, gzip_response = True)
+        status, headers, body = call(app, 'GET', '/repo.git/HEAD',
+            headers = [(b'range', b'bytes=5-'), (b'accept-encoding', b'gzip')])
+        self.assertEqual(status, 206)
+        self.assertEqual(body, b'refs/heads/master\n')
+        self.assertEqual(headers['Content-Range'], 'bytes 5-22/23')
+        self.assertEqual(headers['Content-Length'], '18')
+        self.assertTrue('Content-Encoding' not in headers)
+        status, headers, body = call(app, 'GET', '/repo.git/HEAD',
+            headers = [(b'range', b'bytes=0-2,-1'), (b'if-range', headers['ETag'].encode())])
+        self.assertEqual(status, 206)
+        self.assertTrue(headers['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        status, headers, body = call(app, 'GET', '/repo.git/HEAD', headers = [(b'range', b'bytes=30-')])
+        self.assertEqual(status, 416)
+
+    def test_08_protocol_v2(self):
+        self.assertEqual(git_http_backend.parse_git_protocol(' version=2:x=y '), 'version=2:x=y')
+        self.assertEqual(git_http_backend.parse_git_protocol('version=2; rm -rf'), None)
+        self.assertEqual(git_http_backend.git_protocol_version('version=1:version=2'), 2)
+        self.assertEqual(git_http_backend.git_protocol_version('version=3'), 0)
+        subprocess.check_call(['git', '--git-dir', self.repo_path, 'tag', 'v1', 'master'])
+        v2 = [(b'git-protocol', b'version=2')]
+        capabilities = subprocess.check_output(
+            ['git', 'upload-pack', '--stateless-rpc', '--advertise-refs', self.repo_path],
+            env = dict(os.environ, GIT_PROTOCOL = 'version=2'))
+        self.assertTrue(capabilities.startswith(pkt(b'version 2\n')))
+        ls_refs = (pkt(b'command=ls-refs\n') + b'0001' + pkt(b'peel\n') + pkt(b'symrefs\n')
+            + pkt(b'ref-prefix refs/heads/\n') + b'0000')
+        fetch = (pkt(b'command=fetch\n') + b'0001' + pkt(b'ofs-delta\n')
+            + pkt(b'want ' + self.head + b'\n') + pkt(b'done\n') + b'0000')
+
+        status, headers, body = call(self.app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack', headers = v2)
+        self.assertEqual(headers['Vary'], 'Git-Protocol')
+        self.assertEqual(body, capabilities)
+
+        # only the refs asked for.
+        status, headers, body = call(self.app, 'POST', '/repo.git/git-upload-pack', body = ls_refs, headers = v2)
+        self.assertEqual(body, pkt(self.head + b' refs/heads/master\n') + b'0000')
+        status, headers, body = call(self.app, 'POST', '/repo.git/git-upload-pack', body = fetch, headers = v2)
+        self.assertEqual(body[:13], pkt(b'packfile\n'))
+
+        # v0 and v2 advertisements are cached separately. Junk in the header = v0.
+        app = git_http_backend_asgi.assemble_ASGI_git_app(
+            self.base_path, advertisement_cache = responsecache.AdvertisementCache())
+        for i in range(2):
+            status, headers, body = call(app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack', headers = v2)
+            self.assertEqual(body, capabilities)
+            status, headers, body = call(app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack',
+                headers = [(b'git-protocol', b'version=2;')])
+            self.assertTrue(body.startswith(b'001d# service=git-upload-pack0000'))
+            self.assertTrue(b'refs/tags/v1' in body)
+
+        # passthrough off = v0 for everybody.
+        app = git_http_backend_asgi.assemble_ASGI_git_app(self.base_path, git_protocol_passthrough = False)
+        status, headers, body = call(app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack', headers = v2)
+        self.assertTrue(body.startswith(b'001d# service=git-upload-pack0000'))
+
+    def test_09_admission_waiting(self):
+        controller = admission.AdmissionController(max_total = 1, timeout = 0.1)
+        handler = git_http_backend.GitHTTPBackendSmartHTTP(content_path = self.base_path, admission = controller)
+        async def run():
+            release = controller.acquire('a', 'upload-pack')
+            # timing out, without a thread per waiting request.
+            self.assertEqual(await self.app.wait_for_slot(controller, 'a', 'upload-pack'), None)
+            self.assertEqual(controller.status()['timed_out'], 1)
+            # cancelled while waiting (client went away.)
+            task = asyncio.ensure_future(self.app.wait_for_slot(controller, 'a', 'upload-pack'))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(controller.status()['waiting'], 0)
+            # cancelled as the slot comes. It is either handed over or released.
+            task = asyncio.ensure_future(self.app.wait_for_slot(controller, 'a', 'upload-pack'))
+            await asyncio.sleep(0.01)
+            release()
+            task.cancel()
+            try:
+                (await task)()
+            except asyncio.CancelledError:
+                pass
+            self.assertEqual(controller.status()['running'], 0)
+            # handed the slot.
+            release = controller.acquire('a', 'upload-pack')
+            task = asyncio.ensure_future(self.app.admit(handler, {}, None, 'a', 'upload-pack'))
+            await asyncio.sleep(0.01)
+            release()
+            release = await task
+            self.assertEqual(controller.status()['running'], 1)
+            release()
+        asyncio.run(run())
+        self.assertEqual(controller.status()['running'], 0)
+
+    def test_10_wsgi_apps_off_the_loop(self):
+        threads = []
+        def body():
+            threads.append(threading.current_thread())
+            yield b'a'
+            threads.append(threading.current_thread())
+            yield b'b'
+        def app(environ, start_response):
+            threads.append(threading.current_thread())
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return body()
+        selector = git_http_backend.WSGIHandlerSelector()
+        selector.add('^/app$', GET = app)
+        status, headers, body = call(git_http_backend_asgi.ASGIGitApp(selector), 'GET', '/app')
+        self.assertEqual((status, body), (200, b'ab'))
+        self.assertEqual(len(threads), 3)
+        self.assertFalse(threading.current_thread() in threads)
+        # static files still come through.
+        status, headers, body = call(self.app, 'GET', '/repo.git/HEAD')
+        with open(os.path.join(self.repo_path, 'HEAD'), 'rb') as f:
+            self.assertEqual((status, body), (200, f.read()))
+
+    def test_11_repo_work_off_the_loop(self):
+        threads = []
+        def recording(func):
+            def wrapper(*args, **kw):
+                threads.append((func.__name__, threading.current_thread()))
+                return func(*args, **kw)
+            return wrapper
+        basic_checks = git_http_backend.GitHTTPBackendBase.basic_checks
+        fingerprint = responsecache.ref_state_fingerprint
+        git_http_backend.GitHTTPBackendBase.basic_checks = recording(basic_checks)
+        responsecache.ref_state_fingerprint = recording(fingerprint)
+        try:
+            advertiser = advertisement.RefAdvertiser()
+            advertiser.advertise = recording(advertiser.advertise)
+            app = git_http_backend_asgi.assemble_ASGI_git_app(
+                self.base_path,
+                advertisement_cache = responsecache.AdvertisementCache(),
+                ref_advertiser = advertiser)
+            status, headers, body = call(app, 'GET', '/repo.git/info/refs', b'service=git-upload-pack')
+        finally:
+            git_http_backend.GitHTTPBackendBase.basic_checks = basic_checks
+            responsecache.ref_state_fingerprint = fingerprint
+        self.assertEqual(status, 200)
+        self.assertTrue(self.head in body)
+        names = [name for name, thread in threads]
+        self.assertTrue('basic_checks' in names and 'ref_state_fingerprint' in names, names)
+        if advertiser.enabled:
+            self.assertTrue('advertise' in names, names)
+        self.assertFalse([name for name, thread in threads if thread is threading.current_thread()])
+
+    def test_12_error_output_tail(self):
+        app = git_http_backend_asgi.ASGIGitApp(git_http_backend.WSGIHandlerSelector())
+        errors = io.StringIO()
+        sent = []
+        async def send(message):
+            sent.append(message)
+        ok = asyncio.run(app.run_git(
+            {'wsgi.errors': errors}, send,
+            ['sh', '-c', 'head -c 100000 /dev/zero | tr "\\000" x >&2; exit 1'], []))
+        self.assertFalse(ok)
+        self.assertEqual(sent[0]['status'], 417)
+        self.assertTrue(16000 <= len(errors.getvalue()) < 16100)
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
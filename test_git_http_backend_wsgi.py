@@ -0,0 +1,123 @@
+import io
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+import subprocess
+from wsgiref.util import setup_testing_defaults
+import subprocessio
+import git_http_backend
+
+def pkt(line):
+    return ('%04x' % (len(line) + 4)).encode('ascii') + line
+
+def gzipped(data):
+    out = io.BytesIO()
+    f = gzip.GzipFile(fileobj = out, mode = 'wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.base_path, 'repo.git')
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', self.repo_path])
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def call(self, app, path, method = 'GET', body = None, **extra):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': method}
+        setup_testing_defaults(environ)
+        if body is not None:
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+        environ.update(extra)
+        status = []
+        def start_response(s, headers, exc_info = None):
+            status.append(s)
+            self.headers = dict(headers)
+        result = app(environ, start_response)
+        # (canned responses are native strings.)
+        body = b''.join(data if isinstance(data, bytes) else data.encode('ascii') for data in result)
+        if hasattr(result, 'close'):
+            result.close()
+        return status[0], body
+
+    def test_01_gzip_request_too_large(self):
+        request = gzipped(pkt(b'want ' + b'1' * 40 + b' ofs-delta\n') + b'0000' + pkt(b'done\n') + b'0000' * 10000)
+        for chunker in (subprocessio.SubprocessIOChunker, subprocessio.ReactorSubprocessIOChunker):
+            for command in ('git-upload-pack', 'git-receive-pack'):
+                app = git_http_backend.assemble_WSGI_git_app(
+                    content_path = self.base_path, max_gzip_request_size = 1000, subprocess_chunker = chunker)
+                status, body = self.call(
+                    app, '/repo.git/' + command, 'POST', request, HTTP_CONTENT_ENCODING = 'gzip')
+                self.assertEqual(status, '413 Request Entity Too Large', (chunker, command))
+
+    def test_02_select(self):
+        calls = []
+        def handler(name):
+            def app(environ, start_response):
+                calls.append((name, environ))
+                start_response('200 OK', [])
+                return [b'']
+            return app
+        selector = git_http_backend.WSGIHandlerSelector()
+        selector.add('^(?P<decorative_path>.*?)/my(?P<working_path>/.*)$', GET = handler('my'), HEAD = handler('my'))
+        selector.add('^/refs\\?service=(?P<service>[a-z-]+)$', GET = handler('refs'))
+        selector.add('^/any(?P<working_path>/.*)$', handler('any'), POST = handler('post'))
+
+        first = selector.select('/x/my/repo.git/HEAD', 'GET')
+        self.assertTrue(selector.select('/x/my/repo.git/HEAD', 'GET') is first)
+        self.assertEqual(first[1].groupdict()['working_path'], '/repo.git/HEAD')
+        self.assertEqual(first[3], '/x/my/repo.git/HEAD')
+        handler_, matches, alternate_verbs, path = selector.select('/x/my/repo.git/HEAD', 'POST')
+        self.assertEqual((handler_, sorted(alternate_verbs)), (None, ['GET', 'HEAD']))
+        # routes needing the query string get it.
+        self.assertEqual(selector.select('/refs', 'GET', 'service=git-upload-pack')[1].group('service'), 'git-upload-pack')
+        self.assertEqual(selector.select('/refs', 'GET', 'service=')[0], None)
+        self.assertEqual(selector.select('/refs', 'GET')[0], None)
+        # default handler answers the methods not named, without the route learning them.
+        self.assertTrue(selector.select('/any/thing', 'PUT')[0] is not None)
+        self.assertEqual(sorted(selector.mappings[2][1]), ['POST'])
+        # trash paths
+        self.assertEqual(selector.select('/../my/etc', 'GET')[0], None)
+
+        selector.route_cache_size = 2
+        for i in range(5):
+            selector.select('/x/my/repo%d.git/HEAD' % i, 'GET')
+        self.assertEqual(len(selector.route_cache), 2)
+        # adding routes forgets what was looked up.
+        selector.add('^/other$', GET = handler('other'))
+        self.assertEqual(len(selector.route_cache), 0)
+
+        # routing_args: groups after those of routers before us.
+        environ = {'wsgiorg.routing_args': (['outer'], {'outer': 'outer'})}
+        status, body = self.call(selector, '/x/my/repo.git/HEAD', **environ)
+        name, environ = calls.pop()
+        self.assertEqual(name, 'my')
+        self.assertEqual(environ['wsgiorg.routing_args'], (
+            ['outer', '/x', '/repo.git/HEAD'],
+            {'outer': 'outer', 'decorative_path': '/x', 'working_path': '/repo.git/HEAD'}))
+
+    def test_03_method_not_allowed(self):
+        app = git_http_backend.assemble_WSGI_git_app(content_path = self.base_path, uri_marker = 'my')
+        status, body = self.call(app, '/x/my/repo.git/git-upload-pack', 'PUT')
+        self.assertEqual(status, '405 Method Not Allowed')
+        # (the generic route matches too.)
+        self.assertEqual(sorted(self.headers['Allow'].split(', ')), ['GET', 'HEAD', 'POST'])
+        status, body = self.call(app, '/x/my/repo.git/HEAD')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(body.startswith(b'ref: refs/heads/'))
+        status, body = self.call(app, '/x/nope/repo.git/HEAD')
+        self.assertEqual(status, '404 Not Found')
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
@@ -0,0 +1,24 @@
+import unittest
+import lru
+
+class MainTestCase(unittest.TestCase):
+
+    def test_01_order(self):
+        cache = lru.LRU()
+        for key in 'abc':
+            self.assertEqual(cache.add(key, key.upper()), None)
+        self.assertEqual(cache.touch('a'), 'A')
+        self.assertEqual(cache.touch('x'), None)
+        self.assertEqual(list(cache), ['b', 'c', 'a'])
+        self.assertEqual(cache.add('b', 'B2'), 'B')
+        self.assertEqual(list(cache), ['c', 'a', 'b'])
+        self.assertEqual(cache.trim(1), [('c', 'C'), ('a', 'A')])
+        self.assertEqual(cache.trim(1), [])
+        self.assertEqual(list(cache.items()), [('b', 'B2')])
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
@@ -0,0 +1,180 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+import filecache
+import maintenance
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.calls = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def job(self, repo_path):
+        with self.lock:
+            self.calls.append(repo_path)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.05)
+        with self.lock:
+            self.active -= 1
+
+    def test_01_debounce_and_coalescing(self):
+        scheduler = maintenance.MaintenanceScheduler(
+            debounce = 0.1, max_workers = 2, jobs = {'test': self.job})
+        for i in range(20):
+            scheduler.schedule('a', 'test')
+            scheduler.schedule('b', 'test')
+        self.assertEqual(self.calls, [])
+        self.assertTrue(scheduler.wait(5))
+        self.assertEqual(sorted(self.calls), ['a', 'b'])
+        self.assertEqual((scheduler.requested, scheduler.coalesced, scheduler.runs), (40, 38, 2))
+        self.assertRaises(KeyError, scheduler.schedule, 'a', 'unknown')
+
+        # requested while running = one more run, after this one.
+        self.calls = []
+        scheduler.debounce = 0
+        scheduler.schedule('a', 'test')
+        time.sleep(0.02)
+        scheduler.schedule('a', 'test')
+        scheduler.schedule('a', 'test')
+        self.assertTrue(scheduler.wait(5))
+        self.assertEqual(self.calls, ['a', 'a'])
+        self.assertEqual(self.max_active, 2)
+        scheduler.close()
+
+    def test_02_max_delay_and_workers(self):
+        scheduler = maintenance.MaintenanceScheduler(
+            debounce = 0.05, max_delay = 0.2, max_workers = 1, jobs = {'test': self.job})
+        start = time.time()
+        # requests coming more often than debounce do not hold the job off forever.
+        while not self.calls and time.time() - start < 5:
+            scheduler.schedule('a', 'test')
+            time.sleep(0.01)
+        self.assertTrue(self.calls)
+        self.assertTrue(time.time() - start < 1)
+        for name in 'bcd':
+            scheduler.schedule(name, 'test')
+        self.assertTrue(scheduler.wait(5))
+        self.assertEqual(self.max_active, 1)
+        self.assertEqual(len(scheduler.workers), 1)
+        scheduler.close()
+
+    def test_03_update_server_info(self):
+        repo_path = os.path.join(self.base_path, 'repo.git')
+        subprocess.call(['git', 'init', '--quiet', '--bare', repo_path])
+        scheduler = maintenance.MaintenanceScheduler(debounce = 0)
+        scheduler.schedule(repo_path)
+        self.assertTrue(scheduler.wait(10))
+        self.assertTrue(os.path.isfile(os.path.join(repo_path, 'info', 'refs')))
+        self.assertEqual(scheduler.failures, 0)
+        scheduler.schedule(os.path.join(self.base_path, 'missing.git'))
+        self.assertTrue(scheduler.wait(10))
+        self.assertEqual(scheduler.failures, 1)
+        scheduler.close()
+
+    def test_04_plan(self):
+        scheduler = maintenance.MaintenanceScheduler(repack_packs = 50, midx_packs = 10)
+        stats = {'packs': 1, 'loose_objects': 0, 'commit_graph': True, 'multi_pack_index': False}
+        self.assertEqual(scheduler.plan(stats), [])
+        stats['commit_graph'] = False
+        self.assertEqual(scheduler.plan(stats), ['commit-graph'])
+        stats['packs'] = 10
+        self.assertEqual(scheduler.plan(stats), ['multi-pack-index', 'commit-graph'])
+        stats['packs'] = 50
+        self.assertEqual(scheduler.plan(stats), ['repack', 'commit-graph', 'update-server-info'])
+        stats['packs'], stats['loose_objects'] = 1, 6912
+        self.assertEqual(scheduler.plan(stats)[0], 'repack')
+
+    def test_05_maintenance(self):
+        repo_path = os.path.join(self.base_path, 'repo.git')
+        work_path = os.path.join(self.base_path, 'work')
+        git = ['git', '-c', 'user.name=a', '-c', 'user.email=a@b']
+        subprocess.call(['git', 'init', '--quiet', '--bare', repo_path])
+        # every push leaves a pack of its own.
+        subprocess.call(['git', '--git-dir', repo_path, 'config', 'receive.unpackLimit', '1'])
+        subprocess.call(['git', 'init', '--quiet', work_path])
+        for i in range(3):
+            with open(os.path.join(work_path, 'file'), 'w') as f:
+                f.write('%d\n' % i)
+            subprocess.call(git + ['add', 'file'], cwd = work_path)
+            subprocess.call(git + ['commit', '--quiet', '-m', str(i)], cwd = work_path)
+            subprocess.call(git + ['push', '--quiet', repo_path, 'HEAD:refs/heads/master'], cwd = work_path)
+        self.assertEqual(maintenance.repo_stats(repo_path)['packs'], 3)
+
+        cache = filecache.FileCache()
+        old_packs = [os.path.join(repo_path, 'objects', 'pack', name)
+            for name in os.listdir(os.path.join(repo_path, 'objects', 'pack'))]
+        for path in old_packs:
+            cache.put(path, path, os.stat(path), path, True)
+            if cache.max_open:
+                cache.open(path)[1]()
+
+        scheduler = maintenance.MaintenanceScheduler(
+            debounce = 0, maintenance_delay = 0, repack_packs = 3, file_cache = cache)
+        scheduler.after_push(repo_path)
+        self.assertTrue(scheduler.wait(30))
+        # deleted packs are not kept open.
+        self.assertEqual(list(cache.entries), [])
+        self.assertEqual(cache.open_files, {})
+        stats = maintenance.repo_stats(repo_path)
+        self.assertEqual(stats['packs'], 1)
+        self.assertTrue(stats['commit_graph'])
+        pack_names = os.listdir(os.path.join(repo_path, 'objects', 'pack'))
+        self.assertTrue([n for n in pack_names if n.endswith('.bitmap')])
+        with open(os.path.join(repo_path, 'objects', 'info', 'packs')) as f:
+            self.assertEqual(len([l for l in f if l.startswith('P ')]), 1)
+        status = scheduler.status()
+        self.assertEqual(status['failures'], 0)
+        self.assertEqual(status['repos'][repo_path]['stats']['packs'], 3)
+        self.assertEqual(
+            status['repos'][repo_path]['results'],
+            {'repack': 0, 'commit-graph': 0, 'update-server-info': 0})
+
+        # too soon for another round.
+        scheduler.schedule(repo_path, 'maintenance', 0)
+        time.sleep(0.2)
+        status = scheduler.status()
+        self.assertEqual([job[:2] for job in status['pending']], [(repo_path, 'maintenance')])
+        self.assertTrue(status['pending'][0][2] > time.time() + 500)
+        scheduler.close()
+
+    def test_06_heavy_jobs_workers(self):
+        started = threading.Event()
+        finish = threading.Event()
+        def heavy(repo_path):
+            started.set()
+            finish.wait(10)
+        scheduler = maintenance.MaintenanceScheduler(
+            debounce = 0, max_workers = 1, max_heavy_jobs = 1,
+            jobs = {'maintenance': heavy, 'update-server-info': self.job})
+        scheduler.schedule('a', 'maintenance', 0)
+        self.assertTrue(started.wait(5))
+        # a long maintenance job does not hold update-server-info up.
+        scheduler.schedule('a')
+        scheduler.schedule('b')
+        deadline = time.time() + 5
+        while len(self.calls) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sorted(self.calls), ['a', 'b'])
+        self.assertEqual((len(scheduler.workers), len(scheduler.heavy_workers)), (1, 1))
+        finish.set()
+        self.assertTrue(scheduler.wait(5))
+        scheduler.close()
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
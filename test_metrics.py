@@ -0,0 +1,153 @@
+import io
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from wsgiref.util import setup_testing_defaults, FileWrapper
+import metrics
+import subprocessio
+import processlauncher
+import git_http_backend
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def call(self, app, path, method = 'GET', **extra):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': method}
+        setup_testing_defaults(environ)
+        environ.update(extra)
+        status = []
+        result = app(environ, lambda s, headers, exc_info = None: status.append(s))
+        # (canned responses are native strings.)
+        body = b''.join(data if isinstance(data, bytes) else data.encode('ascii') for data in result)
+        if hasattr(result, 'close'):
+            result.close()
+        return status[0], body
+
+    def test_01_render(self):
+        m = metrics.Metrics()
+        m.inc('requests_total', (('route', 'static'), ('code', '200')))
+        m.inc('requests_total', (('route', 'static'), ('code', '200')))
+        m.observe('request_duration_seconds', (('route', 'static'), ('phase', 'total')), 0.003)
+        m.inc('subprocesses_active', (('route', 'a"b'),), 1)
+        lines = m.render().split('\n')
+        for line in [
+                '# TYPE git_http_requests_total counter',
+                'git_http_requests_total{route="static",code="200"} 2',
+                '# TYPE git_http_request_duration_seconds histogram',
+                'git_http_request_duration_seconds_bucket{route="static",phase="total",le="0.0025"} 0',
+                'git_http_request_duration_seconds_bucket{route="static",phase="total",le="0.005"} 1',
+                'git_http_request_duration_seconds_bucket{route="static",phase="total",le="+Inf"} 1',
+                'git_http_request_duration_seconds_sum{route="static",phase="total"} 0.003',
+                'git_http_request_duration_seconds_count{route="static",phase="total"} 1',
+                'git_http_subprocesses_active{route="a\\"b"} 1']:
+            self.assertTrue(line in lines, line)
+        status, body = self.call(m, '/metrics')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(b'git_http_requests_total{route="static",code="200"} 2\n' in body)
+
+    def test_02_subprocesses(self):
+        launchers = [processlauncher.ProcessLauncher()]
+        if processlauncher.SpawnLauncher.available:
+            launchers.append(processlauncher.SpawnLauncher())
+        for launcher in launchers:
+            m = metrics.Metrics()
+            request = m.request({})
+            chunker = subprocessio.SubprocessIOChunker(
+                ['head', '-c', '100000', '/dev/zero'],
+                buffer_size = 4096,
+                chunk_size = 1024,
+                launcher = launcher,
+                metrics = request
+                )
+            labels = (('route', 'unrouted'),)
+            self.assertEqual(m.get('subprocesses_active', labels), 1)
+            size = 0
+            try:
+                while True:
+                    size += len(chunker.next())
+            except StopIteration:
+                pass
+            self.assertEqual(size, 100000)
+            chunker.close()
+            chunker.process.wait()
+            self.assertEqual(m.get('subprocesses_total', labels), 1)
+            self.assertEqual(m.get('subprocesses_active', labels), 0)
+            self.assertTrue(m.get('buffer_stalls_total', labels) >= 1)
+            self.assertEqual([phase for phase, seconds in request.phases], ['spawn'])
+            if isinstance(launcher, processlauncher.SpawnLauncher):
+                self.assertTrue(chunker.process.rusage.ru_maxrss > 0)
+                self.assertTrue(m.get('subprocess_cpu_seconds_total', labels + (('mode', 'user'),)) is not None)
+                self.assertEqual(m.get('subprocess_max_rss_bytes', labels).count, 1)
+            else:
+                self.assertEqual(m.get('subprocess_max_rss_bytes', labels), None)
+
+    def test_03_requests(self):
+        f = open(os.path.join(self.base_path, 'hello.txt'), 'wb')
+        f.write(b'hello')
+        f.close()
+        m = metrics.Metrics()
+        app = git_http_backend.assemble_WSGI_git_app(
+            content_path = self.base_path, metrics = m, metrics_path = '/metrics')
+        self.assertEqual(self.call(app, '/hello.txt'), ('200 OK', b'hello'))
+        # responses through wsgi.file_wrapper are counted per Content-Length.
+        self.assertEqual(
+            self.call(app, '/hello.txt', **{'wsgi.file_wrapper': FileWrapper}),
+            ('200 OK', b'hello'))
+        self.assertEqual(self.call(app, '/nothing.txt')[0], '404 Not Found')
+        self.assertEqual(self.call(app, '/hello.txt', 'POST')[0], '405 Method Not Allowed')
+
+        static = (('route', 'static'),)
+        self.assertEqual(m.get('requests_total', static + (('code', '200'),)), 2)
+        self.assertEqual(m.get('requests_total', static + (('code', '404'),)), 1)
+        self.assertEqual(m.get('requests_total', (('route', 'unrouted'), ('code', '405'))), 1)
+        self.assertEqual(m.get('response_bytes_total', static), 10)
+        self.assertEqual(m.get('request_bytes_total', static), 0)
+        for phase, count in (('routing', 3), ('checks', 2), ('first_byte', 2), ('total', 3)):
+            self.assertEqual(m.get('request_duration_seconds', static + (('phase', phase),)).count, count)
+
+        status, body = self.call(app, '/metrics')
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(b'git_http_requests_total{route="static",code="200"} 2\n' in body)
+        self.assertEqual(self.call(app, '/metrics', 'HEAD'), ('200 OK', b''))
+        self.assertEqual(m.get('requests_total', (('route', 'metrics'), ('code', '200'))), 2)
+
+        # not served unless asked for.
+        app = git_http_backend.assemble_WSGI_git_app(content_path = self.base_path, metrics = m)
+        self.assertEqual(self.call(app, '/metrics')[0], '404 Not Found')
+
+    def test_04_git_requests(self):
+        if sys.version_info[0] > 2:
+            self.skipTest('subprocessio iterators are Python 2 ones')
+        repo_path = os.path.join(self.base_path, 'repo.git')
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', repo_path])
+        m = metrics.Metrics()
+        app = git_http_backend.assemble_WSGI_git_app(content_path = self.base_path, metrics = m)
+        status, body = self.call(app, '/repo.git/info/refs', QUERY_STRING = 'service=git-upload-pack')
+        self.assertEqual(status, '200 OK')
+        route = (('route', 'info-refs/upload-pack'),)
+        self.assertEqual(m.get('response_bytes_total', route), len(body))
+        self.assertEqual(m.get('subprocesses_total', route), 1)
+        for phase in ('routing', 'checks', 'spawn', 'first_byte', 'total'):
+            self.assertEqual(m.get('request_duration_seconds', route + (('phase', phase),)).count, 1)
+
+        request = b'0000'
+        status, body = self.call(app, '/repo.git/git-upload-pack', 'POST', **{
+            'wsgi.input': io.BytesIO(request), 'CONTENT_LENGTH': str(len(request))})
+        route = (('route', 'rpc/upload-pack'),)
+        self.assertEqual(m.get('request_bytes_total', route), 4)
+        self.assertEqual(m.get('subprocesses_total', route), 1)
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
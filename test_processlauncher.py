@@ -0,0 +1,126 @@
+import os
+import unittest
+import subprocessio
+import processlauncher
+
+class MainTestCase(unittest.TestCase):
+
+    def launchers(self):
+        launchers = [processlauncher.ProcessLauncher()]
+        if processlauncher.SpawnLauncher.available:
+            launchers.append(processlauncher.SpawnLauncher())
+        return launchers
+
+    def output(self, process):
+        # reads the output and reaps the process.
+        try:
+            return process.stdout.read()
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    def test_01_spawn(self):
+        for launcher in self.launchers():
+            process = launcher.spawn(['cat'], stdin = processlauncher.PIPE)
+            process.stdin.write(b'hello')
+            process.stdin.close()
+            self.assertEqual(process.stdout.read(), b'hello')
+            self.assertEqual(process.wait(), 0)
+            # strings are shell command lines.
+            process = launcher.spawn('echo $0; exit 3')
+            self.assertEqual(process.stdout.read(), b'/bin/sh\n')
+            self.assertEqual(process.wait(), 3)
+            process = launcher.spawn(['sleep', '10'])
+            self.assertEqual(process.poll(), None)
+            process.terminate()
+            self.assertEqual(process.wait(), -15)
+            self.assertRaises(OSError, launcher.spawn, ['/nonexistent/git'])
+            self.assertEqual(launcher.call(['false']), 1)
+            self.assertEqual(launcher.call(['true'], nice = 1), 0)
+            # (the one failing to start is not counted.)
+            self.assertEqual(launcher.spawned, 5)
+
+    def test_02_environment_and_fds(self):
+        os.environ['GIT_DIR'] = '/somewhere'
+        os.environ['GIT_TRACE_PACKET'] = '0'
+        try:
+            for launcher in self.launchers():
+                env = self.output(launcher.spawn(['env'])).split(b'\n')
+                self.assertTrue(b'GIT_TRACE_PACKET=0' in env)
+                self.assertFalse(b'GIT_DIR=/somewhere' in env)
+                self.assertTrue([v for v in env if v.startswith(b'PATH=')])
+                self.assertTrue(b'A=b' in self.output(launcher.spawn(['env'], env = launcher.environ({'A': 'b'}))))
+        finally:
+            del os.environ['GIT_DIR']
+            del os.environ['GIT_TRACE_PACKET']
+        if not os.path.isdir('/proc/self/fd'):
+            return
+        r, w = os.pipe()
+        try:
+            if hasattr(os, 'set_inheritable'):
+                os.set_inheritable(w, True)
+            for launcher in self.launchers():
+                fds = self.output(launcher.spawn('ls /proc/$$/fd; true')).split()
+                self.assertEqual(sorted(fds), [b'0', b'1', b'2'])
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_03_executables(self):
+        launcher = processlauncher.ProcessLauncher(executables = {'git': '/bin/echo'})
+        self.assertEqual(self.output(launcher.spawn(['git', 'version'])), b'version\n')
+        launcher = processlauncher.ProcessLauncher()
+        path = launcher.which('sh')
+        self.assertTrue(os.path.isabs(path))
+        self.assertEqual(launcher.executables, {'sh': path})
+        self.assertEqual(launcher.argv(['sh', '-c', 'true']), [path, '-c', 'true'])
+        self.assertEqual(launcher.which('no-such-program'), 'no-such-program')
+
+    def test_04_chunker_input(self):
+        if not os.path.isdir('/proc/self/fd'):
+            return
+        fds = set(os.listdir('/proc/self/fd'))
+        for launcher in self.launchers():
+            for i in range(5):
+                chunker = subprocessio.SubprocessIOChunker(
+                    ['head', '-c', '3'], inputstream = b'abcdef', launcher = launcher)
+                self.assertEqual(chunker.next(), b'abc')
+                self.assertRaises(StopIteration, chunker.next)
+                chunker.close()
+        # no stdin pipe ends are left behind.
+        self.assertEqual(set(os.listdir('/proc/self/fd')) - fds, set())
+
+    def test_05_reaping(self):
+        if processlauncher.SpawnLauncher.available:
+            # exit status taken by someone else is no success.
+            process = processlauncher.SpawnLauncher().spawn(['true'])
+            os.waitpid(process.pid, 0)
+            self.assertEqual(process.wait(), -1)
+        for launcher in self.launchers():
+            for chunker_class in (subprocessio.SubprocessIOChunker, subprocessio.ReactorSubprocessIOChunker):
+                # (more output than fits the buffer, for the chunker to start.)
+                chunker = chunker_class(['sh', '-c', 'head -c 1000000 /dev/zero; exec sleep 10'],
+                    buffer_size = 65536, chunk_size = 4096, launcher = launcher)
+                self.assertEqual(chunker.next(), b'\0' * 4096)
+                chunker.close()
+                # closing the chunker reaps the process.
+                self.assertEqual(chunker.process.returncode, -15)
+            output = subprocessio.SubprocessIOChunker(
+                ['sh', '-c', 'echo a; exec sleep 10'], passthrough = True, launcher = launcher).output
+            self.assertEqual(output.read(2), b'a\n')
+            output.close()
+            self.assertEqual(output.process.returncode, -15)
+            # file descriptors are fed as input too.
+            r, w = os.pipe()
+            os.write(w, b'abc')
+            os.close(w)
+            chunker = subprocessio.SubprocessIOChunker(['cat'], inputstream = r, launcher = launcher)
+            self.assertEqual(chunker.next(), b'abc')
+            chunker.close()
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
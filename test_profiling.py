@@ -0,0 +1,184 @@
+import gc
+import io
+import os
+import sys
+import time
+import pstats
+import shutil
+import tempfile
+import unittest
+import subprocess
+from wsgiref.util import setup_testing_defaults, FileWrapper
+import profiling
+import git_http_backend
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.profiles_path = os.path.join(self.base_path, 'profiles')
+        f = open(os.path.join(self.base_path, 'hello.txt'), 'wb')
+        f.write(b'hello')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def call(self, app, path, method = 'GET', **extra):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': method}
+        setup_testing_defaults(environ)
+        environ.update(extra)
+        status = []
+        result = app(environ, lambda s, headers, exc_info = None: status.append(s))
+        # (canned responses are native strings.)
+        body = b''.join(data if isinstance(data, bytes) else data.encode('ascii') for data in result)
+        if hasattr(result, 'close'):
+            result.close()
+        return status[0], body
+
+    def profiles(self):
+        return sorted(os.listdir(self.profiles_path))
+
+    def test_01_picking(self):
+        profiler = profiling.RequestProfiler(self.profiles_path, token = 'secret')
+        app = git_http_backend.assemble_WSGI_git_app(content_path = self.base_path, profiler = profiler)
+        self.assertEqual(self.call(app, '/hello.txt'), ('200 OK', b'hello'))
+        self.assertEqual(self.call(app, '/hello.txt', HTTP_X_GIT_HTTP_PROFILE = 'guess'), ('200 OK', b'hello'))
+        self.assertEqual(self.profiles(), [])
+
+        self.assertEqual(self.call(app, '/hello.txt', HTTP_X_GIT_HTTP_PROFILE = 'secret'), ('200 OK', b'hello'))
+        self.assertEqual(self.call(app, '/nothing.txt', HTTP_X_GIT_HTTP_PROFILE = 'secret')[0], '404 Not Found')
+        self.assertEqual(
+            self.call(app, '/hello.txt', HTTP_X_GIT_HTTP_PROFILE = 'secret', **{'wsgi.file_wrapper': FileWrapper}),
+            ('200 OK', b'hello'))
+        names = self.profiles()
+        self.assertEqual(len(names), 3)
+        self.assertEqual((profiler.profiled, profiler.written, profiler.failed), (3, 3, 0))
+        for name in names:
+            self.assertTrue(name.endswith('.pstats'), name)
+        self.assertTrue([name for name in names if name.endswith('-static-hello.txt.pstats')])
+        self.assertTrue([name for name in names if name.endswith('-static-nothing.txt.pstats')])
+        stats = pstats.Stats(os.path.join(self.profiles_path, names[0]))
+        self.assertTrue([func for func in stats.stats if func[2] == 'dispatch'])
+
+        # no token, no header. Sampling only.
+        profiler = profiling.RequestProfiler(self.profiles_path, sample_rate = 1.0)
+        app = git_http_backend.assemble_WSGI_git_app(content_path = self.base_path, profiler = profiler)
+        self.call(app, '/hello.txt', HTTP_X_GIT_HTTP_PROFILE = '')
+        self.assertEqual(profiler.written, 1)
+        self.assertEqual(len(self.profiles()), 4)
+
+        self.assertRaises(ValueError, profiling.RequestProfiler, self.profiles_path, formats = ('svg',))
+
+    def test_02_response_iteration(self):
+        def slow_body():
+            for i in range(5):
+                deadline = time.time() + 0.02
+                while time.time() < deadline:
+                    pass
+                yield b'x'
+
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return slow_body()
+
+        profiler = profiling.RequestProfiler(
+            self.profiles_path, sample_rate = 1.0, formats = ('pstats', 'collapsed'))
+        selector = git_http_backend.WSGIHandlerSelector(profiler = profiler)
+        selector.add('^/(?P<working_path>.*)$', GET = app)
+        self.assertEqual(self.call(selector, '/some/repo.git'), ('200 OK', b'xxxxx'))
+        names = self.profiles()
+        self.assertEqual(len(names), 2)
+        self.assertTrue(names[0].endswith('-other-some_repo.git.collapsed'), names[0])
+        self.assertTrue(names[1].endswith('-other-some_repo.git.pstats'), names[1])
+
+        stats = pstats.Stats(os.path.join(self.profiles_path, names[1]))
+        self.assertTrue([func for func in stats.stats if func[2] == 'slow_body'])
+        f = open(os.path.join(self.profiles_path, names[0]))
+        lines = f.read().splitlines()
+        f.close()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue(int(count) > 0)
+        self.assertTrue([line for line in lines if 'slow_body' in line])
+
+    def test_03_git_requests(self):
+        if sys.version_info[0] > 2:
+            self.skipTest('subprocessio iterators are Python 2 ones')
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', os.path.join(self.base_path, 'repo.git')])
+        profiler = profiling.RequestProfiler(self.profiles_path, sample_rate = 1.0)
+        app = git_http_backend.assemble_WSGI_git_app(content_path = self.base_path, profiler = profiler)
+        status, body = self.call(app, '/repo.git/info/refs', QUERY_STRING = 'service=git-upload-pack')
+        self.assertEqual(status, '200 OK')
+        request = b'0000'
+        status, body = self.call(app, '/repo.git/git-upload-pack', 'POST', **{
+            'wsgi.input': io.BytesIO(request), 'CONTENT_LENGTH': str(len(request))})
+        self.assertEqual(status, '200 OK')
+        names = self.profiles()
+        self.assertTrue([name for name in names if name.endswith('-info-refs_upload-pack-repo.git.pstats')], names)
+        self.assertTrue([name for name in names if name.endswith('-rpc_upload-pack-repo.git.pstats')], names)
+
+    def test_04_one_cprofile_at_a_time(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return iter([b'x', b'y'])
+        for formats, written in ((('pstats',), ['.pstats']), (('pstats', 'collapsed'), ['.collapsed', '.pstats'])):
+            shutil.rmtree(self.profiles_path, True)
+            profiler = profiling.RequestProfiler(self.profiles_path, sample_rate = 1.0, formats = formats)
+            selector = git_http_backend.WSGIHandlerSelector(profiler = profiler)
+            selector.add('^/(?P<working_path>.*)$', GET = app)
+            environ = {'PATH_INFO': '/first', 'REQUEST_METHOD': 'GET'}
+            setup_testing_defaults(environ)
+            # still being sent.
+            first = selector(environ, lambda s, headers, exc_info = None: None)
+            self.assertEqual(self.call(selector, '/second'), ('200 OK', b'xy'))
+            self.assertEqual(b''.join(first), b'xy')
+            first.close()
+            # and once the first one is done.
+            self.assertEqual(self.call(selector, '/third'), ('200 OK', b'xy'))
+            names = self.profiles()
+            self.assertEqual([name.rsplit('-', 1)[1] for name in names if '-first.' in name],
+                ['first' + ext for ext in written])
+            self.assertEqual([name.rsplit('-', 1)[1] for name in names if '-second.' in name],
+                ['second.collapsed'] if 'collapsed' in formats else [])
+            self.assertEqual([name.rsplit('-', 1)[1] for name in names if '-third.' in name],
+                ['third' + ext for ext in written])
+            self.assertEqual(profiler.busy, 0 if 'collapsed' in formats else 1)
+
+    def test_05_dropped_responses(self):
+        def body():
+            yield b'x'
+            raise IOError('failed')
+        def failing(environ, start_response):
+            start_response('200 OK', [])
+            return body()
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            return iter([b'x', b'y'])
+        profiler = profiling.RequestProfiler(self.profiles_path, sample_rate = 1.0)
+        selector = git_http_backend.WSGIHandlerSelector(profiler = profiler)
+        selector.add('^/(?P<working_path>failing)$', GET = failing)
+        selector.add('^/(?P<working_path>.*)$', GET = app)
+        environ = {'PATH_INFO': '/failing', 'REQUEST_METHOD': 'GET'}
+        setup_testing_defaults(environ)
+        result = selector(environ, lambda s, headers, exc_info = None: None)
+        self.assertRaises(IOError, b''.join, result)
+        # neither closed nor exhausted: client went away.
+        environ = {'PATH_INFO': '/dropped', 'REQUEST_METHOD': 'GET'}
+        setup_testing_defaults(environ)
+        result = selector(environ, lambda s, headers, exc_info = None: None)
+        self.assertEqual(next(result), b'x')
+        del result
+        gc.collect()
+        self.assertEqual(self.call(selector, '/next'), ('200 OK', b'xy'))
+        names = self.profiles()
+        for name in ('failing', 'dropped', 'next'):
+            self.assertEqual(len([n for n in names if n.endswith('-%s.pstats' % name)]), 1, names)
+        self.assertEqual(profiler.busy, 0)
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
@@ -0,0 +1,92 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import repoindex
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.base_path, 'repo.git')
+        os.makedirs(os.path.join(self.repo_path, 'refs'))
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def touch(self, name):
+        open(os.path.join(self.repo_path, name), 'w').close()
+
+    def wait_for(self, index, names):
+        # inotify events are picked up by a thread, a moment later.
+        for i in range(100):
+            if index.listdir(self.repo_path) == frozenset(names):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_01_ttl_and_stat_revalidation(self):
+        index = repoindex.RepoIndex(ttl = 0, use_inotify = False)
+        self.assertEqual(index.listdir(self.repo_path), frozenset(['refs']))
+        self.assertEqual(index.listdir(self.repo_path), frozenset(['refs']))
+        self.assertEqual((index.misses, index.revalidations), (1, 1))
+        self.touch('HEAD')
+        # making sure the folder's mtime moves, whatever the timestamp granularity.
+        t = time.time() + 10
+        os.utime(self.repo_path, (t, t))
+        self.assertEqual(index.listdir(self.repo_path), frozenset(['refs', 'head']))
+        self.assertEqual(index.misses, 2)
+        # missing folders are remembered too.
+        missing = os.path.join(self.base_path, 'other.git')
+        self.assertEqual(index.listdir(missing), frozenset())
+        os.makedirs(missing)
+        index.invalidate(missing)
+        self.assertEqual(index.listdir(missing), frozenset())
+        self.assertEqual(index.misses, 4)
+
+        index = repoindex.RepoIndex(ttl = 60, use_inotify = False)
+        index.listdir(self.repo_path)
+        self.touch('config')
+        self.assertEqual(index.listdir(self.repo_path), frozenset(['refs', 'head']))
+        self.assertEqual(index.hits, 1)
+        index.invalidate(self.repo_path)
+        self.assertEqual(index.listdir(self.repo_path), frozenset(['refs', 'head', 'config']))
+
+    def test_02_inotify(self):
+        index = repoindex.RepoIndex(ttl = None)
+        if index.inotify_fd is None:
+            self.skipTest('inotify is not available')
+        self.assertEqual(index.listdir(self.repo_path), frozenset(['refs']))
+        self.assertEqual(index.listdir(self.repo_path), frozenset(['refs']))
+        self.assertEqual((index.hits, index.misses), (1, 1))
+        self.touch('HEAD')
+        self.assertTrue(self.wait_for(index, ['refs', 'head']))
+        os.rename(os.path.join(self.repo_path, 'HEAD'), os.path.join(self.repo_path, 'ORIG_HEAD'))
+        self.assertTrue(self.wait_for(index, ['refs', 'orig_head']))
+        self.assertEqual(index.misses, 3)
+        shutil.rmtree(self.repo_path)
+        self.assertTrue(self.wait_for(index, []))
+        self.assertEqual(index.watches, {})
+        index.close()
+
+    def test_03_eviction(self):
+        index = repoindex.RepoIndex(max_entries = 2)
+        paths = []
+        for name in ('a', 'b', 'c'):
+            paths.append(os.path.join(self.base_path, name))
+            os.makedirs(paths[-1])
+            index.listdir(paths[-1])
+        self.assertEqual(list(index.entries), paths[1:])
+        if index.inotify_fd is not None:
+            self.assertEqual(
+                sorted(p for s in index.watches.values() for p in s),
+                paths[1:])
+        index.close()
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+import responsecache
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.base_path = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.base_path, 'repo.git')
+        os.makedirs(os.path.join(self.repo_path, 'refs', 'heads'))
+        os.makedirs(os.path.join(self.repo_path, 'refs', 'tags'))
+        self.write_ref('HEAD', 'ref: refs/heads/master\n')
+        self.write_ref('refs/heads/master', 'a' * 40 + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_path, True)
+
+    def write_ref(self, name, content):
+        # same as git does it - write lock file, rename over.
+        path = os.path.join(self.repo_path, name)
+        f = open(path + '.lock', 'w')
+        f.write(content)
+        f.close()
+        os.rename(path + '.lock', path)
+
+    def test_01_fingerprint_follows_refs(self):
+        fp = responsecache.ref_state_fingerprint(self.repo_path)
+        self.assertEqual(fp, responsecache.ref_state_fingerprint(self.repo_path))
+        self.write_ref('refs/tags/v1', 'b' * 40 + '\n')
+        fp_tag = responsecache.ref_state_fingerprint(self.repo_path)
+        self.assertNotEqual(fp, fp_tag)
+        self.write_ref('refs/heads/master', 'c' * 40 + '\n')
+        self.assertNotEqual(fp_tag, responsecache.ref_state_fingerprint(self.repo_path))
+        fp = responsecache.ref_state_fingerprint(self.repo_path)
+        self.write_ref('packed-refs', 'd' * 40 + ' refs/heads/other\n')
+        self.assertNotEqual(fp, responsecache.ref_state_fingerprint(self.repo_path))
+
+    def test_02_lru_byte_budget(self):
+        cache = responsecache.AdvertisementCache(max_bytes = 100)
+        cache.put('/a', 'git-upload-pack', 'f1', b'x' * 40)
+        cache.put('/b', 'git-upload-pack', 'f1', b'y' * 40)
+        self.assertEqual(cache.get('/a', 'git-upload-pack', 'f1'), b'x' * 40)
+        # /b is now least recently used and must be the one evicted.
+        cache.put('/c', 'git-upload-pack', 'f1', b'z' * 40)
+        self.assertEqual(cache.get('/b', 'git-upload-pack', 'f1'), None)
+        self.assertEqual(cache.get('/a', 'git-upload-pack', 'f1'), b'x' * 40)
+        self.assertEqual(cache.get('/a', 'git-upload-pack', 'f2'), None)
+        self.assertTrue(cache.size <= 100)
+        cache.put('/d', 'git-upload-pack', 'f1', b'w' * 101)
+        self.assertEqual(cache.get('/d', 'git-upload-pack', 'f1'), None)
+
+    def test_03_wrap_and_invalidate(self):
+        cache = responsecache.AdvertisementCache()
+        out = cache.wrap(iter([b'one', b'two']), '/a', 'git-upload-pack', 'f1')
+        self.assertEqual(b''.join(out), b'onetwo')
+        self.assertEqual(cache.get('/a', 'git-upload-pack', 'f1'), b'onetwo')
+        # output generated before invalidation is not stored.
+        out = cache.wrap(iter([b'old']), '/a', 'git-receive-pack', 'f1')
+        cache.invalidate('/a')
+        self.assertEqual(cache.get('/a', 'git-upload-pack', 'f1'), None)
+        self.assertEqual(b''.join(out), b'old')
+        self.assertEqual(cache.get('/a', 'git-receive-pack', 'f1'), None)
+        # closed before exhausted = not stored.
+        out = cache.wrap(iter([b'one', b'two']), '/a', 'git-upload-pack', 'f1')
+        next(out)
+        out.close()
+        self.assertEqual(cache.get('/a', 'git-upload-pack', 'f1'), None)
+
+    def test_04_shared_disk_cache(self):
+        cache_dir = os.path.join(self.base_path, 'cache')
+        one = responsecache.AdvertisementCache(cache_dir = cache_dir, max_disk_bytes = 1000)
+        two = responsecache.AdvertisementCache(cache_dir = cache_dir, max_disk_bytes = 1000)
+        one.put('/a', 'git-upload-pack', 'f1', b'x' * 400)
+        self.assertEqual(two.get('/a', 'git-upload-pack', 'f1'), b'x' * 400)
+        self.assertEqual(two.get('/a', 'git-upload-pack', 'f2'), None)
+        time.sleep(0.01)
+        one.put('/b', 'git-upload-pack', 'f1', b'y' * 400)
+        time.sleep(0.01)
+        one.put('/c', 'git-upload-pack', 'f1', b'z' * 400)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        two.invalidate('/c')
+        self.assertEqual(one.get('/b', 'git-upload-pack', 'f1'), b'y' * 400)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def pkt(self, *lines):
+        return b''.join(
+            (b'0000' if l is None else ('%04x' % (len(l) + 4)).encode('ascii') + l)
+            for l in lines)
+
+    def test_05_normalize_upload_pack_request(self):
+        a, b = b'a' * 40, b'b' * 40
+        one = self.pkt(
+            b'want ' + a + b' side-band-64k ofs-delta agent=git/2.1\n',
+            b'want ' + b + b'\n',
+            None,
+            b'done\n')
+        two = self.pkt(
+            b'want ' + b + b' ofs-delta side-band-64k agent=git/2.9\n',
+            b'want ' + a + b'\n',
+            None,
+            b'done\n')
+        self.assertTrue(responsecache.normalize_upload_pack_request(one))
+        self.assertEqual(
+            responsecache.normalize_upload_pack_request(one),
+            responsecache.normalize_upload_pack_request(two))
+        three = self.pkt(
+            b'want ' + a + b' side-band-64k ofs-delta\n',
+            None,
+            b'have ' + b + b'\n',
+            b'done\n')
+        self.assertNotEqual(
+            responsecache.normalize_upload_pack_request(one),
+            responsecache.normalize_upload_pack_request(three))
+        # negotiation rounds without "done" and garbage are not cacheable.
+        self.assertEqual(responsecache.normalize_upload_pack_request(
+            self.pkt(b'want ' + a + b'\n', None, b'have ' + b + b'\n', None)), None)
+        self.assertEqual(responsecache.normalize_upload_pack_request(b'zzzzwant'), None)
+
+    def test_06_pack_cache_fill(self):
+        cache = responsecache.PackResponseCache(
+            os.path.join(self.base_path, 'packs'), max_bytes = 100, fill_wait = 0.2)
+        key = cache.key(self.repo_path, 'f1', b'request')
+        self.assertEqual(cache.get(key), None)
+        self.assertTrue(cache.lock(key))
+        # other workers can't fill the same entry and time out waiting.
+        self.assertFalse(cache.lock(key))
+        self.assertEqual(cache.wait(key), None)
+        out = cache.fill(key, iter([b'PACK', b'data']))
+        self.assertEqual(b''.join(out), b'PACKdata')
+        f = cache.get(key)
+        self.assertEqual(f.read(), b'PACKdata')
+        f.close()
+        f = cache.wait(key)
+        self.assertEqual(f.read(), b'PACKdata')
+        f.close()
+        # waiting is counted on its own. (The timed out wait, and the wait
+        # getting the entry.)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual((cache.wait_hits, cache.wait_misses), (1, 1))
+        # abandoned fill leaves no entry and no lock behind.
+        other = cache.key(self.repo_path, 'f2', b'request')
+        self.assertTrue(cache.lock(other))
+        out = cache.fill(other, iter([b'PACK', b'data']))
+        next(out)
+        out.close()
+        self.assertEqual(cache.get(other), None)
+        self.assertTrue(cache.lock(other))
+        # eviction by size, least recently used first.
+        self.assertEqual(b''.join(cache.fill(other, iter([b'x' * 95]))), b'x' * 95)
+        self.assertEqual(cache.get(key), None)
+        f = cache.get(other)
+        self.assertEqual(len(f.read()), 95)
+        f.close()
+
+    def test_06a_pack_cache_dead_filler(self):
+        if not responsecache.fcntl:
+            self.skipTest('lock files are flock()ed only where fcntl is available')
+        cache_dir = os.path.join(self.base_path, 'packs')
+        cache = responsecache.PackResponseCache(cache_dir, fill_wait = 30)
+        key = cache.key(self.repo_path, 'f1', b'request')
+        filler = subprocess.Popen([
+            sys.executable, '-c',
+            'import sys, time, responsecache\n'
+            'responsecache.PackResponseCache(sys.argv[1]).lock(sys.argv[2])\n'
+            'print("locked")\n'
+            'sys.stdout.flush()\n'
+            'time.sleep(60)\n',
+            cache_dir, key],
+            stdout = subprocess.PIPE,
+            cwd = os.path.dirname(os.path.abspath(responsecache.__file__)))
+        try:
+            self.assertEqual(filler.stdout.readline().strip(), b'locked')
+            self.assertFalse(cache.lock(key))
+        finally:
+            filler.kill()
+            filler.wait()
+            filler.stdout.close()
+        # lock file is left behind, but nobody waits on it.
+        self.assertTrue(os.path.exists(cache._lock_path(key)))
+        start = time.time()
+        self.assertEqual(cache.wait(key), None)
+        self.assertTrue(time.time() - start < 5)
+        self.assertTrue(cache.lock(key))
+        cache.unlock(key)
+
+    def test_07_normalize_fetch_command(self):
+        a, b = b'a' * 40, b'b' * 40
+        normalize = responsecache.normalize_upload_pack_request
+        delimiter = b'0001'
+        one = (self.pkt(b'command=fetch\n', b'agent=git/2.39\n', b'object-format=sha1\n') + delimiter
+            + self.pkt(b'thin-pack\n', b'ofs-delta\n', b'want ' + a + b'\n', b'want ' + b + b'\n', b'done\n', None))
+        two = (self.pkt(b'command=fetch', b'object-format=sha1', b'agent=git/2.45') + delimiter
+            + self.pkt(b'want ' + b + b'\n', b'want ' + a + b'\n', b'want ' + a + b'\n', b'ofs-delta', b'thin-pack', b'done\n', None))
+        self.assertTrue(normalize(one, 2))
+        self.assertEqual(normalize(one, 2), normalize(two, 2))
+        # v2 requests are not v0 ones, and the other way around.
+        self.assertEqual(normalize(one), None)
+        self.assertEqual(normalize(self.pkt(b'want ' + a + b'\n', None, b'done\n'), 2), None)
+        # negotiation rounds, ls-refs, server options are not cacheable.
+        for request in (
+                self.pkt(b'command=fetch\n') + delimiter + self.pkt(b'want ' + a + b'\n', b'have ' + b + b'\n', None),
+                self.pkt(b'command=ls-refs\n') + delimiter + self.pkt(b'peel\n', None),
+                self.pkt(b'command=fetch\n', b'server-option=x\n') + delimiter + self.pkt(b'want ' + a + b'\n', b'done\n', None)):
+            self.assertEqual(normalize(request, 2), None)
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
@@ -0,0 +1,160 @@
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import subprocessio
+import simpleserver
+import git_http_backend
+
+class MainTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.base_path = tempfile.mkdtemp()
+        static = git_http_backend.StaticWSGIServer(content_path = self.base_path)
+        def app(environ, start_response):
+            if environ['REQUEST_METHOD'] == 'GET':
+                return static(environ, start_response)
+            self.requests.append(environ['wsgi.input'].read())
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            output = subprocessio.SubprocessIOChunker(
+                'head -c 1000000 /dev/zero',
+                starting_values = ['>'],
+                passthrough = True
+                ).output
+            return environ['wsgi.file_wrapper'](output, 65536)
+        simpleserver.RequestHandler.log_message = lambda *args: None
+        self.server = simpleserver.make_server('127.0.0.1', 0, app)
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.base_path, True)
+
+    def request(self, data):
+        s = socket.create_connection(('127.0.0.1', self.server.server_port))
+        s.sendall(data)
+        response = []
+        chunk = s.recv(65536)
+        while chunk:
+            response.append(chunk)
+            chunk = s.recv(65536)
+        s.close()
+        return b''.join(response)
+
+    def test_01_chunked_reader(self):
+        reader = simpleserver.ChunkedReader(
+            io.BytesIO(b'5\r\nhello\r\n6;ext=1\r\n world\r\n0\r\nTrailer: 1\r\n\r\nNEXT'))
+        self.assertEqual(reader.read(3), b'hel')
+        self.assertEqual(reader.read(), b'lo world')
+        self.assertEqual(reader.read(), b'')
+        reader = simpleserver.ChunkedReader(io.BytesIO(b'5\r\nhel'))
+        self.assertRaises(IOError, reader.read)
+
+    def test_02_request_bodies_and_file_response(self):
+        response = self.request(
+            b'POST / HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n')
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 200 OK'))
+        self.assertEqual(body, b'>' + b'\0' * 1000000)
+        response = self.request(
+            b'POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 4\r\n\r\nbody')
+        self.assertEqual(len(response.split(b'\r\n\r\n', 1)[1]), 1000001)
+        self.assertEqual(self.requests, [b'abcde', b'body'])
+
+    def test_03_ranges(self):
+        data = os.urandom(3000000)
+        with open(os.path.join(self.base_path, 'pack-1.pack'), 'wb') as f:
+            f.write(data)
+        calls = []
+        sendfile = simpleserver.sendfile
+        def counting_sendfile(*args):
+            calls.append(args)
+            return sendfile(*args)
+        simpleserver.sendfile = counting_sendfile
+        try:
+            response = self.request(
+                b'GET /pack-1.pack HTTP/1.1\r\nHost: x\r\nRange: bytes=1000-2000999\r\n\r\n')
+        finally:
+            simpleserver.sendfile = sendfile
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 206 Partial Content'))
+        self.assertTrue(b'Content-Range: bytes 1000-2000999/3000000' in head)
+        self.assertTrue(b'Content-Length: 2000000' in head)
+        self.assertEqual(body, data[1000:2001000])
+        self.assertTrue(calls)
+
+        response = self.request(
+            b'GET /pack-1.pack HTTP/1.1\r\nHost: x\r\nRange: bytes=0-9,-10\r\n\r\n')
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(b'Content-Length: %d' % len(body) in head)
+        boundary = head.split(b'boundary=')[1].split(b'\r\n')[0]
+        parts = body.split(b'\r\n--' + boundary)
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[1].split(b'\r\n\r\n')[1], data[:10])
+        self.assertTrue(b'Content-Range: bytes 2999990-2999999/3000000' in parts[2])
+        self.assertEqual(parts[2].split(b'\r\n\r\n')[1], data[-10:])
+        self.assertEqual(parts[3], b'--\r\n')
+
+        response = self.request(
+            b'GET /pack-1.pack HTTP/1.1\r\nHost: x\r\nRange: bytes=3000000-\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.0 416'))
+        self.assertTrue(b'Content-Range: bytes */3000000' in response)
+        # file changed since the client got the first part = whole file.
+        response = self.request(
+            b'GET /pack-1.pack HTTP/1.1\r\nHost: x\r\nRange: bytes=10-\r\nIf-Range: "other"\r\n\r\n')
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 200 OK'))
+        self.assertEqual(body, data)
+
+    def test_04_caching_headers(self):
+        sha = 'a' * 40
+        os.makedirs(os.path.join(self.base_path, 'objects', 'pack'))
+        with open(os.path.join(self.base_path, 'objects', 'pack', 'pack-%s.pack' % sha), 'wb') as f:
+            f.write(b'PACK')
+        with open(os.path.join(self.base_path, 'HEAD'), 'wb') as f:
+            f.write(b'ref: refs/heads/master\n')
+
+        def get(path, *headers):
+            response = self.request(
+                ('GET %s HTTP/1.1\r\nHost: x\r\n%s\r\n' % (path, ''.join(h + '\r\n' for h in headers))
+                ).encode('ascii'))
+            return response.split(b'\r\n\r\n', 1)[0].decode('ascii')
+
+        pack = '/objects/pack/pack-%s.pack' % sha
+        head = get(pack)
+        self.assertTrue('Cache-Control: public, max-age=31536000, immutable' in head)
+        self.assertTrue('ETag: "%s-pack"' % sha in head)
+        self.assertTrue(get(pack, 'If-None-Match: "x", "%s-pack"' % sha).startswith('HTTP/1.0 304'))
+        self.assertTrue(get(pack, 'If-None-Match: W/"%s-pack"' % sha).startswith('HTTP/1.0 304'))
+        self.assertTrue(get(pack, 'If-None-Match: *').startswith('HTTP/1.0 304'))
+        self.assertTrue(get(pack, 'If-None-Match: "%s"' % sha).startswith('HTTP/1.0 200'))
+        self.assertTrue(get(pack, 'If-Match: "%s-pack"' % sha).startswith('HTTP/1.0 200'))
+        # If-Match takes strong comparison.
+        self.assertTrue(get(pack, 'If-Match: W/"%s-pack"' % sha).startswith('HTTP/1.0 412'))
+        self.assertTrue(get(pack, 'If-Unmodified-Since: Thu, 01 Jan 1970 00:00:00 GMT').startswith('HTTP/1.0 412'))
+        # If-None-Match wins over If-Modified-Since.
+        self.assertTrue(get(pack,
+            'If-Modified-Since: Fri, 01 Jan 2100 00:00:00 GMT', 'If-None-Match: "x"').startswith('HTTP/1.0 200'))
+        self.assertTrue(get(pack, 'If-Modified-Since: Fri, 01 Jan 2100 00:00:00 GMT').startswith('HTTP/1.0 304'))
+        self.assertTrue(get(pack, 'If-Modified-Since: garbage').startswith('HTTP/1.0 200'))
+
+        head = get('/HEAD')
+        self.assertTrue('Cache-Control: public, max-age=5, must-revalidate' in head)
+        etag = head.split('ETag: ')[1].split('\r\n')[0]
+        self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+        self.assertTrue(get('/HEAD', 'If-None-Match: %s' % etag).startswith('HTTP/1.0 304'))
+
+if __name__ == "__main__":
+    unittest.TextTestRunner(verbosity=2).run(
+        unittest.TestSuite([
+            unittest.TestLoader().loadTestsFromTestCase(MainTestCase),
+        ])
+    )
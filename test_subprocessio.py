@@ -2,6 +2,9 @@ import random
 import unittest
 import subprocessio
 import tempfile
+import threading
+import time
+import os
 
 class MainTestCase(unittest.TestCase):
 
@@ -69,6 +72,258 @@ class MainTestCase(unittest.TestCase):
             0
             )
 
+    def test_03_coalesced_readers(self):
+        coalescer = subprocessio.SubprocessIOCoalescer()
+        cmd = 'sleep 1; seq 1 200000'
+        results = []
+        def reader():
+            results.append("".join(coalescer.run('key', cmd)))
+        threads = [threading.Thread(target = reader) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        expected = "".join(subprocessio.SubprocessIOChunker(cmd))
+        self.assertEqual(coalescer.started, 1)
+        self.assertEqual(len(results), 5)
+        for r in results:
+            self.assertEqual(r, expected)
+        # flight is over. next caller gets a new subprocess.
+        "".join(coalescer.run('key', cmd))
+        self.assertEqual(coalescer.started, 2)
+
+    def test_04_coalesced_slow_reader(self):
+        coalescer = subprocessio.SubprocessIOCoalescer()
+        cmd = 'sleep 1; head -c 1000000 /dev/zero'
+        slow = []
+        t = threading.Thread(target = lambda: slow.append(coalescer.run('key', cmd)))
+        t.start()
+        fast = coalescer.run('key', cmd)
+        t.join()
+        # slow reader never reads, but that does not hold up the fast one.
+        self.assertEqual(len("".join(fast)), 1000000)
+        self.assertEqual(len("".join(slow[0])), 1000000)
+        self.assertEqual(coalescer.started, 1)
+
+    def test_05_coalesced_error(self):
+        coalescer = subprocessio.SubprocessIOCoalescer()
+        self.assertRaises(
+            EnvironmentError,
+            coalescer.run,
+            'key',
+            'echo error >&2; exit 1'
+            )
+        self.assertEqual(coalescer.flights, {})
+
+    def test_06_reactor_throughput(self):
+        _r = subprocessio.ReactorSubprocessIOChunker(
+            'cat',
+            'This is a test string',
+            starting_values = ['>']
+            )
+        self.assertEqual("".join(_r), '>This is a test string')
+
+        size = 1000000
+        input = tempfile.TemporaryFile()
+        input.write("".join(chr(random.randrange(32,255)) for i in range(size)))
+        input.seek(0)
+        expected = input.read()
+        input.seek(0)
+        _r = subprocessio.ReactorSubprocessIOChunker(
+            'cat',
+            input,
+            buffer_size = 65536,
+            chunk_size = 4096
+            )
+        self.assertEqual("".join(_r), expected)
+
+    def test_07_reactor_shares_thread(self):
+        threads_before = threading.active_count()
+        chunkers = [
+            subprocessio.ReactorSubprocessIOChunker('head -c 300000 /dev/zero', buffer_size = 8192)
+            for i in range(20)
+            ]
+        # the one reactor thread, no matter the number of subprocesses.
+        self.assertTrue(threading.active_count() <= threads_before + 1)
+        for c in chunkers:
+            self.assertEqual(len("".join(c)), 300000)
+
+    def test_08_reactor_error(self):
+        self.assertRaises(
+            EnvironmentError,
+            subprocessio.ReactorSubprocessIOChunker,
+            'echo error >&2; sleep 1'
+            )
+        self.assertRaises(
+            EnvironmentError,
+            subprocessio.ReactorSubprocessIOChunker,
+            'exit 1'
+            )
+
+    def test_09_bounded_buffer(self):
+        r, w = os.pipe()
+        def produce():
+            for i in range(100):
+                os.write(w, 'x' * 64)
+            os.close(w)
+        t = threading.Thread(target = produce)
+        t.daemon = True
+        t.start()
+        _r = subprocessio.BufferedGenerator(os.fdopen(r, 'rb', 0), 256, 64)
+        started = time.time()
+        while not _r.reading_paused and time.time() - started < 5:
+            time.sleep(0.01)
+        # buffer limit is in bytes, not chunks.
+        self.assertTrue(_r.reading_paused)
+        self.assertEqual(_r.size, 256)
+        # slow consumer is waited for, not timed out on.
+        time.sleep(2.5)
+        self.assertEqual(len("".join(_r)), 6400)
+
+    def test_10_buffer_pool(self):
+        pool = subprocessio.BufferPool(chunk_size = 16384)
+        cmd = 'head -c 1000000 /dev/urandom | tee %s'
+        for i in range(5):
+            output = tempfile.NamedTemporaryFile()
+            _r = subprocessio.SubprocessIOChunker(
+                cmd % output.name,
+                buffer_size = 65536,
+                starting_values = ['>'],
+                pool = pool
+                )
+            self.assertEqual("".join(c.tobytes() if isinstance(c, memoryview) else c for c in _r), '>' + output.read())
+            _r.close()
+        # buffers are reused, not allocated anew per request.
+        self.assertTrue(pool.allocated <= 65536 / 16384 + 2)
+        self.assertTrue(pool.reused > 100)
+        self.assertEqual(pool.idle, pool.allocated)
+
+    def test_11_passthrough(self):
+        _r = subprocessio.SubprocessIOChunker(
+            'printf abc; sleep 0.2; printf def',
+            starting_values = ['>'],
+            passthrough = True
+            )
+        output = _r.output
+        del _r
+        # output is left in the pipe, for the consumer to read.
+        self.assertTrue(output.fileno() > 2)
+        self.assertEqual(output.read(), '>abcdef')
+        output.close()
+        self.assertEqual(
+            "".join(subprocessio.SubprocessIOChunker('cat', 'input', passthrough = True)),
+            'input'
+            )
+        self.assertRaises(
+            EnvironmentError,
+            subprocessio.SubprocessIOChunker,
+            'echo error >&2; exit 1',
+            passthrough = True
+            )
+        output = subprocessio.SubprocessIOChunker('printf abc; sleep 0.5; exit 2', passthrough = True).output
+        self.assertEqual(output.read(3), 'abc')
+        self.assertRaises(EnvironmentError, output.read, 3)
+
+    def test_12_coalesced_lone_reader(self):
+        spool_dir = tempfile.mkdtemp()
+        try:
+            coalescer = subprocessio.SubprocessIOCoalescer(spool_dir = spool_dir, memory_limit = 65536)
+            done = []
+            output = coalescer.run('key', 'head -c 1000000 /dev/zero', on_done = lambda: done.append(True))
+            flight = output.flight
+            size = len(output.next())
+            time.sleep(0.2)
+            # past memory_limit. Not spooled, held in memory up to the limit,
+            # and not taking more readers.
+            self.assertEqual(os.listdir(spool_dir), [])
+            self.assertTrue(len(flight.memory) <= 65536 + 65536)
+            self.assertEqual(coalescer.join('key'), None)
+            size += len("".join(output))
+            self.assertEqual(size, 1000000)
+            self.assertEqual(os.listdir(spool_dir), [])
+            output.close()
+            while not done:
+                time.sleep(0.01)
+            self.assertEqual(coalescer.started, 1)
+        finally:
+            os.rmdir(spool_dir)
+
+    def test_13_coalesced_spool_limit(self):
+        coalescer = subprocessio.SubprocessIOCoalescer(max_spool = 131072)
+        done = []
+        cmd = 'sleep 0.5; head -c 1000000 /dev/zero'
+        first = coalescer.run('key', cmd, on_done = lambda: done.append(True))
+        second = coalescer.run('key', cmd)
+        flight = first.flight
+        sizes = []
+        t = threading.Thread(target = lambda: sizes.append(len("".join(second))))
+        t.start()
+        self.assertEqual(len(first.next()), 65536)
+        time.sleep(0.7)
+        # past max_spool. No more readers, and no more output than that
+        # spooled before the first reader reads on.
+        self.assertTrue(flight.size - flight.spool_base <= 131072 + 65536)
+        self.assertTrue(os.fstat(flight.spool_fd).st_size <= 131072 + 65536)
+        third = coalescer.run('key', cmd)
+        self.assertTrue(third.flight is not flight)
+        self.assertEqual(coalescer.started, 2)
+        # the first reader leaving does not end the subprocess it started,
+        # nor the caller's hold on it (on_done.)
+        self.assertEqual(done, [])
+        first.close()
+        t.join()
+        self.assertEqual(sizes, [1000000])
+        while not done:
+            time.sleep(0.01)
+        self.assertEqual(len("".join(third)), 1000000)
+
+    def test_14_reactor_reused_fds(self):
+        # a chunker closed late must not touch file descriptors (numbers)
+        # that a newer one got since its pipes were closed.
+        for i in range(5):
+            first = subprocessio.ReactorSubprocessIOChunker('printf x')
+            self.assertEqual("".join(first), 'x')
+            results = []
+            def second():
+                results.append("".join(subprocessio.ReactorSubprocessIOChunker('sleep 0.3; printf y')))
+            t = threading.Thread(target = second)
+            t.daemon = True
+            t.start()
+            time.sleep(0.1)
+            first.close()
+            t.join(10)
+            self.assertEqual(results, ['y'])
+
+        def client(n):
+            for i in range(10):
+                c = subprocessio.ReactorSubprocessIOChunker('printf %d' % n)
+                results.append("".join(c) == str(n))
+                c.close()
+        results = []
+        threads = [threading.Thread(target = client, args = (n,)) for n in range(8)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEqual(results, [True] * 80)
+
+    def test_15_input_errors(self):
+        class TooLarge(IOError):
+            pass
+        class Source(object):
+            def __init__(self):
+                self.left = 3
+            def read(self, size = -1):
+                self.left -= 1
+                if not self.left:
+                    raise TooLarge('too large')
+                return 'x' * 10
+        for chunker in (subprocessio.SubprocessIOChunker, subprocessio.ReactorSubprocessIOChunker):
+            # the input's error, not the subprocess', whether that fails or not.
+            for cmd in ('cat; exit 1', 'cat'):
+                self.assertRaises(TooLarge, chunker, cmd, Source())
+
 
 if __name__ == "__main__":
     unittest.TextTestRunner(verbosity=2).run(